@@ -0,0 +1,25 @@
+import argparse
+import time
+from pathlib import Path
+
+from parse_env import getenv
+from src.index import build_index
+
+DB_DIR = Path(getenv("GEOLOCATION_DB_DIR", "db"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compile the City and ASN databases into one lookup index"
+    )
+    parser.add_argument("--city", default=DB_DIR.joinpath("GeoLite2-City.mmdb"))
+    parser.add_argument("--asn", default=DB_DIR.joinpath("GeoLite2-ASN.mmdb"))
+    parser.add_argument("--output", default=DB_DIR.joinpath("GeoLite2-City-ASN.idx"))
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    count = build_index(args.city, args.asn, args.output)
+    print(
+        f"Wrote {count} ranges to {args.output} "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
@@ -0,0 +1,47 @@
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+from src.diff import diff_builds
+
+CITY_DB = "GeoLite2-City.mmdb"
+ASN_DB = "GeoLite2-ASN.mmdb"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write the networks whose record changed between two builds "
+        "of the City and ASN databases as NDJSON"
+    )
+    parser.add_argument("old_dir", type=Path, help="Directory of the previous build")
+    parser.add_argument("new_dir", type=Path, help="Directory of the new build")
+    parser.add_argument("--output", help="Write to this file instead of stdout")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    summary = Counter()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for change in diff_builds(
+            args.old_dir.joinpath(CITY_DB),
+            args.old_dir.joinpath(ASN_DB),
+            args.new_dir.joinpath(CITY_DB),
+            args.new_dir.joinpath(ASN_DB),
+        ):
+            summary[change["database"], change["change"]] += 1
+            for field in change.get("changed_fields", ()):
+                summary[change["database"], field] += 1
+            change["network"] = str(change["network"])
+            output.write(json.dumps(change) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    for (database, key), count in sorted(summary.items()):
+        print(f"{database:<6}{key:<40}{count:>10}", file=sys.stderr)
+    print(
+        f"Compared the builds in {time.perf_counter() - started:.1f}s", file=sys.stderr
+    )
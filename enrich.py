@@ -0,0 +1,235 @@
+import argparse
+import csv
+import ipaddress
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+from geoip2.errors import AddressNotFoundError
+
+from parse_env import getenv
+from src.cache import NetworkCache
+from src.databases import MMDBReaderSet
+from src.models import geolocation_content, not_found_message
+
+DB_DIR = Path(getenv("GEOLOCATION_DB_DIR", "db"))
+
+# Columns appended to CSV rows, as paths into the `GeoLocation` content
+CSV_COLUMNS = (
+    ("continent_code", ("continent", "code")),
+    ("continent_name", ("continent", "name")),
+    ("country_iso_code", ("country", "iso_code")),
+    ("country_name", ("country", "name")),
+    ("country_is_in_european_union", ("country", "is_in_european_union")),
+    ("city_name", ("city", "name")),
+    ("latitude", ("location", "latitude")),
+    ("longitude", ("location", "longitude")),
+    ("accuracy_radius", ("location", "accuracy_radius")),
+    ("time_zone", ("location", "time_zone")),
+    ("postal_code", ("postal", "code")),
+    ("autonomous_system_number", ("asn", "autonomous_system_number")),
+    ("autonomous_system_organization", ("asn", "autonomous_system_organization")),
+    ("network", ("asn", "network")),
+)
+
+# Set in every worker process by `open_readers`
+_readers = None
+_cache = None
+
+
+def open_readers(city_path, asn_path, cache_size):
+    """Pool initializer, each worker maps the database files itself"""
+
+    global _readers, _cache
+    _readers = MMDBReaderSet(city_path, asn_path)
+    _cache = NetworkCache(cache_size)
+
+
+def lookup(ip_address):
+    """Return the `GeoLocation` content for an address and an error message, one of them None"""
+
+    try:
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return None, f"{ip_address} is not a valid IP address"
+
+    cached = _cache.get(ip)
+    if cached is None:
+        try:
+            (city, city_prefix_len), (asn, asn_prefix_len) = _readers.records(ip)
+        except AddressNotFoundError:
+            return None, not_found_message(ip_address)
+
+        asn_network = ipaddress.ip_network((ip, asn_prefix_len), strict=False)
+        cached = geolocation_content(city, asn, "", asn_network)
+        prefix_len = max(city_prefix_len, asn_prefix_len)
+        _cache.put(ipaddress.ip_network((ip, prefix_len), strict=False), cached)
+
+    content = dict(cached, asn=dict(cached["asn"], ip_address=str(ip)))
+    return content, None
+
+
+def enrich_ndjson(lines):
+    """Enrich NDJSON lines the same way as the /stream endpoint"""
+
+    output = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                output.append(json.dumps({"error": "Line is not valid JSON"}))
+                continue
+            if not isinstance(record, dict) or not isinstance(record.get("ip"), str):
+                output.append(json.dumps({"error": "Record has no ip field"}))
+                continue
+        else:
+            record = {"ip": line}
+
+        content, message = lookup(record["ip"])
+        if content is None:
+            record["error"] = message
+        else:
+            record["geolocation"] = content
+        output.append(json.dumps(record))
+
+    return output
+
+
+def enrich_csv(rows, ip_column):
+    """Append the `CSV_COLUMNS` and an error column to CSV rows"""
+
+    output = []
+    for row in rows:
+        ip_address = row[ip_column] if ip_column < len(row) else ""
+        content, message = lookup(ip_address)
+        values = []
+        for _, (section, field) in CSV_COLUMNS:
+            value = content.get(section, {}).get(field) if content else None
+            values.append("" if value is None else value)
+        output.append(row + values + [message or ""])
+
+    return output
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def run(chunks, enrich, write, workers, initargs):
+    """
+    Enrich chunks in a pool of worker processes, writing results in input order.
+
+    At most two chunks per worker are in flight, so memory use does not grow
+    with the size of the input. Returns the number of rows written.
+    """
+
+    rows = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(
+        workers, initializer=open_readers, initargs=initargs
+    ) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(enrich, chunk))
+            if len(pending) >= workers * 2:
+                rows += write(pending.popleft().result())
+                report(rows, started)
+        while pending:
+            rows += write(pending.popleft().result())
+            report(rows, started)
+
+    return rows
+
+
+def report(rows, started):
+    elapsed = time.perf_counter() - started
+    print(
+        f"\r{rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s)",
+        end="",
+        file=sys.stderr,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Enrich a CSV or NDJSON file of IP addresses with geolocation data"
+    )
+    parser.add_argument("input", help="Input file, or - for stdin")
+    parser.add_argument("output", help="Output file, or - for stdout")
+    parser.add_argument(
+        "--format",
+        choices=("csv", "ndjson"),
+        help="Input format, guessed from the input file extension by default",
+    )
+    parser.add_argument(
+        "--ip-column", default="ip", help="Name of the CSV column holding addresses"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--cache-size", type=int, default=4096)
+    parser.add_argument("--city", default=DB_DIR.joinpath("GeoLite2-City.mmdb"))
+    parser.add_argument("--asn", default=DB_DIR.joinpath("GeoLite2-ASN.mmdb"))
+    args = parser.parse_args(argv)
+
+    input_format = args.format or Path(args.input).suffix.lstrip(".").lower()
+    if input_format not in ("csv", "ndjson"):
+        parser.error("Cannot guess the input format, pass --format")
+
+    source = sys.stdin if args.input == "-" else open(args.input, newline="")
+    target = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    initargs = (args.city, args.asn, args.cache_size)
+    started = time.perf_counter()
+    try:
+        if input_format == "csv":
+            reader = csv.reader(source)
+            writer = csv.writer(target)
+            header = next(reader)
+            if args.ip_column not in header:
+                parser.error(f"The input has no {args.ip_column} column")
+            ip_column = header.index(args.ip_column)
+            writer.writerow(header + [name for name, _ in CSV_COLUMNS] + ["error"])
+
+            def write(rows):
+                writer.writerows(rows)
+                return len(rows)
+
+            enrich = partial(enrich_csv, ip_column=ip_column)
+        else:
+
+            def write(lines):
+                target.writelines(line + "\n" for line in lines)
+                return len(lines)
+
+            reader = source
+            enrich = enrich_ndjson
+
+        rows = run(
+            chunked(reader, args.chunk_size), enrich, write, args.workers, initargs
+        )
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"\rEnriched {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
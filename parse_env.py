@@ -1,9 +1,20 @@
 import os
 
 class ParseEnv:
+    def __init__(self):
+        self.loaded = False
+
     def load_dotenv(self):
         """Assuming that the .env file is in the root folder"""
 
+        # Read once per process, every setting is looked up at import time
+        if self.loaded:
+            return
+        self.loaded = True
+
+        if not os.path.exists(".env"):
+            return
+
         with open(".env", "r") as file:
             lines = file.readlines()
 
@@ -1,18 +1,25 @@
 from gunicorn.app.base import BaseApplication
-from src.main import app
+from parse_env import getenv
+from src import metrics
 import asyncio
+import logging
 import uvloop
 
 from uvicorn.workers import UvicornWorker
 
+logger = logging.getLogger("gunicorn.error")
+
+WORKERS = int(getenv("GEOLOCATION_WORKERS", "2"))
+PRELOAD_APP = getenv("GEOLOCATION_PRELOAD_APP", "true").lower() == "true"
+
+
 class UvicornWithUvloop(UvicornWorker):
     CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
 
 
 class StartApp(BaseApplication):
-    def __init__(self, app, options=None):
+    def __init__(self, options=None):
         self.options = options or {}
-        self.application = app
         super().__init__()
 
     def load_config(self):
@@ -25,16 +32,32 @@ class StartApp(BaseApplication):
             self.cfg.set(key.lower(), value)
 
     def load(self):
-        return self.application
+        from src.main import app
+        from src.models import PREWARM, databases
+
+        if PRELOAD_APP:
+            # This runs once in the master, so the workers forked from it share
+            # the database pages instead of opening their own copy. Without
+            # preload_app every worker opens them in its startup hook
+            databases.open()
+            if PREWARM:
+                size = databases.prewarm()
+                logger.info("Prewarmed %d bytes of database files", size)
+        return app
 
 
 if __name__ == "__main__":
     options = {
         "bind": "0.0.0.0:8080",
-        "workers": 2,
+        "workers": WORKERS,
+        "preload_app": PRELOAD_APP,
         "timeout": 0,
         "worker_class": "prod_server.UvicornWithUvloop",
     }
 
+    if metrics.ENABLED:
+        # Workers of a previous run may have left their metric files behind
+        metrics.registry.reset()
+
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-    StartApp(app, options).run()
+    StartApp(options).run()
@@ -0,0 +1,172 @@
+import asyncio
+import ipaddress
+from collections import Counter
+
+from geoip2.errors import AddressNotFoundError
+
+from . import models
+from .cache import NetworkCache
+
+# Dimensions addresses can be counted by, with the `GeoLocation` section and
+# field of their key
+DIMENSIONS = {
+    "country": ("country", "iso_code"),
+    "continent": ("continent", "code"),
+    "asn": ("asn", "autonomous_system_number"),
+}
+
+
+class Aggregation:
+    """
+    Counts of addresses per key of every dimension, added up one address at a
+    time without building a response for any of them.
+
+    Every dimension is looked up in the database of `registry` its section is
+    routed to. The keys of a record are cached by the network block of their
+    database, so addresses of a block already seen take no lookup.
+    `known_missing(ip, aggregation)` answers reserved and known missing
+    addresses without one.
+    """
+
+    def __init__(self, registry, dimensions, known_missing, cache_size=4096):
+        unknown = [
+            dimension for dimension in dimensions if dimension not in DIMENSIONS
+        ]
+        if unknown or not dimensions:
+            raise ValueError(
+                f"Unknown dimensions {', '.join(unknown) or 'none'}, "
+                f"expected some of {', '.join(DIMENSIONS)}"
+            )
+        self.dimensions = tuple(dict.fromkeys(dimensions))
+        route = registry.route(
+            tuple(dict.fromkeys(DIMENSIONS[dimension][0] for dimension in dimensions))
+        )
+        self.lookups = []
+        for name in dict.fromkeys(route.values()):
+            fields = tuple(
+                (dimension, DIMENSIONS[dimension][1])
+                for dimension in self.dimensions
+                if route[DIMENSIONS[dimension][0]] == name
+            )
+            self.lookups.append((registry[name], fields, NetworkCache(cache_size)))
+        # Read by `known_missing` like the databases of a `FieldPlan`
+        self.databases = tuple(database.name for database, _, _ in self.lookups)
+        self.known_missing = known_missing
+        self.counters = {dimension: Counter() for dimension in self.dimensions}
+        self.total = 0
+        self.invalid = 0
+        self.not_found = 0
+
+    def _keys(self, ip):
+        keys = []
+        for database, fields, cache in self.lookups:
+            cached = cache.get(ip)
+            if cached is None:
+                record, prefix_len = database.record(ip)
+                cached = tuple(
+                    _key(record, dimension, field) for dimension, field in fields
+                )
+                cache.put(ipaddress.ip_network((ip, prefix_len), strict=False), cached)
+            keys.extend(zip((dimension for dimension, _ in fields), cached))
+        return keys
+
+    def add(self, ip_address):
+        """Count one untrusted address"""
+
+        self.total += 1
+        try:
+            ip = ipaddress.ip_address(ip_address)
+        except ValueError:
+            self.invalid += 1
+            return
+        if self.known_missing(ip, self):
+            self.not_found += 1
+            return
+        try:
+            keys = self._keys(ip)
+        except AddressNotFoundError:
+            self.not_found += 1
+            return
+        for dimension, key in keys:
+            self.counters[dimension][key] += 1
+
+    def update(self, ip_addresses):
+        """Count every untrusted address of an iterable"""
+
+        for ip_address in ip_addresses:
+            self.add(ip_address)
+
+    def result(self, top=None):
+        """
+        The counts of every dimension, by key, or only the `top` keys as a
+        list with the count of the other keys. Keys are strings either way, as
+        JSON object keys are. Addresses without a key are counted as
+        `unknown`.
+        """
+
+        result = {
+            "total": self.total,
+            "found": self.total - self.invalid - self.not_found,
+            "invalid": self.invalid,
+            "not_found": self.not_found,
+        }
+        for dimension, counter in self.counters.items():
+            unknown = counter.get(None, 0)
+            known = len(counter) - (None in counter)
+            if top is None:
+                counts = {
+                    "counts": {
+                        str(key): count
+                        for key, count in counter.items()
+                        if key is not None
+                    }
+                }
+            else:
+                most_common = [
+                    (key, count)
+                    for key, count in counter.most_common(top + 1)
+                    if key is not None
+                ][:top]
+                counts = {
+                    "top": [
+                        {"key": str(key), "count": count} for key, count in most_common
+                    ],
+                    "others": counter.total()
+                    - unknown
+                    - sum(count for _, count in most_common),
+                }
+            result[dimension] = {"keys": known, **counts, "unknown": unknown}
+        return result
+
+
+def _key(record, dimension, field):
+    # ASN records are flat, City and Country records have a section per key
+    if dimension == "asn":
+        return record.get(field)
+    return record.get(dimension, {}).get(field)
+
+
+def aggregation(dimensions):
+    """
+    A new `Aggregation` of addresses by `dimensions` in the databases of the
+    registry, raising ValueError for unknown ones
+    """
+
+    return Aggregation(
+        models.registry, dimensions, models.known_missing, cache_size=models.CACHE_SIZE
+    )
+
+
+async def aggregate_stream(chunks, aggregation):
+    """
+    Count the addresses of a newline-delimited stream of chunks into
+    `aggregation`, the lines of every chunk in the threadpool
+    """
+
+    async for lines in models.stream_lines(chunks):
+        # A line too long to be an address is counted once as invalid
+        ip_addresses = [
+            "" if line is None else line.decode(errors="replace") for line in lines
+        ]
+        await asyncio.to_thread(aggregation.update, ip_addresses)
+    return aggregation
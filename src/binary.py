@@ -0,0 +1,139 @@
+import ipaddress
+import struct
+
+CONTENT_TYPE = "application/vnd.geolocation+binary"
+
+# A request body is a sequence of addresses, each a version byte (4 or 6)
+# followed by the 4 or 16 bytes of the packed address. The response holds one
+# record per address, in request order: a u8 status (`FOUND` or `NOT_FOUND`)
+# and the u16 size of the rest. A found record goes on with a u16 in which bit
+# i is set when `FIELDS[i]` follows, then the present fields in `FIELDS` order.
+# Strings are a u16 length followed by UTF-8 bytes, `asn.network` is sent as
+# its prefix length and `asn.ip_address` is left out, it is the address of the
+# request. Everything is little-endian.
+RECORD = struct.Struct("<BH")
+PRESENT = struct.Struct("<H")
+FOUND = 0
+NOT_FOUND = 1
+NOT_FOUND_RECORD = RECORD.pack(NOT_FOUND, 0)
+
+ADDRESS_SIZES = {4: 4, 6: 16}
+
+_STRING_SIZE = struct.Struct("<H")
+_KINDS = {
+    "bool": struct.Struct("<?"),
+    "u16": struct.Struct("<H"),
+    "u32": struct.Struct("<I"),
+    "f64": struct.Struct("<d"),
+    "prefix": struct.Struct("<B"),
+}
+
+# Section, field and how the value is packed
+FIELDS = (
+    ("continent", "code", "str"),
+    ("continent", "name", "str"),
+    ("country", "is_in_european_union", "bool"),
+    ("country", "iso_code", "str"),
+    ("country", "name", "str"),
+    ("city", "name", "str"),
+    ("location", "accuracy_radius", "u16"),
+    ("location", "latitude", "f64"),
+    ("location", "longitude", "f64"),
+    ("location", "metro_code", "u16"),
+    ("location", "time_zone", "str"),
+    ("asn", "autonomous_system_number", "u32"),
+    ("asn", "autonomous_system_organization", "str"),
+    ("asn", "network", "prefix"),
+    ("postal", "code", "str"),
+)
+assert len(FIELDS) <= PRESENT.size * 8
+
+
+def accepts(accept):
+    """Whether an Accept header allows a binary response"""
+
+    if not accept:
+        return True
+    media_types = {item.split(";")[0].strip() for item in accept.split(",")}
+    return bool(media_types & {CONTENT_TYPE, "application/*", "*/*"})
+
+
+def parse_addresses(body, max_count):
+    """Unpack the addresses of a request body, raising ValueError for a malformed one"""
+
+    addresses = []
+    position = 0
+    while position < len(body):
+        if len(addresses) == max_count:
+            raise ValueError(f"At most {max_count} addresses are accepted")
+        version = body[position]
+        size = ADDRESS_SIZES.get(version)
+        if size is None:
+            raise ValueError(f"Unknown address version {version} at byte {position}")
+        packed = body[position + 1 : position + 1 + size]
+        if len(packed) != size:
+            raise ValueError(f"Truncated address at byte {position}")
+        addresses.append(ipaddress.ip_address(packed))
+        position += 1 + size
+
+    if not addresses:
+        raise ValueError("No addresses in the request body")
+    return addresses
+
+
+def encode_content(content):
+    """Encode the content of a `GeoLocation` response into a found record"""
+
+    present = 0
+    values = []
+    for bit, (section, field, kind) in enumerate(FIELDS):
+        value = content.get(section, {}).get(field)
+        if value is None:
+            continue
+        present |= 1 << bit
+        if kind == "str":
+            encoded = value.encode()
+            values.append(_STRING_SIZE.pack(len(encoded)))
+            values.append(encoded)
+        elif kind == "prefix":
+            values.append(_KINDS[kind].pack(int(value.rpartition("/")[2])))
+        else:
+            values.append(_KINDS[kind].pack(value))
+
+    payload = PRESENT.pack(present) + b"".join(values)
+    return RECORD.pack(FOUND, len(payload)) + payload
+
+
+def decode_records(data):
+    """Decode the records of a response, None for addresses that were not found"""
+
+    records = []
+    position = 0
+    while position < len(data):
+        status, size = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        if status != FOUND:
+            records.append(None)
+            position += size
+            continue
+
+        end = position + size
+        (present,) = PRESENT.unpack_from(data, position)
+        position += PRESENT.size
+        record = {}
+        for bit, (section, field, kind) in enumerate(FIELDS):
+            if not present & 1 << bit:
+                continue
+            if kind == "str":
+                (length,) = _STRING_SIZE.unpack_from(data, position)
+                position += _STRING_SIZE.size
+                value = data[position : position + length].decode()
+                position += length
+            else:
+                (value,) = _KINDS[kind].unpack_from(data, position)
+                position += _KINDS[kind].size
+            record.setdefault(section, {})[field] = value
+        records.append(record)
+        position = end
+
+    return records
@@ -0,0 +1,137 @@
+import bisect
+import threading
+from collections import Counter, OrderedDict
+
+
+class NetworkCache:
+    """
+    LRU cache of lookup results keyed by the network block they were found in.
+
+    Every address in a network block returned by the databases shares the same
+    record, so a single entry answers lookups for the whole block. The cache
+    must be cleared whenever different database files are loaded. It is safe
+    to use from the threadpool while the event loop evicts or clears it.
+
+    Every eviction and clear starts a new `generation`. A lookup that reads it
+    before acquiring the databases passes it to `put`, so a result of a build
+    the cache was invalidated for is dropped instead of cached.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._prefix_lens = {4: Counter(), 6: Counter()}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(ip_address, prefix_len):
+        host_bits = ip_address.max_prefixlen - prefix_len
+        return ip_address.version, prefix_len, int(ip_address) >> host_bits
+
+    def get(self, ip_address):
+        """Return the cached result for the block containing `ip_address`, or None"""
+
+        with self._lock:
+            prefix_lens = self._prefix_lens[ip_address.version]
+            # Blocks from one database build never overlap, so at most one can match
+            for prefix_len in prefix_lens:
+                key = self._key(ip_address, prefix_len)
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, network, value, generation=None):
+        if self.maxsize <= 0:
+            return
+
+        key = self._key(network.network_address, network.prefixlen)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key not in self._entries:
+                self._prefix_lens[network.version][network.prefixlen] += 1
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                (version, prefix_len, _), _ = self._entries.popitem(last=False)
+                self._forget_prefix_len(version, prefix_len)
+                self.evictions += 1
+
+    def _forget_prefix_len(self, version, prefix_len):
+        prefix_lens = self._prefix_lens[version]
+        prefix_lens[prefix_len] -= 1
+        if not prefix_lens[prefix_len]:
+            del prefix_lens[prefix_len]
+
+    def evict(self, networks):
+        """Remove the blocks overlapping any of `networks`, returning how many were removed"""
+
+        ranges = {4: [], 6: []}
+        for network in networks:
+            ranges[network.version].append(
+                (int(network.network_address), int(network.broadcast_address))
+            )
+        starts = {}
+        ends = {}
+        for version, version_ranges in ranges.items():
+            version_ranges.sort()
+            # Merged, so the last range starting before a block is the only candidate
+            merged = []
+            for start, end in version_ranges:
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            starts[version] = [start for start, _ in merged]
+            ends[version] = [end for _, end in merged]
+
+        evicted = []
+        with self._lock:
+            self.generation += 1
+            for key in self._entries:
+                version, prefix_len, value = key
+                host_bits = (32 if version == 4 else 128) - prefix_len
+                block_start = value << host_bits
+                block_end = block_start + (1 << host_bits) - 1
+                position = bisect.bisect_right(starts[version], block_end) - 1
+                if position >= 0 and ends[version][position] >= block_start:
+                    evicted.append(key)
+
+            for key in evicted:
+                del self._entries[key]
+                self._forget_prefix_len(key[0], key[1])
+        return len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            for prefix_lens in self._prefix_lens.values():
+                prefix_lens.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            size = len(self._entries)
+        lookups = hits + misses
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "hits": hits,
+            "misses": misses,
+            "evictions": self.evictions,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
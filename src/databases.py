@@ -0,0 +1,493 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import cached_property
+
+import maxminddb
+from geoip2.errors import AddressNotFoundError
+from geoip2.models import ASN, City
+
+logger = logging.getLogger(__name__)
+
+LOCALES = ["en"]
+
+READER_MODES = {
+    "mmap_ext": maxminddb.MODE_MMAP_EXT,
+    "mmap": maxminddb.MODE_MMAP,
+    "memory": maxminddb.MODE_MEMORY,
+}
+
+
+def files_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            signature.append(None)
+        else:
+            signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return signature
+
+
+def reader_mode(name):
+    try:
+        return READER_MODES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown reader mode {name!r}, expected one of {', '.join(READER_MODES)}"
+        ) from None
+
+
+def prewarm(paths, chunk_size=1 << 20):
+    """Read files once so their pages are in the page cache, returning the bytes read"""
+
+    buffer = bytearray(chunk_size)
+    total = 0
+    for path in paths:
+        with open(path, "rb", buffering=0) as file:
+            while size := file.readinto(buffer):
+                total += size
+    return total
+
+
+def duplicate_files(files):
+    """
+    Open the files of a build again on duplicated descriptors, which read the
+    same build and stay open when a reload closes the originals
+    """
+
+    return {
+        name: os.fdopen(os.dup(file.fileno()), "rb") for name, file in files.items()
+    }
+
+
+class RecordNotFoundError(AddressNotFoundError):
+    """An address missing from the "city" or "asn" database named by `database`"""
+
+    def __init__(self, message, ip_address, prefix_len, database):
+        super().__init__(message, ip_address, prefix_len)
+        self.database = database
+
+
+def address_not_found(ip_address, prefix_len, database):
+    return RecordNotFoundError(
+        f"The address {ip_address} is not in the database.",
+        str(ip_address),
+        prefix_len,
+        database,
+    )
+
+
+class Retirable:
+    """
+    An open resource that lookups hold while they use it, so once it is
+    retired it is only closed after the last of them has finished.
+    Subclasses provide `close`.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.retired = False
+        self.closed = False
+        self._hold_lock = threading.Lock()
+
+    def close(self):
+        raise NotImplementedError
+
+    def hold(self):
+        """Count a lookup using it, returning False if it is already closed"""
+
+        with self._hold_lock:
+            if self.closed:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._hold_lock:
+            self.in_flight -= 1
+            self._close_if_drained()
+
+    def retire(self):
+        with self._hold_lock:
+            self.retired = True
+            self._close_if_drained()
+
+    def _close_if_drained(self):
+        if self.retired and not self.in_flight and not self.closed:
+            self.close()
+            self.closed = True
+
+
+class ReaderSet(Retirable):
+    """
+    City and ASN lookups served from one build of the databases.
+
+    Lookups hold the set while they use it, so a set retired by a reload is
+    only closed once the last of them has finished. Subclasses provide the raw
+    records, `metadata` and `close`, and may keep the database files of the
+    build open in `files` so it can be compared with the next one.
+    """
+
+    files = None
+
+    def records(self, ip_address):
+        """Return the `(record, prefix_len)` pairs of the City and ASN databases"""
+
+        raise NotImplementedError
+
+    def city_record(self, ip_address):
+        """Return the `(record, prefix_len)` pair of the City database alone"""
+
+        return self.records(ip_address)[0]
+
+    def asn_record(self, ip_address):
+        """Return the `(record, prefix_len)` pair of the ASN database alone"""
+
+        return self.records(ip_address)[1]
+
+    def lookup(self, ip_address):
+        """Return the geoip2 City and ASN models for an address"""
+
+        (city, city_prefix_len), (asn, asn_prefix_len) = self.records(ip_address)
+        traits = city.setdefault("traits", {})
+        traits["ip_address"] = ip_address
+        traits["prefix_len"] = city_prefix_len
+        asn["ip_address"] = ip_address
+        asn["prefix_len"] = asn_prefix_len
+        return City(city, locales=LOCALES), ASN(asn)
+
+    @cached_property
+    def build_epoch(self):
+        return max(metadata.build_epoch for metadata in self.metadata().values())
+
+    def validate(self):
+        for name, database_type in (("city", "City"), ("asn", "ASN")):
+            metadata = self.metadata()[name]
+            if database_type not in metadata.database_type:
+                raise ValueError(
+                    f"Expected a {database_type} database, got {metadata.database_type}"
+                )
+        # Walk the search trees once, a missing address still proves they are readable
+        try:
+            self.lookup("8.8.8.8")
+        except AddressNotFoundError:
+            pass
+
+    def describe(self):
+        return {
+            name: {
+                "database_type": metadata.database_type,
+                "build_epoch": metadata.build_epoch,
+            }
+            for name, metadata in self.metadata().items()
+        }
+
+
+class MMDBReaderSet(ReaderSet):
+    """City and ASN records read from the MaxMind DB files"""
+
+    def __init__(self, city_path, asn_path, mode=maxminddb.MODE_MMAP_EXT):
+        super().__init__()
+        self.city_reader = maxminddb.open_database(city_path, mode)
+        try:
+            self.asn_reader = maxminddb.open_database(asn_path, mode)
+        except Exception:
+            self.city_reader.close()
+            raise
+        # Still the files of this build after geoipupdate replaces the paths
+        self.files = {"city": open(city_path, "rb"), "asn": open(asn_path, "rb")}
+
+    @staticmethod
+    def _record(reader, ip_address, database):
+        record, prefix_len = reader.get_with_prefix_len(ip_address)
+        if record is None:
+            raise address_not_found(ip_address, prefix_len, database)
+        return record, prefix_len
+
+    def records(self, ip_address):
+        return (
+            self._record(self.city_reader, ip_address, "city"),
+            self._record(self.asn_reader, ip_address, "asn"),
+        )
+
+    def city_record(self, ip_address):
+        return self._record(self.city_reader, ip_address, "city")
+
+    def asn_record(self, ip_address):
+        return self._record(self.asn_reader, ip_address, "asn")
+
+    def metadata(self):
+        return {"city": self.city_reader.metadata(), "asn": self.asn_reader.metadata()}
+
+    def close(self):
+        self.city_reader.close()
+        self.asn_reader.close()
+        if self.files is not None:
+            for file in self.files.values():
+                file.close()
+
+
+def _run_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            logger.exception("Database callback %r failed", callback)
+
+
+class DatabaseManager:
+    """
+    Owns the active ReaderSet and swaps in new database builds without downtime.
+
+    `open_readers` opens a new ReaderSet from `paths`. The first set is opened
+    by `open`, or by the first lookup that needs it, followed by the `on_open`
+    callbacks. New readers are opened and validated off the event loop, then
+    replace the active set atomically. In-flight lookups keep using the set
+    they acquired.
+
+    `compare(previous, readers)` runs off the event loop before a swap, and
+    what it returns is kept in `last_changes` for the `on_reload` callbacks,
+    which run on the event loop right after the swap, followed by the
+    `on_reload_blocking` callbacks in the threadpool. A failing callback is
+    logged and does not stop the others.
+    The files of the replaced build are kept in `previous_files` until the
+    next swap, so readers that outlive it need `duplicate_files`.
+    """
+
+    def __init__(
+        self,
+        open_readers,
+        paths,
+        on_reload=(),
+        on_reload_blocking=(),
+        on_open=(),
+        compare=None,
+    ):
+        self.open_readers = open_readers
+        self.paths = paths
+        self.on_reload = list(on_reload)
+        self.on_reload_blocking = list(on_reload_blocking)
+        self.on_open = list(on_open)
+        self.compare = compare
+        self.last_changes = None
+        self.previous_files = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.last_reload_duration = None
+        self.last_reload_error = None
+        self.prewarmed = False
+        self._current = None
+        self._signature = None
+        self._open_lock = threading.Lock()
+        self._lock = asyncio.Lock()
+
+    @property
+    def current(self):
+        readers = self._current
+        if readers is None:
+            readers = self.open()
+        return readers
+
+    @current.setter
+    def current(self, readers):
+        self._current = readers
+
+    @property
+    def is_open(self):
+        return self._current is not None
+
+    def open(self):
+        """Open the first ReaderSet unless it is already open, returning the active set"""
+
+        with self._open_lock:
+            if self._current is None:
+                signature = files_signature(self.paths)
+                self._current = self.open_readers()
+                self._signature = signature
+                self.loaded_at = time.time()
+                for callback in self.on_open:
+                    callback()
+        return self._current
+
+    @contextmanager
+    def acquire(self):
+        readers = self.current
+        # A lookup in the threadpool can race a swap, the set it read may
+        # have been retired and closed since
+        while not readers.hold():
+            readers = self.current
+        try:
+            yield readers
+        finally:
+            readers.release()
+
+    def _open(self):
+        readers = self.open_readers()
+        try:
+            readers.validate()
+        except Exception:
+            readers.retire()
+            raise
+        return readers
+
+    async def reload(self):
+        """Open the database files again and swap them in, returning whether the swap happened"""
+
+        async with self._lock:
+            if not self.is_open:
+                # The first load of the files, there is nothing to swap out
+                await asyncio.to_thread(self.open)
+                return True
+            started = time.perf_counter()
+            signature = files_signature(self.paths)
+            try:
+                readers = await asyncio.to_thread(self._open)
+            except Exception as exc:
+                self.last_reload_error = str(exc)
+                logger.exception(
+                    "Reloading databases failed, keeping build %s",
+                    self.current.build_epoch,
+                )
+                return False
+
+            changes = None
+            if self.compare is not None:
+                try:
+                    changes = await asyncio.to_thread(
+                        self.compare, self._current, readers
+                    )
+                except Exception:
+                    logger.exception("Comparing database builds failed")
+
+            previous, self._current = self._current, readers
+            self._signature = signature
+            self.loaded_at = time.time()
+            self.reloads += 1
+            self.last_reload_duration = time.perf_counter() - started
+            self.last_reload_error = None
+            self.last_changes = changes
+            self._keep_files(previous)
+            previous.retire()
+            _run_callbacks(self.on_reload)
+            await asyncio.to_thread(_run_callbacks, self.on_reload_blocking)
+            logger.info(
+                "Loaded database build %s in %.3fs",
+                readers.build_epoch,
+                self.last_reload_duration,
+            )
+            return True
+
+    def _keep_files(self, previous):
+        if self.previous_files is not None:
+            for file in self.previous_files.values():
+                file.close()
+        # Taken over so closing the retired set leaves them open
+        self.previous_files, previous.files = previous.files, None
+
+    def prewarm(self):
+        size = prewarm(self.paths)
+        self.prewarmed = True
+        return size
+
+    def changed(self):
+        # Files that were never opened have nothing to be swapped out
+        return self.is_open and files_signature(self.paths) != self._signature
+
+    async def watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.changed():
+                    await self.reload()
+            except Exception:
+                # Keep watching, the next change may load
+                logger.exception("Watching the databases failed")
+
+    def status(self):
+        return {
+            "build_epoch": self.current.build_epoch,
+            "databases": self.current.describe(),
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+            "last_reload_duration": self.last_reload_duration,
+            "last_reload_error": self.last_reload_error,
+        }
+
+
+class FileIndex:
+    """
+    An index built by `build(path)` from a small configuration file, on first
+    use and again when the file changes. `on_load` callbacks run after every
+    build. A file that fails to build keeps the previous index.
+    """
+
+    def __init__(self, path, build, on_load=()):
+        self.path = path
+        self.build = build
+        self.on_load = list(on_load)
+        self.index = None
+        self.loaded_at = None
+        self.last_error = None
+        self._signature = None
+
+    def current(self):
+        """The index of the file, raising FileNotFoundError without one"""
+
+        if self.index is None:
+            self._swap(*self._build())
+        return self.index
+
+    def _build(self):
+        signature = files_signature((self.path,))
+        return signature, self.build(self.path)
+
+    def _swap(self, signature, index):
+        self.index = index
+        self._signature = signature
+        self.loaded_at = time.time()
+        self.last_error = None
+        for callback in self.on_load:
+            callback()
+
+    def changed(self):
+        if self.index is None:
+            return False
+        return files_signature((self.path,)) != self._signature
+
+    async def reload(self):
+        """Build the index of the file again off the event loop and swap it in"""
+
+        signature = files_signature((self.path,))
+        try:
+            signature, index = await asyncio.to_thread(self._build)
+        except (OSError, ValueError) as exc:
+            # Keep serving the previous index until the file changes again
+            self._signature = signature
+            self.last_error = str(exc)
+            logger.exception("Loading %s failed", self.path)
+            return False
+        self._swap(signature, index)
+        logger.info("Loaded %s", self.path)
+        return True
+
+    async def watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.changed():
+                    await self.reload()
+            except Exception:
+                logger.exception("Watching %s failed", self.path)
+
+    def status(self):
+        return {
+            "path": str(self.path),
+            "size": None if self.index is None else len(self.index),
+            "loaded_at": self.loaded_at,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,129 @@
+import ipaddress
+from functools import lru_cache
+
+from .mmdb import IPV4_MAX, TreeWalker, merge_partitions, tree_network
+from .networks import cidrs
+
+# Pairs of records compared, and so decoded, at most once during a diff
+COMPARE_CACHE_SIZE = 65536
+
+
+def changed_fields(old, new):
+    """The `section.field` paths, or top level keys, that differ between two records"""
+
+    fields = []
+    for key in sorted(old.keys() | new.keys()):
+        old_value, new_value = old.get(key), new.get(key)
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            fields.extend(
+                f"{key}.{field}"
+                for field in sorted(old_value.keys() | new_value.keys())
+                if old_value.get(field) != new_value.get(field)
+            )
+        else:
+            fields.append(key)
+    return fields
+
+
+def aliased_networks(network, aliases):
+    """The IPv6 networks that the `aliases` of a build map onto an IPv4 network"""
+
+    if network.version != 4:
+        return []
+    return [
+        ipaddress.IPv6Network(
+            (
+                int(alias.network_address)
+                | int(network.network_address) << (96 - alias.prefixlen),
+                alias.prefixlen + network.prefixlen,
+            )
+        )
+        for alias in aliases
+    ]
+
+
+def _end(network, bits):
+    start, prefix_len, _ = network
+    return start + (1 << (bits - prefix_len)) - 1
+
+
+def diff_database(old, new, database, aliases=None):
+    """
+    Yield every network whose record differs between two builds of a
+    database, as a dict with the `database` name, the `network`, the `change`
+    ("added", "removed" or "changed") and, for a changed record, the
+    `changed_fields`. `old` and `new` are paths or open binary files. A
+    network split or merged with others is changed too, with a `network`
+    changed field, as the network of its responses differs.
+
+    Both search trees are walked once, side by side, so memory does not grow
+    with the size of the databases. Adjacent networks with the same pair of
+    records are reported as the fewest CIDRs covering them. When `aliases` is
+    a list, it is extended with the IPv6 networks the new build aliases to its
+    IPv4 networks.
+    """
+
+    with TreeWalker(old) as old_walker, TreeWalker(new) as new_walker:
+        if old_walker.bits != new_walker.bits:
+            raise ValueError("The two builds must have the same IP version")
+        bits = new_walker.bits
+
+        @lru_cache(maxsize=COMPARE_CACHE_SIZE)
+        def compare(old_pointer, new_pointer):
+            if old_pointer is None:
+                return "added", None
+            if new_pointer is None:
+                return "removed", None
+            fields = changed_fields(
+                old_walker.record(old_pointer), new_walker.record(new_pointer)
+            )
+            return ("changed", tuple(fields)) if fields else (None, None)
+
+        def changes(start, end, pointers, resized):
+            if pointers == (None, None):
+                return
+            change, fields = compare(*pointers)
+            if resized and change in (None, "changed"):
+                # A split or merged network changes the `network` of every
+                # response for it, even with the same record
+                change, fields = "changed", (fields or ()) + ("network",)
+            if change is None:
+                return
+            for network_start, prefix_len in cidrs(start, end, bits):
+                item = {
+                    "database": database,
+                    "network": tree_network(bits, network_start, prefix_len),
+                    "change": change,
+                }
+                if fields is not None:
+                    item["changed_fields"] = list(fields)
+                yield item
+
+        run_start = run_end = run_key = None
+        merged = merge_partitions(old_walker.networks(), new_walker.networks(), bits)
+        for start, old_network, new_network in merged:
+            end = min(_end(old_network, bits), _end(new_network, bits))
+            key = (old_network[2], new_network[2]), old_network[:2] != new_network[:2]
+            # IPv4 networks of an IPv6 tree are never merged with the IPv6 ones
+            if key == run_key and start != IPV4_MAX + 1:
+                run_end = end
+                continue
+            if run_key is not None:
+                yield from changes(run_start, run_end, *run_key)
+            run_start, run_end, run_key = start, end, key
+        yield from changes(run_start, run_end, *run_key)
+
+        if aliases is not None:
+            aliases.extend(
+                ipaddress.IPv6Network((start, prefix_len))
+                for start, prefix_len in new_walker.aliases
+            )
+
+
+def diff_builds(old_city, old_asn, new_city, new_asn, aliases=None):
+    """The changes of the City database followed by those of the ASN database"""
+
+    yield from diff_database(old_city, new_city, "city", aliases)
+    yield from diff_database(old_asn, new_asn, "asn")
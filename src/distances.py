@@ -0,0 +1,194 @@
+import ipaddress
+import socket
+from pathlib import Path
+
+from parse_env import getenv
+
+from . import models
+from .cache import NetworkCache
+from .databases import FileIndex, RecordNotFoundError
+
+GEOFENCES_FILE = Path(
+    getenv(
+        "GEOLOCATION_GEOFENCES_FILE", str(models.BASE_DIR.joinpath("geofences.json"))
+    )
+)
+
+# The coordinates and accuracy radius of a City network block
+location_cache = models.register_cache("location", NetworkCache(models.CACHE_SIZE))
+
+
+def load_geofences(path):
+    # NumPy is only needed by distance requests, keep it out of server startup
+    from .geo import load_geofences
+
+    return load_geofences(path)
+
+
+# Opened on the first request for a geofence, see `distances`
+geofences = FileIndex(GEOFENCES_FILE, load_geofences)
+
+
+def _location(ip, database):
+    """The `(latitude, longitude, accuracy_radius)` of an address, or None"""
+
+    cached = location_cache.get(ip)
+    if cached is None:
+        # See `models.lookup_ip`
+        generation = location_cache.generation
+        missing_generation = models.missing_cache.generation
+        try:
+            record, prefix_len = models.registry[database].record(ip)
+        except RecordNotFoundError as exc:
+            models.missing_cache.put(exc.network, exc.database, missing_generation)
+            return None
+        location = record.get("location", {})
+        cached = (
+            location.get("latitude"),
+            location.get("longitude"),
+            location.get("accuracy_radius"),
+        )
+        location_cache.put(
+            ipaddress.ip_network((ip, prefix_len), strict=False), cached, generation
+        )
+    return cached
+
+
+def _parse_ip(ip_address):
+    # inet_pton parses a dotted quad several times faster than `ipaddress`
+    # and is just as strict, other addresses are left to `ipaddress`
+    try:
+        return ipaddress.IPv4Address(socket.inet_pton(socket.AF_INET, ip_address))
+    except OSError:
+        return ipaddress.ip_address(ip_address)
+
+
+def locate(ip_addresses):
+    """
+    The coordinates and accuracy radius in km of every untrusted address of a
+    batch, as NumPy arrays with NaN coordinates for an address without a
+    location, and its status code: 422 for an invalid address and 404 for one
+    without a location.
+
+    With `GEOLOCATION_LOOKUP_ENGINE=index` the whole batch is resolved at once
+    in the `models.range_index`, otherwise every network block is looked up
+    once.
+    """
+
+    import numpy as np
+
+    invalid = []
+    ips = []
+    for position, ip_address in enumerate(ip_addresses):
+        try:
+            ips.append((position, _parse_ip(ip_address)))
+        except ValueError:
+            invalid.append(position)
+
+    count = len(ip_addresses)
+    latitudes = np.full(count, np.nan)
+    longitudes = np.full(count, np.nan)
+    radii = np.zeros(count)
+    if models.LOOKUP_ENGINE == "index":
+        index = models.range_index()
+        for version in (4, 6):
+            positions = [position for position, ip in ips if ip.version == version]
+            if not positions:
+                continue
+            values = [int(ip) for _, ip in ips if ip.version == version]
+            if version == 4:
+                columns = index.lookup_ipv4(np.array(values, dtype=np.uint64))
+            else:
+                columns = index.lookup_ipv6(
+                    np.array([value >> 64 for value in values], dtype=np.uint64),
+                    np.array([value & (2**64 - 1) for value in values], np.uint64),
+                )
+            latitudes[positions] = columns["latitude"]
+            longitudes[positions] = columns["longitude"]
+            radii[positions] = columns["accuracy_radius"]
+    else:
+        plan = models.field_plan("location")
+        database = plan.databases[0]
+        positions, locations = [], []
+        for position, ip in ips:
+            location = None
+            if not models.known_missing(ip, plan):
+                location = _location(ip, database)
+            if location is not None:
+                positions.append(position)
+                locations.append(location)
+        if locations:
+            columns = np.array(locations, dtype=np.float64)
+            latitudes[positions] = columns[:, 0]
+            longitudes[positions] = columns[:, 1]
+            radii[positions] = np.nan_to_num(columns[:, 2])
+
+    status = np.where(np.isnan(latitudes) | np.isnan(longitudes), 404, 200)
+    status[invalid] = 422
+    return status, latitudes, longitudes, radii
+
+
+def _column(values):
+    # NaN is not valid JSON
+    return [None if value != value else value for value in values.tolist()]
+
+
+def distances(request):
+    """
+    The location of every address of a `DistanceRequest` with its distance
+    to the given points and whether it is within the distance or the
+    geofences, as lists by column.
+
+    Distances are given as the range the true location can be in, from
+    `min_distance_km` to `max_distance_km` around the distance to the
+    located point, by its accuracy radius. `within` and every geofence are
+    True or False only when that holds for the whole range, otherwise None.
+
+    Raises ValueError for an unknown geofence.
+    """
+
+    import numpy as np
+
+    from .geo import distance_km, verdicts
+
+    fences = {}
+    if request.geofences:
+        configured = geofences.current()
+        unknown = [name for name in request.geofences if name not in configured]
+        if unknown:
+            raise ValueError(f"Unknown geofences {', '.join(unknown)}")
+        fences = {name: configured[name] for name in request.geofences}
+
+    status, latitudes, longitudes, radii = locate(request.ip_addresses)
+    located = status == 200
+    result = {
+        "ip_addresses": request.ip_addresses,
+        "status": status.tolist(),
+        "latitude": _column(latitudes),
+        "longitude": _column(longitudes),
+        "accuracy_radius_km": _column(np.where(located, radii, np.nan)),
+    }
+
+    if request.latitudes is not None:
+        distance = distance_km(
+            latitudes,
+            longitudes,
+            np.array(request.latitudes),
+            np.array(request.longitudes),
+        )
+        nearest = np.maximum(distance - radii, 0)
+        farthest = distance + radii
+        result["distance_km"] = _column(np.round(distance, 1))
+        result["min_distance_km"] = _column(np.round(nearest, 1))
+        result["max_distance_km"] = _column(np.round(farthest, 1))
+        if request.max_distance_km is not None:
+            inside = farthest <= request.max_distance_km
+            outside = nearest > request.max_distance_km
+            result["within"] = verdicts(inside, located & (inside | outside))
+
+    if fences:
+        result["geofences"] = {
+            name: verdicts(*fence.classify(latitudes, longitudes, radii))
+            for name, fence in fences.items()
+        }
+    return result
@@ -0,0 +1,42 @@
+import hashlib
+import ipaddress
+
+
+def _digest(ip_address, fields):
+    return hashlib.blake2b(
+        f"{ip_address}|{fields or ''}".encode(), digest_size=8
+    ).hexdigest()
+
+
+def entity_tag(ip_address, network, build_epoch, fields=None):
+    """
+    Strong ETag of a lookup response, made of the database build epoch, the
+    network block the response holds for and a digest of the address and
+    selected fields
+    """
+
+    return f'"{build_epoch}-{network}-{_digest(ip_address, fields)}"'
+
+
+def matching_tag(if_none_match, ip_address, build_epoch, fields=None):
+    """
+    Return the tag of an If-None-Match header that is still current for the
+    address, or None. A tag stays current while the build epoch is unchanged,
+    so no lookup is needed to tell.
+    """
+
+    for tag in if_none_match.split(","):
+        # If-None-Match compares tags weakly
+        tag = tag.strip().removeprefix("W/")
+        if len(tag) < 2 or not (tag.startswith('"') and tag.endswith('"')):
+            continue
+        epoch, _, rest = tag[1:-1].partition("-")
+        network, _, digest = rest.rpartition("-")
+        if epoch != str(build_epoch) or digest != _digest(ip_address, fields):
+            continue
+        try:
+            if ip_address in ipaddress.ip_network(network):
+                return tag
+        except ValueError:
+            continue
+    return None
@@ -0,0 +1,162 @@
+import json
+
+import numpy as np
+
+from .sites import EARTH_RADIUS_KM
+
+KM_PER_DEGREE = np.pi / 180 * EARTH_RADIUS_KM
+# Smallest cosine of a latitude used to widen a margin in longitude, so the
+# margin of a point near a pole covers every longitude instead of dividing by 0
+MIN_COSINE = 1e-6
+# Answers of `verdicts` by code, -1 is undecided
+VERDICTS = (False, True, None)
+
+
+def distance_km(latitudes, longitudes, latitude, longitude):
+    """
+    Great-circle distances in km between arrays of points and one point or an
+    array of as many points, with the haversine formula. Distances from a
+    missing coordinate are NaN.
+    """
+
+    phi1 = np.radians(latitudes)
+    phi2 = np.radians(latitude)
+    a = (
+        np.sin((phi2 - phi1) / 2) ** 2
+        + np.cos(phi1)
+        * np.cos(phi2)
+        * np.sin(np.radians(np.subtract(longitude, longitudes)) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def verdicts(inside, certain):
+    """Combine two boolean arrays into a list of True, False or None where uncertain"""
+
+    codes = np.where(certain, inside.astype(np.int8), -1)
+    return [VERDICTS[code] for code in codes.tolist()]
+
+
+def _ring(coordinates, name):
+    ring = np.asarray(coordinates, dtype=np.float64)
+    if ring.ndim != 2 or ring.shape[0] < 4 or ring.shape[1] < 2:
+        raise ValueError(f"Geofence {name} has a ring of fewer than 4 positions")
+    ring = ring[:, :2]
+    if not np.isfinite(ring).all() or (np.abs(ring) > (180, 90)).any():
+        raise ValueError(f"Geofence {name} has a position out of range")
+    return ring
+
+
+class Geofence:
+    """
+    A region of one or more polygons with holes, given as longitude and
+    latitude positions like GeoJSON.
+
+    Containment uses the even-odd rule on the plane of longitude and latitude,
+    so polygons must not cross the antimeridian. Distances to the boundary are
+    measured on a local equirectangular projection around every point, which
+    is accurate to well under 1% over the few hundred km of an accuracy radius.
+    """
+
+    def __init__(self, name, polygons):
+        self.name = name
+        rings = [_ring(ring, name) for polygon in polygons for ring in polygon]
+        if not rings:
+            raise ValueError(f"Geofence {name} has no polygon")
+        # Every edge as the columns start longitude, start latitude, end
+        # longitude and end latitude. Rings need not repeat their first position.
+        edges = np.concatenate(
+            [np.hstack((ring, np.roll(ring, -1, axis=0))) for ring in rings]
+        )
+        # Without the empty edge from the last position back to a repeated first
+        self.edges = edges[(edges[:, :2] != edges[:, 2:]).any(axis=1)]
+        positions = np.concatenate(rings)
+        self.min_longitude, self.min_latitude = positions.min(axis=0)
+        self.max_longitude, self.max_latitude = positions.max(axis=0)
+
+    def classify(self, latitudes, longitudes, radii):
+        """
+        Whether every point is inside the region, and whether that holds for
+        the whole circle of its radius in km around it, as two boolean arrays
+        """
+
+        count = len(latitudes)
+        inside = np.zeros(count, dtype=bool)
+        certain = np.isfinite(latitudes) & np.isfinite(longitudes)
+
+        # Only points whose circle reaches the bounding box can be inside or
+        # near the boundary, the others are certainly outside
+        margin = radii / KM_PER_DEGREE
+        longitude_margin = margin / np.maximum(
+            np.cos(np.radians(latitudes)), MIN_COSINE
+        )
+        near = certain & (
+            (latitudes + margin >= self.min_latitude)
+            & (latitudes - margin <= self.max_latitude)
+            & (longitudes + longitude_margin >= self.min_longitude)
+            & (longitudes - longitude_margin <= self.max_longitude)
+        )
+        candidates = np.flatnonzero(near)
+        if not len(candidates):
+            return inside, certain
+
+        y = latitudes[candidates]
+        x = longitudes[candidates]
+        scale = np.cos(np.radians(y)) * KM_PER_DEGREE
+        crossings = np.zeros(len(candidates), dtype=bool)
+        boundary = np.full(len(candidates), np.inf)
+        # One pass over the edges, each vectorized over the points
+        for x1, y1, x2, y2 in self.edges.tolist():
+            if y1 != y2:
+                # A ray from the point towards growing longitudes crosses the edge
+                spans = (y1 > y) != (y2 > y)
+                crossings ^= spans & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+            # Distance to the edge in km, with the point at the origin
+            ax = (x1 - x) * scale
+            ay = (y1 - y) * KM_PER_DEGREE
+            bx = (x2 - x) * scale
+            by = (y2 - y) * KM_PER_DEGREE
+            dx, dy = bx - ax, by - ay
+            t = np.clip(-(ax * dx + ay * dy) / (dx * dx + dy * dy), 0, 1)
+            np.minimum(boundary, np.hypot(ax + t * dx, ay + t * dy), out=boundary)
+
+        inside[candidates] = crossings
+        certain[candidates] = boundary > radii[candidates]
+        return inside, certain
+
+
+def load_geofences(path):
+    """
+    Read the geofences of a GeoJSON FeatureCollection of Polygon and
+    MultiPolygon features, by the `id` of every feature or its `id` property,
+    raising ValueError for a malformed one
+    """
+
+    with open(path, "rb") as file:
+        collection = json.load(file)
+    if not isinstance(collection, dict) or (
+        collection.get("type") != "FeatureCollection"
+    ):
+        raise ValueError(f"{path} must hold a GeoJSON FeatureCollection")
+    geofences = {}
+    for position, feature in enumerate(collection.get("features", ())):
+        if not isinstance(feature, dict):
+            raise ValueError(f"Feature {position} of {path} is not an object")
+        name = feature.get("id", (feature.get("properties") or {}).get("id"))
+        if name is None:
+            raise ValueError(f"Feature {position} of {path} has no id")
+        name = str(name)
+        if name in geofences:
+            raise ValueError(f"Geofence {name} of {path} is listed twice")
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry.get("coordinates")]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry.get("coordinates")
+        else:
+            raise ValueError(f"Geofence {name} of {path} is not a Polygon")
+        try:
+            geofences[name] = Geofence(name, polygons or ())
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f"{exc} in {path}") from exc
+    return geofences
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+import time
+
+from fastapi.responses import Response
+from geoip2.errors import AddressNotFoundError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _encoded(status_code, content):
+    # One response object is sent to every probe until the next check
+    return Response(
+        content=json.dumps(content, separators=(",", ":")).encode(),
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+ALIVE = _encoded(200, {"status": "alive"})
+# Answer of the original /healthz/ endpoint, kept for existing probes
+OK = _encoded(200, {"status": "ok"})
+STARTING = _encoded(503, {"status": "starting"})
+
+
+class Readiness:
+    """
+    Whether the databases are open and fresh, checked in the background.
+
+    Probes are answered with the pre-encoded response of the last check, so
+    they never touch the databases themselves. A `max_age` in seconds turns a
+    build older than that into a `stale`, not ready, worker. 0 disables it.
+
+    `health_response` answers the original /healthz/ probe: `starting` until
+    the first check, then `ok`, or an `error` with a 500 status while the
+    check fails.
+    """
+
+    def __init__(self, databases, address, max_age=0):
+        self.databases = databases
+        self.address = address
+        self.max_age = max_age
+        self.response = STARTING
+        self.health_response = STARTING
+
+    def reset(self):
+        self.response = STARTING
+        self.health_response = STARTING
+
+    def check(self):
+        """Look up `address` once and return the readiness response"""
+
+        with self.databases.acquire() as readers:
+            try:
+                readers.lookup(self.address)
+            except AddressNotFoundError:
+                pass
+            build_epoch = readers.build_epoch
+
+        now = time.time()
+        age = now - build_epoch
+        stale = self.max_age > 0 and age > self.max_age
+        return _encoded(
+            503 if stale else 200,
+            {
+                "status": "stale" if stale else "ready",
+                "build_epoch": build_epoch,
+                "age": round(age),
+                "loaded_at": self.databases.loaded_at,
+                "checked_at": now,
+            },
+        )
+
+    async def run(self, warm_up, interval):
+        """Warm up the databases, then check them every `interval` seconds"""
+
+        while True:
+            try:
+                if not self.databases.is_open:
+                    await warm_up()
+                self.response = self.check()
+                self.health_response = OK
+            except Exception as exc:
+                logger.exception("Readiness check failed")
+                error = {"status": "error", "message": str(exc)}
+                self.response = _encoded(503, error)
+                self.health_response = _encoded(500, error)
+            await asyncio.sleep(interval)
+
+
+class EventLoopLag:
+    """
+    How late the event loop of this worker runs its callbacks, measured by a
+    task that sleeps for `interval` seconds and records how much longer the
+    sleep took.
+
+    A sleep that is overdue already counts as lag before it wakes up, so the
+    requests that queued up while the loop was blocked see it at once.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lag = 0.0
+        self._due = None
+
+    def current(self):
+        """The lag in seconds, 0 until the monitor runs"""
+
+        if self._due is None:
+            return 0.0
+        return max(self.lag, time.perf_counter() - self._due)
+
+    async def run(self):
+        try:
+            while True:
+                self._due = time.perf_counter() + self.interval
+                await asyncio.sleep(self.interval)
+                self.lag = max(time.perf_counter() - self._due, 0.0)
+                metrics.EVENT_LOOP_LAG.observe(None, self.lag)
+        finally:
+            # Not measured once stopped, rather than ever more overdue
+            self._due = None
+            self.lag = 0.0
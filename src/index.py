@@ -0,0 +1,282 @@
+import ipaddress
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from bisect import bisect_right
+
+from maxminddb.reader import Metadata
+
+from .databases import ReaderSet, address_not_found
+from .mmdb import TreeWalker, merge_partitions
+
+MAGIC = b"GEOIDX01"
+HEADER = struct.Struct("<8sI")
+ENTRY = struct.Struct("<IIBB")
+OFFSET = struct.Struct("<Q")
+START_SIZE = 16
+NO_RECORD = 0xFFFFFFFF
+
+
+def _en_names(record):
+    names = record.get("names", {})
+    return {"en": names["en"]} if "en" in names else {}
+
+
+def prune_city(record):
+    """Keep only the City fields `GeoLocation` is built from"""
+
+    pruned = {}
+    for key in ("continent", "country", "city"):
+        if key in record:
+            pruned[key] = {
+                field: value
+                for field, value in record[key].items()
+                if field in ("code", "geoname_id", "iso_code", "is_in_european_union")
+            }
+            pruned[key]["names"] = _en_names(record[key])
+    for key in ("location", "postal"):
+        if key in record:
+            pruned[key] = dict(record[key])
+    return pruned
+
+
+def prune_asn(record):
+    return record
+
+
+class _RecordPool:
+    """Records deduplicated by their data section pointer, encoded as JSON"""
+
+    def __init__(self, walker, prune):
+        self.walker = walker
+        self.prune = prune
+        self.indexes = {}
+        self.offsets = [0]
+        self.blob = bytearray()
+
+    def index(self, pointer):
+        if pointer is None:
+            return NO_RECORD
+        index = self.indexes.get(pointer)
+        if index is None:
+            record = self.prune(self.walker.record(pointer))
+            self.blob += json.dumps(record, separators=(",", ":")).encode()
+            self.offsets.append(len(self.blob))
+            index = self.indexes[pointer] = len(self.offsets) - 2
+        return index
+
+    def write(self, file):
+        for offset in self.offsets:
+            file.write(OFFSET.pack(offset))
+        file.write(self.blob)
+
+
+def build_index(city_path, asn_path, index_path):
+    """
+    Compile the City and ASN databases into one sorted table of address ranges.
+
+    Each range points into deduplicated pools of City and ASN records, so one
+    binary search answers both lookups. The file is written next to
+    `index_path` and renamed into place, so a watching server never sees it
+    half written. Returns the number of ranges.
+    """
+
+    with TreeWalker(city_path) as city, TreeWalker(asn_path) as asn:
+        if city.bits != asn.bits:
+            raise ValueError("The City and ASN databases must have the same IP version")
+
+        city_pool = _RecordPool(city, prune_city)
+        asn_pool = _RecordPool(asn, prune_asn)
+        count = 0
+        with tempfile.TemporaryFile() as starts, tempfile.TemporaryFile() as entries:
+            merged = merge_partitions(city.networks(), asn.networks(), city.bits)
+            for start, (_, city_prefix, city_pointer), (_, asn_prefix, asn_pointer) in merged:
+                starts.write(start.to_bytes(START_SIZE, "big"))
+                entries.write(
+                    ENTRY.pack(
+                        city_pool.index(city_pointer),
+                        asn_pool.index(asn_pointer),
+                        city_prefix,
+                        asn_prefix,
+                    )
+                )
+                count += 1
+
+            if city.aliases != asn.aliases:
+                raise ValueError("The City and ASN databases alias different networks")
+
+            layout = {
+                "bits": city.bits,
+                "aliases": city.aliases,
+                "count": count,
+                "city_records": len(city_pool.offsets) - 1,
+                "asn_records": len(asn_pool.offsets) - 1,
+                "city_blob_size": len(city_pool.blob),
+                "asn_blob_size": len(asn_pool.blob),
+                "metadata": {"city": vars(city.metadata), "asn": vars(asn.metadata)},
+            }
+            header = json.dumps(layout).encode()
+
+            directory = os.path.dirname(os.path.abspath(index_path))
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+                file.write(HEADER.pack(MAGIC, len(header)))
+                file.write(header)
+                for section in (starts, entries):
+                    section.seek(0)
+                    shutil.copyfileobj(section, file)
+                city_pool.write(file)
+                asn_pool.write(file)
+            os.replace(file.name, index_path)
+
+    return count
+
+
+class _Starts:
+    """Sequence view of the range starts, compared as big-endian bytes"""
+
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        offset = self.offset + index * START_SIZE
+        return self.buffer[offset : offset + START_SIZE]
+
+
+class CompiledIndex:
+    """Memory-mapped lookups in a file written by `build_index`"""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size = HEADER.unpack_from(self._buffer)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a compiled geolocation index")
+        layout = self.layout = json.loads(
+            self._buffer[HEADER.size : HEADER.size + header_size]
+        )
+
+        self.bits = layout["bits"]
+        self.count = layout["count"]
+        # IPv6 networks the trees alias to the IPv4 subtree, where the address
+        # bits following the network are looked up as an IPv4 address
+        self.aliases = [
+            (ipaddress.IPv6Network((start, prefix_len)), prefix_len)
+            for start, prefix_len in layout["aliases"]
+        ]
+        self.metadata = {
+            name: Metadata(**metadata) for name, metadata in layout["metadata"].items()
+        }
+        offset = self.starts_offset = HEADER.size + header_size
+        self._starts = _Starts(self._buffer, offset, self.count)
+        offset += self.count * START_SIZE
+        self._entries = self.entries_offset = offset
+        offset += self.count * ENTRY.size
+        self._city_offsets = offset
+        offset += (layout["city_records"] + 1) * OFFSET.size
+        self._city_blob = offset
+        offset += layout["city_blob_size"]
+        self._asn_offsets = offset
+        offset += (layout["asn_records"] + 1) * OFFSET.size
+        self._asn_blob = offset
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
+
+    def pool(self, name):
+        """Decode every record of the "city" or "asn" pool, in pool order"""
+
+        offsets = getattr(self, f"_{name}_offsets")
+        blob = getattr(self, f"_{name}_blob")
+        return [
+            self._record(offsets, blob, index)
+            for index in range(self.layout[f"{name}_records"])
+        ]
+
+    def _key(self, ip_address):
+        """Map an address to its position in the tree and the prefix length adjustment"""
+
+        if ip_address.version == 4:
+            return int(ip_address), -96 if self.bits == 128 else 0
+        if self.bits == 32:
+            raise ValueError(
+                f"Error looking up {ip_address}. You attempted to look up an IPv6 "
+                "address in an IPv4-only database."
+            )
+        for network, prefix_len in self.aliases:
+            if ip_address in network:
+                ipv4 = (int(ip_address) >> (96 - prefix_len)) & 0xFFFFFFFF
+                return ipv4, prefix_len - 96
+        return int(ip_address), 0
+
+    def _record(self, offsets, blob, index):
+        if index == NO_RECORD:
+            return None
+        start, end = struct.unpack_from("<QQ", self._buffer, offsets + index * OFFSET.size)
+        return json.loads(self._buffer[blob + start : blob + end])
+
+    def get(self, ip_address):
+        """
+        Return `(city_record, city_prefix_len, asn_record, asn_prefix_len)` for
+        an address, with one binary search. Missing records are None.
+        """
+
+        ip_address = ipaddress.ip_address(ip_address)
+        key, adjust = self._key(ip_address)
+        position = bisect_right(self._starts, key.to_bytes(START_SIZE, "big")) - 1
+        city_index, asn_index, city_prefix, asn_prefix = ENTRY.unpack_from(
+            self._buffer, self._entries + position * ENTRY.size
+        )
+        return (
+            self._record(self._city_offsets, self._city_blob, city_index),
+            max(city_prefix + adjust, 0),
+            self._record(self._asn_offsets, self._asn_blob, asn_index),
+            max(asn_prefix + adjust, 0),
+        )
+
+
+class IndexReaderSet(ReaderSet):
+    """City and ASN records read from a compiled index instead of the MMDB files"""
+
+    def __init__(self, index_path):
+        super().__init__()
+        self.index = CompiledIndex(index_path)
+
+    def records(self, ip_address):
+        city, city_prefix_len, asn, asn_prefix_len = self.index.get(ip_address)
+        if city is None:
+            raise address_not_found(ip_address, city_prefix_len, "city")
+        if asn is None:
+            raise address_not_found(ip_address, asn_prefix_len, "asn")
+        return (city, city_prefix_len), (asn, asn_prefix_len)
+
+    def city_record(self, ip_address):
+        city, city_prefix_len, _, _ = self.index.get(ip_address)
+        if city is None:
+            raise address_not_found(ip_address, city_prefix_len, "city")
+        return city, city_prefix_len
+
+    def asn_record(self, ip_address):
+        _, _, asn, asn_prefix_len = self.index.get(ip_address)
+        if asn is None:
+            raise address_not_found(ip_address, asn_prefix_len, "asn")
+        return asn, asn_prefix_len
+
+    def metadata(self):
+        return self.index.metadata
+
+    def close(self):
+        self.index.close()
@@ -1,12 +1,212 @@
-from fastapi import FastAPI, Request
+import asyncio
+import ipaddress
+import json
+import logging
+import secrets
+import time
+from typing import List, Optional
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+)
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from geoip2.errors import AddressNotFoundError
+from starlette.datastructures import Headers
 
 from parse_env import getenv
 
-from . import models
+from . import aggregate, binary, distances, etags, health, metrics, models, sites
+from .databases import duplicate_files
+
+logger = logging.getLogger(__name__)
+
+ADMIN_TOKEN = getenv("GEOLOCATION_ADMIN_TOKEN", "")
+CACHE_CONTROL = getenv("GEOLOCATION_CACHE_CONTROL", "public, max-age=3600")
+WEBSOCKET_MAX_IN_FLIGHT = int(getenv("GEOLOCATION_WEBSOCKET_MAX_IN_FLIGHT", "64"))
+READINESS_INTERVAL = float(getenv("GEOLOCATION_READINESS_INTERVAL", "5"))
+MAX_DATABASE_AGE = float(getenv("GEOLOCATION_MAX_DATABASE_AGE", "0"))
+MAX_IN_FLIGHT = int(getenv("GEOLOCATION_MAX_IN_FLIGHT", "0"))
+MAX_EVENT_LOOP_LAG = float(getenv("GEOLOCATION_MAX_EVENT_LOOP_LAG", "0"))
+EVENT_LOOP_LAG_INTERVAL = float(getenv("GEOLOCATION_EVENT_LOOP_LAG_INTERVAL", "0.1"))
+RETRY_AFTER = int(getenv("GEOLOCATION_RETRY_AFTER", "1"))
+# Cheap requests that are admitted however loaded the worker is, so probes do
+# not take an overloaded but healthy worker out of service
+PRIORITY_PATHS = frozenset(("/livez/", "/readyz/", "/healthz/", "/metrics"))
+
+
+class RequestStreamingResponse(StreamingResponse):
+    """
+    Streaming response generated while the request body is being read.
+
+    The iterator consumes the request body itself, so the response must not
+    listen for a client disconnect on the same receive channel.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+class MetricsMiddleware:
+    """
+    Times whole requests and counts failed ones.
+
+    The start time is left in the scope, so endpoints can time the stages
+    before them. Plain ASGI instead of `BaseHTTPMiddleware`, which would cost
+    more than the measurements themselves.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = scope["metrics.started"] = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.STAGE_DURATION.observe("request", time.perf_counter() - started)
+            if status >= 500:
+                metrics.ERRORS.inc("internal")
+            elif status == 422:
+                metrics.ERRORS.inc("invalid")
+
+
+class AdmissionMiddleware:
+    """
+    Sheds requests with a 503 and a `Retry-After` header while the worker is
+    overloaded: with `max_in_flight` requests in progress, or with an event
+    loop running more than `max_lag` seconds behind. 0 disables a limit.
+
+    Requests queued behind a busy worker are answered at once instead of
+    waiting their turn, so latency stays bounded and clients retry while the
+    service scales out. Priority paths and admin requests are always admitted
+    and not counted.
+    """
+
+    def __init__(self, app, lag, max_in_flight=0, max_lag=0, retry_after=1):
+        self.app = app
+        self.lag = lag
+        self.max_in_flight = max_in_flight
+        self.max_lag = max_lag
+        self.in_flight = 0
+        self.response = JSONResponse(
+            status_code=503,
+            content={"detail": "The server is overloaded, retry later"},
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def overloaded(self):
+        """The reason to shed a request now, or None"""
+
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return "in_flight"
+        if self.max_lag and self.lag.current() > self.max_lag:
+            return "lag"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (
+            scope["type"] != "http"
+            or path in PRIORITY_PATHS
+            or path.startswith("/admin/")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        reason = self.overloaded()
+        if reason is not None:
+            metrics.SHED.inc(reason)
+            await self.response(scope, receive, send)
+            return
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+
+class BinaryProtocolMiddleware:
+    """
+    Answers `POST /` and `POST /batch` requests with a `binary.CONTENT_TYPE`
+    body, in the same format, before they reach FastAPI. Neither side parses
+    JSON or validates models. `POST /` takes exactly one address.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_counts = {"/": 1, "/batch": models.BATCH_MAX_SIZE}
+
+    async def __call__(self, scope, receive, send):
+        max_count = self.max_counts.get(scope.get("path"))
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or max_count is None
+            or Headers(scope=scope).get("content-type") != binary.CONTENT_TYPE
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        response = await self.respond(scope, receive, max_count)
+        await response(scope, receive, send)
+
+    async def respond(self, scope, receive, max_count):
+        if not binary.accepts(Headers(scope=scope).get("accept")):
+            detail = f"Binary requests are only answered in {binary.CONTENT_TYPE}"
+            return JSONResponse(status_code=406, content={"detail": detail})
+
+        # Every address takes at most 17 bytes
+        max_size = max_count * 17
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(body) > max_size:
+                return JSONResponse(
+                    status_code=413,
+                    content={"detail": f"At most {max_count} addresses are accepted"},
+                )
+
+        try:
+            addresses = binary.parse_addresses(bytes(body), max_count)
+        except ValueError as exc:
+            return JSONResponse(status_code=422, content={"detail": str(exc)})
+        if max_count > 1:
+            # A whole batch of lookups would stall the event loop
+            content = await asyncio.to_thread(models.lookup_binary, addresses)
+        else:
+            content = models.lookup_binary(addresses)
+        return Response(content=content, media_type=binary.CONTENT_TYPE)
+
 
 app = FastAPI(
     title="Geolocation API",
@@ -14,10 +214,27 @@ app = FastAPI(
     version="0.1.0",
 )
 
+# Added first, so it runs after the host and CORS checks
+app.add_middleware(BinaryProtocolMiddleware)
+
 app.add_middleware(
     TrustedHostMiddleware, allowed_hosts=getenv("FASTAPI_ALLOWED_HOSTS", "*").split(" ")
 )
 
+app.add_middleware(MetricsMiddleware)
+
+event_loop_lag = health.EventLoopLag(EVENT_LOOP_LAG_INTERVAL)
+
+# Outside of everything but CORS, so a shed request costs as little as
+# possible and browsers can still read its 503
+app.add_middleware(
+    AdmissionMiddleware,
+    lag=event_loop_lag,
+    max_in_flight=MAX_IN_FLIGHT,
+    max_lag=MAX_EVENT_LOOP_LAG,
+    retry_after=RETRY_AFTER,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=getenv("FASTAPI_CORS_ORIGINS").split(" "),
@@ -26,15 +243,110 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+readiness = health.Readiness(
+    models.databases, models.WARM_UP_ADDRESS, max_age=MAX_DATABASE_AGE
+)
+
 
 @app.exception_handler(AddressNotFoundError)
 async def address_not_found_error(request: Request, exc: AddressNotFoundError):
+    return not_found_response(exc.ip_address)
+
+
+def not_found_response(ip_address):
+    metrics.NOT_FOUND.inc()
     return JSONResponse(
         status_code=404,
-        content={
-            "message": f"IP address {exc.ip_address} is not present in the database"
-        },
+        content={"message": models.not_found_message(ip_address)},
+    )
+
+
+@app.on_event("startup")
+async def start_readiness_check():
+    # In the background, so probes are answered with `starting` meanwhile
+    readiness.reset()
+    app.state.readiness_check = asyncio.create_task(
+        readiness.run(models.warm_up, READINESS_INTERVAL)
+    )
+
+
+@app.on_event("startup")
+async def start_database_watch():
+    if models.DB_WATCH_INTERVAL > 0:
+        app.state.database_watch = asyncio.create_task(
+            models.databases.watch(models.DB_WATCH_INTERVAL)
+        )
+        if models.DATABASES:
+            app.state.extra_databases_watch = asyncio.create_task(
+                models.registry.watch(models.DB_WATCH_INTERVAL)
+            )
+
+
+@app.on_event("startup")
+async def start_event_loop_lag():
+    if MAX_EVENT_LOOP_LAG > 0 or metrics.ENABLED:
+        app.state.event_loop_lag = asyncio.create_task(event_loop_lag.run())
+
+
+@app.on_event("startup")
+async def start_network_index():
+    if models.NETWORK_INDEX:
+        app.state.network_index = asyncio.create_task(
+            models.watch_network_index(models.DB_WATCH_INTERVAL or 60)
+        )
+
+
+@app.on_event("startup")
+async def start_file_watches():
+    if models.DB_WATCH_INTERVAL > 0:
+        app.state.sites_watch = asyncio.create_task(
+            sites.sites.watch(models.DB_WATCH_INTERVAL)
+        )
+        app.state.geofences_watch = asyncio.create_task(
+            distances.geofences.watch(models.DB_WATCH_INTERVAL)
+        )
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    tasks = (
+        "readiness_check",
+        "database_watch",
+        "extra_databases_watch",
+        "network_index",
+        "sites_watch",
+        "geofences_watch",
+        "event_loop_lag",
     )
+    for name in tasks:
+        task = getattr(app.state, name, None)
+        if task is not None:
+            task.cancel()
+
+
+async def require_admin(x_admin_token: str = Header(default="")):
+    if not ADMIN_TOKEN or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token is missing or invalid")
+
+
+@app.get("/livez/", summary="Liveness Check", tags=["Health Check"])
+async def liveness_check():
+    """
+    Liveness Check
+
+    Reports that the process is alive and serving requests, without looking at the databases.
+    """
+    return health.ALIVE
+
+
+@app.get("/readyz/", summary="Readiness Check", tags=["Health Check"])
+async def readiness_check():
+    """
+    Readiness Check
+
+    Reports whether the databases are loaded, with their build epoch and age in seconds. Answered from a check run in the background every `GEOLOCATION_READINESS_INTERVAL` seconds, with a 503 status while the worker is `starting`, when the check failed, or when the build is older than `GEOLOCATION_MAX_DATABASE_AGE` seconds.
+    """
+    return readiness.response
 
 
 @app.get("/healthz/", summary="Health Check", tags=["Health Check"])
@@ -42,17 +354,120 @@ async def health_check():
     """
     Health Check
 
-    Performs a health check on the Geolocation API.
+    Reports `ok` while the process is serving requests, `starting` with a 503 status until the databases are opened and warmed up, and an `error` with a 500 status and its `message` while the background check fails. Kept for existing health checks, use `/livez/` and `/readyz/` instead.
+    """
+    # Without a running readiness check, as in tests, the databases are
+    # opened on first use
+    readiness_check = getattr(app.state, "readiness_check", None)
+    if readiness_check is None or readiness_check.done():
+        return health.OK
+    return readiness.health_response
+
+
+@app.get("/metrics", summary="Metrics", tags=["Health Check"])
+async def metrics_exposition():
+    """
+    Metrics
+
+    Per-stage latency histograms and cache, error and not-found counters of all workers, in the Prometheus text format. Only available when `GEOLOCATION_METRICS` is enabled.
+    """
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get(
+    "/admin/databases",
+    summary="Database Status",
+    tags=["Admin"],
+    dependencies=[Depends(require_admin)],
+)
+async def database_status():
     """
+    Database Status
+
+    Reports the build epoch of the active MaxMind Geolite2 databases, the outcome of the last reload, the lookup count and mean lookup time of every database of the registry, the size, hits and misses of every network block cache and the build time and size of the network index. Requires the `X-Admin-Token` header.
+    """
+    index = models.network_index
+    return {
+        **models.databases.status(),
+        "registry": models.registry.status(),
+        "caches": models.cache_stats(),
+        "sites": sites.sites.status(),
+        "geofences": distances.geofences.status(),
+        "network_index": None if index is None else index.stats(),
+    }
+
+
+@app.post(
+    "/admin/reload",
+    summary="Reload Databases",
+    tags=["Admin"],
+    dependencies=[Depends(require_admin)],
+)
+async def reload_databases():
+    """
+    Reload Databases
+
+    Opens and validates the database files in the background and swaps them in once they are ready. Lookups in progress finish on the previous databases. The site list of `/nearest` and the geofences of `/distance` are loaded again too. Requires the `X-Admin-Token` header.
+    """
+    reloaded = await models.databases.reload()
+    for index in (sites.sites, distances.geofences):
+        if index.index is not None:
+            await index.reload()
+    return JSONResponse(
+        status_code=200 if reloaded else 500, content=models.databases.status()
+    )
+
+
+def stream_changes(previous_files, files):
+    # Only imported when changes are requested
+    from .diff import diff_builds
+
     try:
-        models.city_db.city("8.8.8.8")
-        models.asn_db.asn("8.8.8.8")
-        return JSONResponse(content={"status": "ok"})
-    except Exception as e:
-        return JSONResponse(
-            status_code=500,
-            content={"status": "error", "message": str(e)},
+        for change in diff_builds(
+            previous_files["city"], previous_files["asn"], files["city"], files["asn"]
+        ):
+            change["network"] = str(change["network"])
+            yield json.dumps(change) + "\n"
+    finally:
+        for file in (*previous_files.values(), *files.values()):
+            file.close()
+
+
+@app.get(
+    "/admin/changes",
+    summary="Database Changes",
+    tags=["Admin"],
+    dependencies=[Depends(require_admin)],
+)
+async def database_changes():
+    """
+    Database Changes
+
+    Streams the networks whose City or ASN record changed with the last reload as NDJSON, one `{"database", "network", "change", "changed_fields"}` object per line. `change` is `added`, `removed` or `changed`, and `changed_fields` lists the `section.field` paths that differ. Requires the `X-Admin-Token` header.
+    """
+    previous_files = models.databases.previous_files
+    files = models.databases.current.files
+    if previous_files is None or files is None:
+        raise HTTPException(
+            status_code=404, detail="No previous database build to compare with"
         )
+    # Reloads during the stream close or take over the files of both builds
+    return StreamingResponse(
+        stream_changes(duplicate_files(previous_files), duplicate_files(files)),
+        media_type="application/x-ndjson",
+    )
+
+
+def compile_field_plan(fields):
+    if fields is None:
+        return None
+    try:
+        return models.field_plan(fields)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
 
 @app.post(
     "/",
@@ -61,17 +476,454 @@ async def health_check():
     summary="Lookup IP Geolocation",
     tags=["Geolocation"]
 )
-async def ip_lookup(ip: models.IPAddress, request: Request):
+async def ip_lookup(
+    ip: models.IPAddress,
+    request: Request,
+    fields: Optional[str] = Query(
+        default=None, example="country,asn.autonomous_system_number"
+    ),
+):
     """
     Lookup IP Geolocation
 
     Send an empty `POST` body to lookup your IP address or look up any IP address available in MaxMind Geolite2 databases
 
     - **ip_address**: The IP address to lookup (string).
+    - **fields**: Optional comma-separated sections, such as `country`, or section fields, such as `asn.autonomous_system_number`, to return instead of the full response. Each section is looked up in the cheapest configured database that has it, so `country` alone is answered by GeoLite2-Country when it is in `GEOLOCATION_DATABASES`, and a database none of the sections need is not looked up. The `anonymous_ip` and `isp` sections are only available this way.
     """
+    plan = compile_field_plan(fields)
     ip_address = (
         str(ip.ip_address)
         if ip.ip_address
         else (request.headers.get("X-Forwarded-For") or request.client.host)
     )
-    return await models.lookup_ip(ip_address)
+    started = request.scope.get("metrics.started")
+    if started is not None:
+        metrics.STAGE_DURATION.observe("validate", time.perf_counter() - started)
+
+    # Reserved and known missing addresses are answered without a lookup
+    if models.known_missing(ip_address, plan):
+        return not_found_response(ipaddress.ip_address(ip_address))
+
+    if plan is not None:
+        return Response(
+            content=models.lookup_ip_fields(ip_address, plan),
+            media_type="application/json",
+        )
+    if models.FAST_RESPONSE:
+        return Response(
+            content=models.lookup_ip_json(ip_address), media_type="application/json"
+        )
+    result = models.lookup_ip(ip_address)
+    # Encoded here rather than by the response model, so the stage can be
+    # timed and the result is not validated a second time
+    serializing = time.perf_counter()
+    response = JSONResponse(content=jsonable_encoder(result, exclude_none=True))
+    metrics.STAGE_DURATION.observe("serialize", time.perf_counter() - serializing)
+    return response
+
+
+@app.get(
+    "/ip/{address}",
+    response_model=models.GeoLocation,
+    response_model_exclude_none=True,
+    summary="Lookup IP Geolocation (Cacheable)",
+    tags=["Geolocation"],
+)
+async def ip_lookup_cacheable(
+    address: str,
+    request: Request,
+    fields: Optional[str] = Query(
+        default=None, example="country,asn.autonomous_system_number"
+    ),
+):
+    """
+    Lookup IP Geolocation (Cacheable)
+
+    Same response as `POST /` for the address in the path, which CDNs and browsers can cache. Responses carry a `Cache-Control` header set by `GEOLOCATION_CACHE_CONTROL` and an `ETag` that changes with the database build. A request with a current `If-None-Match` tag is answered with `304 Not Modified` without a lookup.
+
+    - **address**: The IP address to lookup.
+    - **fields**: Optional comma-separated sections or section fields to return, as for `POST /`.
+    """
+    plan = compile_field_plan(fields)
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail=f"{address} is not a valid IP address"
+        )
+    started = request.scope.get("metrics.started")
+    if started is not None:
+        metrics.STAGE_DURATION.observe("validate", time.perf_counter() - started)
+
+    if models.known_missing(ip, plan):
+        return not_found_response(ip)
+
+    build_epoch = models.build_epoch(plan)
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tag = etags.matching_tag(if_none_match, ip, build_epoch, fields)
+        if tag is not None:
+            return Response(
+                status_code=304, headers={"ETag": tag, "Cache-Control": CACHE_CONTROL}
+            )
+
+    content, network = models.lookup_ip_document(ip, plan)
+    return Response(
+        content=content,
+        media_type="application/json",
+        headers={
+            "ETag": etags.entity_tag(ip, network, build_epoch, fields),
+            "Cache-Control": CACHE_CONTROL,
+        },
+    )
+
+
+NETWORK_PAGE_SIZE = 1000
+
+
+def stream_networks(index, kind, key, offset):
+    lines = []
+    for network in index.networks(kind, key, offset):
+        lines.append(f"{network}\n")
+        if len(lines) == NETWORK_PAGE_SIZE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def network_list(kind, key, offset, limit, stream):
+    index = models.network_index
+    if index is None:
+        if models.NETWORK_INDEX:
+            raise HTTPException(
+                status_code=503, detail="The network index is being built"
+            )
+        raise HTTPException(status_code=404, detail="The network index is disabled")
+    total = index.count(kind, key)
+    if total is None:
+        raise HTTPException(status_code=404, detail=f"No networks found for {key}")
+
+    if stream:
+        return StreamingResponse(
+            stream_networks(index, kind, key, offset), media_type="text/plain"
+        )
+    networks = index.networks(kind, key, offset, limit)
+    return {
+        kind: key,
+        "build_epoch": index.build_epoch,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "networks": [str(network) for network in networks],
+    }
+
+
+@app.get("/networks/asn/{number}", summary="Networks of an ASN", tags=["Networks"])
+async def asn_networks(
+    number: int,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=NETWORK_PAGE_SIZE, ge=1, le=10 * NETWORK_PAGE_SIZE),
+    stream: bool = False,
+):
+    """
+    Networks of an ASN
+
+    Lists the networks announced by an autonomous system, in address order, with adjacent networks merged. Requires `GEOLOCATION_NETWORK_INDEX`.
+
+    - **offset**, **limit**: The page of networks to return.
+    - **stream**: Stream every network from `offset` on as plain text, one per line, instead of a page.
+    """
+    return network_list("asn", number, offset, limit, stream)
+
+
+@app.get(
+    "/networks/country/{iso_code}", summary="Networks of a Country", tags=["Networks"]
+)
+async def country_networks(
+    iso_code: str,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=NETWORK_PAGE_SIZE, ge=1, le=10 * NETWORK_PAGE_SIZE),
+    stream: bool = False,
+):
+    """
+    Networks of a Country
+
+    Lists the networks located in a country, by ISO code, in address order, with adjacent networks merged. Requires `GEOLOCATION_NETWORK_INDEX`.
+
+    - **offset**, **limit**: The page of networks to return.
+    - **stream**: Stream every network from `offset` on as plain text, one per line, instead of a page.
+    """
+    return network_list("country", iso_code.upper(), offset, limit, stream)
+
+
+def batch_content(ip_addresses):
+    results = models.lookup_batch(ip_addresses)
+    # Serialize directly instead of having every result re-validated against
+    # the response model, which dominates the cost of large batches
+    content = ",".join(result.json(exclude_none=True) for result in results)
+    return f"[{content}]"
+
+
+@app.post(
+    "/batch",
+    response_model=List[models.BatchResult],
+    response_model_exclude_none=True,
+    summary="Batch Lookup IP Geolocation",
+    tags=["Geolocation"]
+)
+async def batch_ip_lookup(batch: models.BatchRequest):
+    """
+    Batch Lookup IP Geolocation
+
+    Look up many IP addresses in one request. Results are returned in the same order as the request and repeated addresses are only looked up once.
+
+    Addresses that are invalid or not present in the MaxMind Geolite2 databases do not fail the batch, they are reported with their own `status` and `message`.
+
+    - **ip_addresses**: The IP addresses to lookup (list of strings).
+    """
+    # Up to `GEOLOCATION_BATCH_MAX_SIZE` lookups would stall the event loop
+    content = await asyncio.to_thread(batch_content, batch.ip_addresses)
+    return Response(content=content, media_type="application/json")
+
+
+@app.post(
+    "/stream",
+    response_class=RequestStreamingResponse,
+    summary="Stream Lookup IP Geolocation",
+    tags=["Geolocation"]
+)
+async def stream_ip_lookup(request: Request):
+    """
+    Stream Lookup IP Geolocation
+
+    Enrich a newline-delimited request body of IP addresses, or NDJSON records with an `ip` field, and stream back one NDJSON record per line as it resolves.
+
+    Each output record is the input record with a `geolocation` field, matching the response of `POST /`, or an `error` field if the address is invalid or not present in the MaxMind Geolite2 databases.
+    """
+    return RequestStreamingResponse(
+        models.enrich_stream(request.stream()), media_type="application/x-ndjson"
+    )
+
+
+def compile_aggregation(dimensions):
+    try:
+        return aggregate.aggregation(dimensions)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+
+@app.post(
+    "/aggregate",
+    summary="Aggregate IP Geolocation",
+    tags=["Geolocation"]
+)
+async def aggregate_ip_lookup(request: models.AggregateRequest):
+    """
+    Aggregate IP Geolocation
+
+    Count many IP addresses by country, continent or ASN instead of returning a result for each. Every address is counted as it is looked up, in a single pass, and addresses of a network block already seen are not looked up again.
+
+    The response has the `total`, `found`, `invalid` and `not_found` counts and, for every dimension, the number of distinct `keys`, their `counts` and the `unknown` count of addresses without a key.
+
+    - **ip_addresses**: The IP addresses to count (list of strings), up to `GEOLOCATION_AGGREGATE_MAX_SIZE`.
+    - **by**: The dimensions to count by, any of `country`, `continent` and `asn`. Defaults to `country`.
+    - **top**: Only return the `top` most common keys of every dimension, as a list, with the count of the `others`.
+    """
+    aggregation = compile_aggregation(request.by)
+    # Up to `GEOLOCATION_AGGREGATE_MAX_SIZE` lookups would stall the event loop
+    await asyncio.to_thread(aggregation.update, request.ip_addresses)
+    return JSONResponse(content=aggregation.result(request.top))
+
+
+@app.post(
+    "/aggregate/stream",
+    summary="Aggregate Streamed IP Geolocation",
+    tags=["Geolocation"]
+)
+async def aggregate_stream_lookup(
+    request: Request,
+    by: List[str] = Query(default=["country"]),
+    top: Optional[int] = Query(default=None, ge=1),
+):
+    """
+    Aggregate Streamed IP Geolocation
+
+    Count a newline-delimited request body of IP addresses of any size, like `POST /aggregate`. Addresses are counted while the body is read, so the list is never held in memory.
+
+    - **by**: The dimensions to count by, repeated for more than one, such as `?by=country&by=asn`.
+    - **top**: Only return the `top` most common keys of every dimension.
+    """
+    aggregation = compile_aggregation(by)
+    await aggregate.aggregate_stream(request.stream(), aggregation)
+    return JSONResponse(content=aggregation.result(top))
+
+
+def require_index(index, name):
+    try:
+        index.current()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"No {name} are configured")
+    except ValueError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
+def require_sites():
+    require_index(sites.sites, "sites")
+
+
+@app.get(
+    "/nearest/{address}",
+    summary="Nearest Sites",
+    tags=["Sites"],
+    dependencies=[Depends(require_sites)],
+)
+async def nearest_sites(
+    address: str, k: int = Query(default=1, ge=1, le=models.NEAREST_MAX_SITES)
+):
+    """
+    Nearest Sites
+
+    Find the `k` sites of `GEOLOCATION_SITES_FILE` nearest to the location of an IP address, nearest first, with their great-circle `distance_km`. Addresses of a network block already seen are answered without a lookup. An address without a location has an empty list of sites.
+
+    - **address**: The IP address to locate.
+    - **k**: The number of sites to return, up to `GEOLOCATION_NEAREST_MAX_SITES`.
+    """
+    status, result, message = sites.try_nearest_sites(address, k)
+    if result is None:
+        return JSONResponse(status_code=status, content={"message": message})
+    return JSONResponse(content=result)
+
+
+def nearest_content(ip_addresses, k):
+    results = []
+    for ip_address in ip_addresses:
+        status, result, message = sites.try_nearest_sites(ip_address, k)
+        item = {"ip_address": ip_address, "status": status}
+        if status == 422:
+            metrics.ERRORS.inc("invalid")
+        if result is None:
+            item["message"] = message
+        else:
+            item["result"] = result
+        results.append(item)
+    return results
+
+
+@app.post(
+    "/nearest",
+    summary="Batch Nearest Sites",
+    tags=["Sites"],
+    dependencies=[Depends(require_sites)],
+)
+async def batch_nearest_sites(nearest: models.NearestRequest):
+    """
+    Batch Nearest Sites
+
+    Find the `k` nearest sites of many IP addresses in one request. Results are returned in the same order as the request, each with its own `status` and the `result` of `GET /nearest/{address}` or a `message`.
+
+    - **ip_addresses**: The IP addresses to locate (list of strings).
+    - **k**: The number of sites to return for every address.
+    """
+    # Up to `GEOLOCATION_BATCH_MAX_SIZE` lookups would stall the event loop
+    results = await asyncio.to_thread(
+        nearest_content, nearest.ip_addresses, nearest.k
+    )
+    return JSONResponse(content=results)
+
+
+def compute_distances(request):
+    if request.geofences:
+        require_index(distances.geofences, "geofences")
+    return distances.distances(request)
+
+
+@app.post(
+    "/distance",
+    summary="Batch Distances and Geofences",
+    tags=["Sites"]
+)
+async def batch_distances(request: models.DistanceRequest):
+    """
+    Batch Distances and Geofences
+
+    Locate many IP addresses at once and measure their great-circle distance to the given points, or check whether they are inside the geofences of `GEOLOCATION_GEOFENCES_FILE`, a GeoJSON FeatureCollection of polygons. The whole batch is computed with NumPy arrays instead of one address at a time.
+
+    The response holds one list per column, in the order of the request: the `status` of every address, its `latitude`, `longitude` and `accuracy_radius_km`, and with points, its `distance_km` and the `min_distance_km` and `max_distance_km` the true location can be at given the accuracy radius. `within` and every list of `geofences` hold `true` or `false` only when that holds anywhere within the accuracy radius, and `null` when it is uncertain or the address has no location.
+
+    - **ip_addresses**: The IP addresses to locate (list of strings), up to `GEOLOCATION_DISTANCE_MAX_SIZE`.
+    - **latitudes**, **longitudes**: The points to measure the distance to, one for every address or a single one for all of them.
+    - **max_distance_km**: Check whether every address is `within` this distance of its point.
+    - **geofences**: The ids of the geofences to check.
+    """
+    try:
+        # A whole batch, and loading the geofences or the range index on first
+        # use, would stall the event loop
+        result = await asyncio.to_thread(compute_distances, request)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+    return JSONResponse(content=result)
+
+
+async def close_websocket(websocket):
+    try:
+        await websocket.close(code=1011)
+    except Exception:
+        # The connection is already gone
+        pass
+
+
+@app.websocket("/ws")
+async def websocket_lookup(websocket: WebSocket):
+    """
+    Lookup IP Geolocation over a WebSocket
+
+    Every message is a JSON object with an `ip` field and an optional `id`
+    chosen by the client. Each is answered with `{"id", "status", "result"}`,
+    the result matching `POST /`, or `{"id", "status", "message"}`.
+
+    At most `GEOLOCATION_WEBSOCKET_MAX_IN_FLIGHT` messages of a connection are
+    answered and not yet sent. Past that, no more messages are read until the
+    client reads its replies, so a slow client is held back by the socket
+    instead of growing a queue on the server.
+    """
+    await websocket.accept()
+    in_flight = asyncio.Semaphore(WEBSOCKET_MAX_IN_FLIGHT)
+    replies = asyncio.Queue()
+
+    async def send_replies():
+        while True:
+            reply = await replies.get()
+            await websocket.send_text(reply)
+            in_flight.release()
+
+    sender = asyncio.create_task(send_replies())
+    try:
+        # The sender only ends when sending a reply failed, its replies would
+        # never be released
+        while not sender.done():
+            if in_flight.locked():
+                acquire = asyncio.ensure_future(in_flight.acquire())
+                await asyncio.wait(
+                    (acquire, sender), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not acquire.done():
+                    acquire.cancel()
+                    break
+            else:
+                await in_flight.acquire()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            data = message.get("text") or message.get("bytes") or ""
+            replies.put_nowait(models.lookup_message(data))
+    finally:
+        sender.cancel()
+        try:
+            await sender
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("Sending a WebSocket reply failed")
+            await close_websocket(websocket)
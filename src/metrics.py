@@ -0,0 +1,269 @@
+import atexit
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+
+from parse_env import getenv
+
+ENABLED = getenv("GEOLOCATION_METRICS", "false").lower() == "true"
+_RUN_PID = os.getpid()
+
+
+def _remove_run_directory():
+    # Workers forked from the process that started the run exit before it
+    if os.getpid() == _RUN_PID:
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+
+# Without a configured directory every run gets its own, named after the
+# process that imports this module first: the gunicorn master, whose workers
+# inherit it, or a single process server. It is removed when the run ends, so
+# a run never sums the files left behind by a previous one.
+if getenv("GEOLOCATION_METRICS_DIR", ""):
+    METRICS_DIR = Path(getenv("GEOLOCATION_METRICS_DIR"))
+else:
+    METRICS_DIR = Path(tempfile.gettempdir()).joinpath(
+        f"geolocation-metrics-{_RUN_PID}"
+    )
+    atexit.register(_remove_run_directory)
+
+# Upper bounds in seconds, lookups take tens of microseconds
+BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+)
+
+# Upper bounds in seconds of event loop lag, shed from a few hundred ms on
+LAG_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+_metrics = []
+_size = 0
+
+
+class Registry:
+    """
+    Metric values of this process, kept in a memory-mapped file per process.
+
+    Every gunicorn worker adds to its own file in `directory`, so only the
+    threads of one worker need a lock, and `collect` sums the files of all
+    workers. The values of
+    workers that exited are kept, so counters never go backwards.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._values = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        # A forked worker must not write to the file of its parent
+        self._values = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory.joinpath(f"metrics_{os.getpid()}.bin")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _size * 8:
+                os.ftruncate(fd, _size * 8)
+            buffer = mmap.mmap(fd, _size * 8)
+        finally:
+            os.close(fd)
+        self._values = memoryview(buffer).cast("d")
+        return self._values
+
+    def add(self, slot, amount):
+        with self._lock:
+            values = self._values
+            if values is None:
+                values = self._open()
+            values[slot] += amount
+
+    def collect(self):
+        """Sum the values written by every process"""
+
+        totals = [0.0] * _size
+        for path in self.directory.glob("metrics_*.bin"):
+            values = array("d")
+            with open(path, "rb") as file:
+                data = file.read(_size * 8)
+            values.frombytes(data[: len(data) // 8 * 8])
+            for slot, value in enumerate(values):
+                totals[slot] += value
+        return totals
+
+    def reset(self):
+        """Remove the files of previous runs, before any worker is started"""
+
+        for path in self.directory.glob("metrics_*.bin"):
+            path.unlink()
+        self._values = None
+
+
+registry = Registry(METRICS_DIR)
+
+
+class _Metric:
+    type = None
+    slots_per_value = 1
+
+    def __init__(self, name, documentation, label=None, values=(None,)):
+        global _size
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._offsets = {}
+        for value in values:
+            self._offsets[value] = _size
+            _size += self.slots_per_value
+        _metrics.append(self)
+
+    def _labels(self, value, **extra):
+        labels = dict(extra)
+        if self.label is not None:
+            labels = {self.label: value, **labels}
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{item}"' for key, item in labels.items()) + "}"
+
+    def render(self, values):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, value=None, amount=1.0):
+        if ENABLED:
+            registry.add(self._offsets[value], amount)
+
+    def render(self, values):
+        for value, offset in self._offsets.items():
+            yield f"{self.name}{self._labels(value)} {values[offset]!r}"
+
+
+class Histogram(_Metric):
+    """
+    Counts per bucket of `buckets`, upper bounds in seconds, with an overflow
+    bucket, followed by the sum of observations
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self, name, documentation, label=None, values=(None,), buckets=BUCKETS
+    ):
+        self.buckets = tuple(buckets)
+        self.slots_per_value = len(self.buckets) + 2
+        super().__init__(name, documentation, label, values)
+
+    def observe(self, value, seconds):
+        if ENABLED:
+            offset = self._offsets[value]
+            registry.add(offset + bisect_left(self.buckets, seconds), 1.0)
+            registry.add(offset + len(self.buckets) + 1, seconds)
+
+    def render(self, values):
+        for value, offset in self._offsets.items():
+            cumulative = 0.0
+            for position, bound in enumerate(self.buckets + ("+Inf",)):
+                cumulative += values[offset + position]
+                labels = self._labels(value, le=bound)
+                yield f"{self.name}_bucket{labels} {cumulative!r}"
+            total = values[offset + len(self.buckets) + 1]
+            yield f"{self.name}_sum{self._labels(value)} {total!r}"
+            yield f"{self.name}_count{self._labels(value)} {cumulative!r}"
+
+
+STAGE_DURATION = Histogram(
+    "geolocation_stage_duration_seconds",
+    "Time spent in each stage of a lookup request",
+    label="stage",
+    values=("request", "validate", "lookup", "build", "serialize"),
+)
+DATABASE_DURATION = Histogram(
+    "geolocation_database_lookup_duration_seconds",
+    "Time spent looking up an address in each database of the registry",
+    label="database",
+    values=("city", "asn", "country", "anonymous_ip", "isp"),
+)
+CACHE_HITS = Counter(
+    "geolocation_cache_hits_total",
+    "Lookups answered from a network block cache",
+    label="cache",
+    values=("result", "json", "binary"),
+)
+CACHE_MISSES = Counter(
+    "geolocation_cache_misses_total",
+    "Lookups not found in a network block cache",
+    label="cache",
+    values=("result", "json", "binary"),
+)
+NOT_FOUND = Counter(
+    "geolocation_not_found_total",
+    "Addresses not present in the databases",
+)
+ERRORS = Counter(
+    "geolocation_errors_total",
+    "Invalid addresses and requests, and server errors",
+    label="type",
+    values=("invalid", "internal"),
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "geolocation_event_loop_lag_seconds",
+    "How much later than scheduled the event loop of a worker woke up",
+    buckets=LAG_BUCKETS,
+)
+SHED = Counter(
+    "geolocation_shed_total",
+    "Requests rejected with a 503 while the worker was overloaded",
+    label="reason",
+    values=("in_flight", "lag"),
+)
+
+
+def render():
+    """Render the metrics of every process in the Prometheus text format"""
+
+    values = registry.collect()
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render(values))
+    return "\n".join(lines) + "\n"
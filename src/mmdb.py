@@ -0,0 +1,156 @@
+import ipaddress
+import mmap
+
+from maxminddb.decoder import Decoder
+from maxminddb.errors import InvalidDatabaseError
+from maxminddb.reader import Metadata
+
+DATA_SECTION_SEPARATOR_SIZE = 16
+METADATA_START_MARKER = b"\xab\xcd\xefMaxMind.com"
+METADATA_MAX_SIZE = 128 * 1024
+IPV4_MAX = 2**32 - 1
+
+
+def tree_network(bits, start, prefix_len):
+    """Convert a network of a `bits` wide search tree to an IPv4 or IPv6 network object"""
+
+    if bits == 128 and start <= IPV4_MAX and prefix_len >= 96:
+        return ipaddress.IPv4Network((start, prefix_len - 96))
+    if bits == 32:
+        return ipaddress.IPv4Network((start, prefix_len))
+    return ipaddress.IPv6Network((start, prefix_len))
+
+
+class TreeWalker:
+    """
+    Walks the search tree of a MaxMind DB file once, in address order.
+
+    Every address belongs to exactly one yielded network, so the networks of a
+    database form a contiguous partition of its address space. Records are
+    referenced by their data section pointer, which is the same for every
+    network sharing a record.
+
+    `database` is a path, or an open binary file, which is left open. A file
+    still reads the build it was opened on after the path was replaced.
+    """
+
+    def __init__(self, database):
+        if hasattr(database, "fileno"):
+            self._file = None
+            fileno = database.fileno()
+        else:
+            self._file = open(database, "rb")
+            fileno = self._file.fileno()
+        self._buffer = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        self.metadata = self._read_metadata()
+        self.bits = 128 if self.metadata.ip_version == 6 else 32
+        self._node_count = self.metadata.node_count
+        self._node_byte_size = self.metadata.node_byte_size
+        self._record_size = self.metadata.record_size
+        self._decoder = Decoder(
+            self._buffer,
+            self.metadata.search_tree_size + DATA_SECTION_SEPARATOR_SIZE,
+        )
+
+        ipv4_start = 0
+        if self.bits == 128:
+            for _ in range(96):
+                if ipv4_start >= self._node_count:
+                    break
+                ipv4_start = self._read_node(ipv4_start, 0)
+        self._ipv4_start = ipv4_start
+        self.aliases = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._buffer.close()
+        if self._file is not None:
+            self._file.close()
+
+    def _read_metadata(self):
+        size = len(self._buffer)
+        start = self._buffer.rfind(
+            METADATA_START_MARKER, max(0, size - METADATA_MAX_SIZE)
+        )
+        if start == -1:
+            self.close()
+            raise InvalidDatabaseError("Is this a valid MaxMind DB file?")
+        start += len(METADATA_START_MARKER)
+        metadata, _ = Decoder(self._buffer, start).decode(start)
+        return Metadata(**metadata)
+
+    def _read_node(self, node, index):
+        offset = node * self._node_byte_size
+        if self._record_size == 24:
+            offset += index * 3
+            return int.from_bytes(self._buffer[offset : offset + 3], "big")
+        if self._record_size == 28:
+            middle = self._buffer[offset + 3]
+            if index:
+                value = int.from_bytes(self._buffer[offset + 4 : offset + 7], "big")
+                return ((middle & 0x0F) << 24) | value
+            value = int.from_bytes(self._buffer[offset : offset + 3], "big")
+            return ((middle & 0xF0) << 20) | value
+        offset += index * 4
+        return int.from_bytes(self._buffer[offset : offset + 4], "big")
+
+    def networks(self):
+        """
+        Yield `(start, prefix_len, pointer)` for every network in the tree.
+
+        `start` is an integer in the tree's address space, where IPv4 addresses
+        of an IPv6 tree live in ::/96. `pointer` is None for networks without a
+        record, including the IPv6 ranges aliased to the IPv4 subtree, which
+        are collected in `aliases` as `(start, prefix_len)`.
+        """
+
+        self.aliases = []
+        stack = [(0, 0, 0)]
+        while stack:
+            node, depth, acc = stack.pop()
+            start = acc << (self.bits - depth)
+            if node > self._node_count:
+                yield start, depth, node
+            elif node == self._node_count:
+                yield start, depth, None
+            elif acc and node == self._ipv4_start:
+                self.aliases.append((start, depth))
+                yield start, depth, None
+            else:
+                stack.append((self._read_node(node, 1), depth + 1, (acc << 1) | 1))
+                stack.append((self._read_node(node, 0), depth + 1, acc << 1))
+
+    def record(self, pointer):
+        offset = pointer - self._node_count + self.metadata.search_tree_size
+        return self._decoder.decode(offset)[0]
+
+    def network(self, start, prefix_len):
+        """Convert a yielded network to an IPv4 or IPv6 network object"""
+
+        return tree_network(self.bits, start, prefix_len)
+
+
+def merge_partitions(first_networks, second_networks, bits):
+    """
+    Split two partitions of the address space, as yielded by
+    `TreeWalker.networks`, into their common refinement. Yields the start of
+    every part with the network of each partition it belongs to.
+    """
+
+    first = next(first_networks)
+    second = next(second_networks)
+    while True:
+        yield max(first[0], second[0]), first, second
+        first_end = first[0] + (1 << (bits - first[1]))
+        second_end = second[0] + (1 << (bits - second[1]))
+        if first_end == 1 << bits and second_end == 1 << bits:
+            return
+        if first_end <= second_end:
+            first = next(first_networks)
+        if second_end <= first_end:
+            second = next(second_networks)
@@ -1,16 +1,251 @@
 import asyncio
+import ipaddress
+import json
+import logging
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, List, Optional
 
-from geoip2.database import Reader
-from pydantic import BaseModel, IPvAnyAddress
+from geoip2.errors import AddressNotFoundError
+from pydantic import (
+    BaseModel,
+    IPvAnyAddress,
+    confloat,
+    conint,
+    conlist,
+    root_validator,
+)
+
+from parse_env import getenv
+
+from . import binary, metrics
+from .cache import NetworkCache
+from .databases import (
+    DatabaseManager,
+    MMDBReaderSet,
+    RecordNotFoundError,
+    files_signature,
+    reader_mode,
+)
+from .registry import DatabaseRegistry, parse_databases
+from .reserved import NetworkSet, verified_missing
+
+logger = logging.getLogger(__name__)
 
 BASE_DIR = Path(__file__).resolve().parent.parent
-CITY_DB_PATH = BASE_DIR.joinpath("db/GeoLite2-City.mmdb")
-ASN_DB_PATH = BASE_DIR.joinpath("db/GeoLite2-ASN.mmdb")
+DB_DIR = Path(getenv("GEOLOCATION_DB_DIR", str(BASE_DIR.joinpath("db"))))
+CITY_DB_PATH = DB_DIR.joinpath("GeoLite2-City.mmdb")
+ASN_DB_PATH = DB_DIR.joinpath("GeoLite2-ASN.mmdb")
+INDEX_PATH = DB_DIR.joinpath("GeoLite2-City-ASN.idx")
+LOOKUP_ENGINE = getenv("GEOLOCATION_LOOKUP_ENGINE", "readers")
+READER_MODE = reader_mode(getenv("GEOLOCATION_READER_MODE", "mmap_ext"))
+DB_WATCH_INTERVAL = float(getenv("GEOLOCATION_DB_WATCH_INTERVAL", "60"))
+
+BATCH_MAX_SIZE = int(getenv("GEOLOCATION_BATCH_MAX_SIZE", "10000"))
+AGGREGATE_MAX_SIZE = int(getenv("GEOLOCATION_AGGREGATE_MAX_SIZE", "100000"))
+STREAM_MAX_LINE_SIZE = int(getenv("GEOLOCATION_STREAM_MAX_LINE_SIZE", "65536"))
+
+CACHE_SIZE = int(getenv("GEOLOCATION_CACHE_SIZE", "4096"))
+NEGATIVE_CACHE_SIZE = int(getenv("GEOLOCATION_NEGATIVE_CACHE_SIZE", "4096"))
+FAST_RESPONSE = getenv("GEOLOCATION_FAST_RESPONSE", "false").lower() == "true"
+PREWARM = getenv("GEOLOCATION_PREWARM", "false").lower() == "true"
+NETWORK_INDEX = getenv("GEOLOCATION_NETWORK_INDEX", "false").lower() == "true"
+# Extra MaxMind editions, see `registry.EDITIONS`
+DATABASES = parse_databases(getenv("GEOLOCATION_DATABASES", ""), DB_DIR)
+NEAREST_MAX_SITES = int(getenv("GEOLOCATION_NEAREST_MAX_SITES", "10"))
+DISTANCE_MAX_SIZE = int(getenv("GEOLOCATION_DISTANCE_MAX_SIZE", "100000"))
+RELOAD_DIFF = getenv("GEOLOCATION_RELOAD_DIFF", "false").lower() == "true"
+RELOAD_DIFF_MAX_NETWORKS = int(getenv("GEOLOCATION_RELOAD_DIFF_MAX_NETWORKS", "100000"))
+WARM_UP_ADDRESS = "8.8.8.8"
+
+result_cache = NetworkCache(CACHE_SIZE)
+json_cache = NetworkCache(CACHE_SIZE)
+binary_cache = NetworkCache(CACHE_SIZE)
+# Network blocks missing from a database, with the name of that database
+missing_cache = NetworkCache(NEGATIVE_CACHE_SIZE)
+reserved_networks = NetworkSet(())
+
+
+def verify_reserved_networks():
+    """Reject up front only the reserved networks the loaded databases have no record for"""
+
+    global reserved_networks
+    with databases.acquire() as readers:
+        reserved_networks = NetworkSet(verified_missing(readers))
+
+
+def open_readers():
+    if LOOKUP_ENGINE == "index":
+        # Only imported when the index engine is configured
+        from .index import IndexReaderSet
 
-city_db = Reader(CITY_DB_PATH, mode=1)
-asn_db = Reader(ASN_DB_PATH, mode=1)
+        return IndexReaderSet(INDEX_PATH)
+    return MMDBReaderSet(CITY_DB_PATH, ASN_DB_PATH, mode=READER_MODE)
+
+
+def changed_networks(previous, readers):
+    """
+    The networks whose City or ASN record differs between two builds, with the
+    IPv6 networks aliased to them, or None when the caches have to be cleared
+    """
+
+    if not RELOAD_DIFF or previous.files is None or readers.files is None:
+        return None
+    # Only imported when reload diffs are enabled
+    from .diff import aliased_networks, diff_builds
+
+    aliases = []
+    networks = []
+    for change in diff_builds(
+        previous.files["city"],
+        previous.files["asn"],
+        readers.files["city"],
+        readers.files["asn"],
+        aliases,
+    ):
+        networks.append(change["network"])
+        # Evicting most of the caches costs more than clearing them
+        if len(networks) > RELOAD_DIFF_MAX_NETWORKS:
+            return None
+    return networks + [
+        alias for network in networks for alias in aliased_networks(network, aliases)
+    ]
+
+
+# The network block caches of the lookups of other modules, by name, see
+# `register_cache`
+extra_caches = {}
+
+
+def register_cache(name, cache):
+    """
+    Invalidate a network block cache of City and ASN records along with the
+    caches of this module, and report it in `cache_stats`
+    """
+
+    extra_caches[name] = cache
+    return cache
+
+
+def invalidate_caches():
+    """Evict the blocks of the networks changed by a reload, or clear the caches"""
+
+    caches = (
+        result_cache,
+        json_cache,
+        binary_cache,
+        *extra_caches.values(),
+        missing_cache,
+    )
+    networks = databases.last_changes
+    # Only the City and ASN databases are compared
+    if networks is None or DATABASES:
+        missing_cache.clear()
+        caches = caches[:-1]
+    if networks is None:
+        for cache in caches:
+            cache.clear()
+        return
+    evicted = sum(cache.evict(networks) for cache in caches)
+    logger.info(
+        "Evicted %d cached blocks of %d changed networks", evicted, len(networks)
+    )
+
+
+def cache_stats():
+    """The size, hit and miss counts of every network block cache, by name"""
+
+    caches = {
+        "result": result_cache,
+        "json": json_cache,
+        "binary": binary_cache,
+        **extra_caches,
+        "missing": missing_cache,
+    }
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+# Nothing is opened at import time, see `warm_up`
+databases = DatabaseManager(
+    open_readers,
+    paths=(INDEX_PATH,) if LOOKUP_ENGINE == "index" else (CITY_DB_PATH, ASN_DB_PATH),
+    on_reload=[invalidate_caches],
+    # Looks up every reserved network
+    on_reload_blocking=[verify_reserved_networks],
+    on_open=[verify_reserved_networks],
+    compare=changed_networks,
+)
+# Every database a selection of fields can be routed to, the extra editions
+# are opened on their first lookup
+registry = DatabaseRegistry(
+    databases,
+    DATABASES,
+    mode=READER_MODE,
+    # Blocks known to be missing from the previous files may be in the new ones
+    on_reopen=[missing_cache.clear],
+)
+databases.on_reload.insert(0, registry.close)
+
+
+async def warm_up():
+    """
+    Open the databases off the event loop, optionally read their files into the
+    page cache, and look up an address once, so the first request pays for none of it
+    """
+
+    await asyncio.to_thread(databases.open)
+    if PREWARM and not databases.prewarmed:
+        await asyncio.to_thread(databases.prewarm)
+    with databases.acquire() as readers:
+        try:
+            readers.lookup(WARM_UP_ADDRESS)
+        except AddressNotFoundError:
+            pass
+
+
+def build_epoch(plan=None):
+    """
+    The build epoch the response of a lookup by `plan` is current for, made of
+    the build epochs of every database it reads
+    """
+
+    if plan is None:
+        return databases.current.build_epoch
+    epochs = dict.fromkeys(str(registry[name].build_epoch) for name in plan.databases)
+    return ".".join(epochs)
+
+
+# Built in the background by `watch_network_index` when NETWORK_INDEX is set
+network_index = None
+
+
+async def watch_network_index(interval):
+    """Build the `NetworkIndex` of the loaded databases, and again after every reload"""
+
+    global network_index
+    # Only imported when the network index is enabled
+    from .networks import NetworkIndex
+
+    await asyncio.to_thread(databases.open)
+    while True:
+        build_epoch = databases.current.build_epoch
+        if network_index is None or network_index.build_epoch != build_epoch:
+            try:
+                network_index = await asyncio.to_thread(
+                    NetworkIndex.build, CITY_DB_PATH, ASN_DB_PATH
+                )
+            except Exception:
+                logger.exception("Building the network index failed")
+            else:
+                logger.info(
+                    "Built the network index of build %s in %.3fs, %d bytes",
+                    network_index.build_epoch,
+                    network_index.build_seconds,
+                    network_index.stats()["size_bytes"],
+                )
+        await asyncio.sleep(interval)
 
 
 class IPAddress(BaseModel):
@@ -57,6 +292,20 @@ class Postal(BaseModel):
     confidence: Optional[int]
     code: Optional[str]
 
+class AnonymousIP(BaseModel):
+    is_anonymous: Optional[bool]
+    is_anonymous_vpn: Optional[bool]
+    is_hosting_provider: Optional[bool]
+    is_public_proxy: Optional[bool]
+    is_residential_proxy: Optional[bool]
+    is_tor_exit_node: Optional[bool]
+
+class ISP(BaseModel):
+    isp: Optional[str]
+    organization: Optional[str]
+    mobile_country_code: Optional[str]
+    mobile_network_code: Optional[str]
+
 class GeoLocation(BaseModel):
     continent: Optional[Continent]
     country: Optional[Country]
@@ -64,25 +313,74 @@ class GeoLocation(BaseModel):
     location: Optional[Location]
     asn: Optional[ASN]
     postal: Optional[Postal]
+    # Only returned when selected with `fields`, from the extra editions
+    # of GEOLOCATION_DATABASES
+    anonymous_ip: Optional[AnonymousIP]
+    isp: Optional[ISP]
+
+class BatchRequest(BaseModel):
+    ip_addresses: conlist(str, min_items=1, max_items=BATCH_MAX_SIZE)
+
+class AggregateRequest(BaseModel):
+    ip_addresses: conlist(str, min_items=1, max_items=AGGREGATE_MAX_SIZE)
+    by: List[str] = ["country"]
+    top: Optional[conint(ge=1)]
+
+class NearestRequest(BaseModel):
+    ip_addresses: conlist(str, min_items=1, max_items=BATCH_MAX_SIZE)
+    k: conint(ge=1, le=NEAREST_MAX_SITES) = 1
+
+class DistanceRequest(BaseModel):
+    ip_addresses: conlist(str, min_items=1, max_items=DISTANCE_MAX_SIZE)
+    latitudes: Optional[List[confloat(ge=-90, le=90)]]
+    longitudes: Optional[List[confloat(ge=-180, le=180)]]
+    max_distance_km: Optional[confloat(ge=0)]
+    geofences: List[str] = []
+
+    @root_validator(skip_on_failure=True)
+    def check_coordinates(cls, values):
+        latitudes, longitudes = values.get("latitudes"), values.get("longitudes")
+        if (latitudes is None) != (longitudes is None):
+            raise ValueError("latitudes and longitudes must be given together")
+        if latitudes is not None and (
+            len(latitudes) != len(longitudes)
+            or len(latitudes) not in (1, len(values["ip_addresses"]))
+        ):
+            raise ValueError(
+                "latitudes and longitudes must hold one point or one per address"
+            )
+        if values.get("max_distance_km") is not None and latitudes is None:
+            raise ValueError("max_distance_km needs latitudes and longitudes")
+        return values
 
+class BatchResult(BaseModel):
+    ip_address: str
+    status: int
+    result: Optional[GeoLocation]
+    message: Optional[str]
 
-async def asn_info(asn):
+
+def not_found_message(ip_address):
+    return f"IP address {ip_address} is not present in the database"
+
+
+def asn_info(asn):
     return ASN(
         autonomous_system_number=asn.autonomous_system_number,
         autonomous_system_organization=asn.autonomous_system_organization,
-        ip_address=asn.ip_address,
+        ip_address=str(asn.ip_address),
         network=asn.network,
     )
 
 
-async def continent_info(continent):
+def continent_info(continent):
     return Continent(
         code=continent.code,
         name=continent.name,
     )
 
 
-async def country_info(country):
+def country_info(country):
     return Country(
         is_in_european_union=country.is_in_european_union,
         iso_code=country.iso_code,
@@ -90,7 +388,7 @@ async def country_info(country):
     )
 
 
-async def location_info(location):
+def location_info(location):
     return Location(
         accuracy_radius=location.accuracy_radius,
         latitude=location.latitude,
@@ -100,28 +398,522 @@ async def location_info(location):
     )
 
 
-async def city_info(city):
+def city_info(city):
     return City(
         name=city.name,
     )
 
 
-async def postal_info(postal):
+def postal_info(postal):
     return Postal(
         code=postal.code,
     )
 
 
-async def lookup_ip(ip):
-    city = city_db.city(ip)
-    asn = asn_db.asn(ip)
+def lookup_ip(ip):
+    ip = ipaddress.ip_address(ip)
+    cached = result_cache.get(ip)
+    if cached is not None:
+        metrics.CACHE_HITS.inc("result")
+        # Only the looked up address differs between addresses of a cached block
+        return cached.copy(
+            update={"asn": cached.asn.copy(update={"ip_address": str(ip)})}
+        )
+    metrics.CACHE_MISSES.inc("result")
+
+    # Read before the databases, a reload invalidating the caches meanwhile
+    # drops the result of the previous build
+    generation = result_cache.generation
+    missing_generation = missing_cache.generation
+    started = time.perf_counter()
+    try:
+        with databases.acquire() as readers:
+            city, asn = readers.lookup(ip)
+    except RecordNotFoundError as exc:
+        missing_cache.put(exc.network, exc.database, missing_generation)
+        raise
+    finally:
+        looked_up = time.perf_counter()
+        metrics.STAGE_DURATION.observe("lookup", looked_up - started)
+
+    result = GeoLocation(
+        continent=continent_info(city.continent),
+        country=country_info(city.country),
+        city=city_info(city.city),
+        location=location_info(city.location),
+        postal=postal_info(city.postal),
+        asn=asn_info(asn),
+    )
+    metrics.STAGE_DURATION.observe("build", time.perf_counter() - looked_up)
+    # Both records are shared by every address in the smaller of the two networks
+    network = max(city.traits.network, asn.network, key=lambda n: n.prefixlen)
+    result_cache.put(network, result, generation)
+    return result
+
+
+def _dumps(content):
+    # Same encoding as JSONResponse
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    )
+
+
+def _without_none(**fields):
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def _name(record):
+    return record.get("names", {}).get("en")
+
+
+_IP_PLACEHOLDER = _dumps("\0")
+
+
+def _continent_content(city):
+    continent = city.get("continent", {})
+    return _without_none(code=continent.get("code"), name=_name(continent))
+
+
+def _country_content(city):
+    country = city.get("country", {})
+    return _without_none(
+        is_in_european_union=country.get("is_in_european_union", False),
+        iso_code=country.get("iso_code"),
+        name=_name(country),
+    )
+
+
+def _city_content(city):
+    return _without_none(name=_name(city.get("city", {})))
+
 
-    return GeoLocation(
-        continent=await continent_info(city.continent),
-        country=await country_info(city.country),
-        city=await city_info(city.city),
-        location=await location_info(city.location),
-        postal=await postal_info(city.postal),
-        asn=await asn_info(asn),
+def _location_content(city):
+    location = city.get("location", {})
+    return _without_none(
+        accuracy_radius=location.get("accuracy_radius"),
+        latitude=location.get("latitude"),
+        longitude=location.get("longitude"),
+        metro_code=location.get("metro_code"),
+        time_zone=location.get("time_zone"),
     )
 
+
+def _postal_content(city):
+    return _without_none(code=city.get("postal", {}).get("code"))
+
+
+def _anonymous_ip_content(record):
+    return {field: record.get(field, False) for field in AnonymousIP.__fields__}
+
+
+def _isp_content(record):
+    return _without_none(**{field: record.get(field) for field in ISP.__fields__})
+
+
+def _asn_content(asn, ip_address, asn_network):
+    return _without_none(
+        autonomous_system_number=asn.get("autonomous_system_number"),
+        autonomous_system_organization=asn.get("autonomous_system_organization"),
+        ip_address=ip_address,
+        network=str(asn_network),
+    )
+
+
+SECTIONS = {
+    "continent": _continent_content,
+    "country": _country_content,
+    "city": _city_content,
+    "location": _location_content,
+    "postal": _postal_content,
+    "anonymous_ip": _anonymous_ip_content,
+    "isp": _isp_content,
+}
+
+
+def geolocation_content(city, asn, ip_address, asn_network):
+    """Build the content of a `GeoLocation` response straight from raw records"""
+
+    return {
+        "continent": _continent_content(city),
+        "country": _country_content(city),
+        "city": _city_content(city),
+        "location": _location_content(city),
+        "asn": _asn_content(asn, ip_address, asn_network),
+        "postal": _postal_content(city),
+    }
+
+
+class FieldPlan:
+    """
+    The sections of a `GeoLocation` response selected by `field_plan`, each
+    with the tuple of its selected fields or None for all of them, and the
+    database of the registry each section is routed to. Only those databases
+    are looked up.
+    """
+
+    def __init__(self, sections, route):
+        self.sections = sections
+        self.route = route
+        self.databases = tuple(dict.fromkeys(route.values()))
+
+    def content(self, records, ip_address, asn_network):
+        content = {}
+        for name, fields in self.sections.items():
+            record = records[self.route[name]]
+            if name == "asn":
+                section = _asn_content(record, ip_address, asn_network)
+            else:
+                section = SECTIONS[name](record)
+            if fields is not None:
+                section = {
+                    field: section[field] for field in fields if field in section
+                }
+            content[name] = section
+        return content
+
+
+@lru_cache(maxsize=256)
+def field_plan(fields):
+    """
+    Compile a comma-separated selection such as `country,asn.autonomous_system_number`
+    into a `FieldPlan`, raising ValueError for unknown fields and for sections
+    no configured database answers
+    """
+
+    selected = {}
+    for item in fields.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, field = item.partition(".")
+        section = GeoLocation.__fields__.get(name)
+        if section is None or (field and field not in section.type_.__fields__):
+            raise ValueError(f"Unknown field {item}")
+        if not field:
+            selected[name] = None
+        elif selected.get(name, ()) is not None:
+            selected[name] = selected.get(name, ()) + (field,)
+
+    if not selected:
+        raise ValueError("No fields selected")
+
+    # Sections and fields are returned in the same order as the full response
+    sections = {}
+    for name, section in GeoLocation.__fields__.items():
+        if name in selected:
+            fields = selected[name]
+            if fields is not None:
+                fields = tuple(
+                    field for field in section.type_.__fields__ if field in fields
+                )
+            sections[name] = fields
+    return FieldPlan(sections, registry.route(sections))
+
+
+def _lookup_fields(ip, plan):
+    def read(ip):
+        return [registry[name].record(ip) for name in plan.databases]
+
+    def encode(ip, pairs):
+        records = {}
+        prefix_lens = {}
+        for name, (record, prefix_len) in zip(plan.databases, pairs):
+            records[name] = record
+            prefix_lens[name] = prefix_len
+        asn_network = None
+        if plan.route.get("asn") in prefix_lens:
+            asn_network = ipaddress.ip_network(
+                (ip, prefix_lens[plan.route["asn"]]), strict=False
+            )
+        return _dumps(plan.content(records, str(ip), asn_network)).encode()
+
+    return _lookup(ip, read, encode)
+
+
+def lookup_ip_fields(ip, plan):
+    """Look up the sections selected by a `FieldPlan`, as JSON bytes"""
+
+    return _lookup_fields(ipaddress.ip_address(ip), plan)[0]
+
+
+def _read_records(ip):
+    with databases.acquire() as readers:
+        return readers.records(ip)
+
+
+def _lookup(ip, read, encode, cache=None, name=None):
+    """
+    The encoded records of an address and the network block they hold for.
+    With a `cache` they are cached by block and counted as `name` cache hits
+    and misses.
+
+    `read(ip)` returns the `(record, prefix_len)` pair of every database the
+    lookup needs, and `encode(ip, pairs)` encodes them. The block of a missing
+    address is remembered in `missing_cache`.
+    """
+
+    if cache is not None:
+        cached = cache.get(ip)
+        if cached is not None:
+            metrics.CACHE_HITS.inc(name)
+            return cached
+        metrics.CACHE_MISSES.inc(name)
+
+    # See `lookup_ip`
+    generation = None if cache is None else cache.generation
+    missing_generation = missing_cache.generation
+    started = time.perf_counter()
+    try:
+        pairs = read(ip)
+    except RecordNotFoundError as exc:
+        missing_cache.put(exc.network, exc.database, missing_generation)
+        raise
+    finally:
+        looked_up = time.perf_counter()
+        metrics.STAGE_DURATION.observe("lookup", looked_up - started)
+
+    # Every address in the smallest of the blocks shares all the records
+    prefix_len = max(prefix_len for _, prefix_len in pairs)
+    network = ipaddress.ip_network((ip, prefix_len), strict=False)
+    encoded = encode(ip, pairs), network
+    if cache is not None:
+        cache.put(network, encoded, generation)
+    metrics.STAGE_DURATION.observe("serialize", time.perf_counter() - looked_up)
+    return encoded
+
+
+def _encode_records(ip, pairs):
+    """Encode raw records like `GeoLocation`, split around the asn.ip_address value"""
+
+    (city, _), (asn, asn_prefix_len) = pairs
+    asn_network = ipaddress.ip_network((ip, asn_prefix_len), strict=False)
+    content = geolocation_content(city, asn, "\0", asn_network)
+    head, tail = _dumps(content).split(_IP_PLACEHOLDER, 1)
+    return head.encode(), tail.encode()
+
+
+def _lookup_encoded(ip):
+    """The encoded records of an address, split around asn.ip_address, and their network"""
+
+    return _lookup(ip, _read_records, _encode_records, json_cache, "json")
+
+
+def lookup_ip_json(ip):
+    """Look up an address straight into the JSON bytes `lookup_ip` would be serialized to"""
+
+    return lookup_ip_document(ip)[0]
+
+
+def lookup_ip_document(ip, plan=None):
+    """
+    Look up an address into the JSON bytes of a full `GeoLocation` response, or
+    of the sections selected by `plan`, and the network block they hold for
+    """
+
+    ip = ipaddress.ip_address(ip)
+    if plan is not None:
+        return _lookup_fields(ip, plan)
+    (head, tail), network = _lookup_encoded(ip)
+    return b"".join((head, _dumps(str(ip)).encode(), tail)), network
+
+
+def _encode_binary(ip, pairs):
+    (city, _), (asn, asn_prefix_len) = pairs
+    asn_network = ipaddress.ip_network((ip, asn_prefix_len), strict=False)
+    # Without asn.ip_address, so one record serves the whole block
+    return binary.encode_content(geolocation_content(city, asn, None, asn_network))
+
+
+def lookup_ip_binary(ip):
+    """Look up an address into a `binary` record"""
+
+    return _lookup(ip, _read_records, _encode_binary, binary_cache, "binary")[0]
+
+
+def lookup_binary(addresses):
+    """Look up parsed `binary` request addresses into the records of the response"""
+
+    records = []
+    for ip in addresses:
+        if known_missing(ip):
+            metrics.NOT_FOUND.inc()
+            records.append(binary.NOT_FOUND_RECORD)
+            continue
+        try:
+            records.append(lookup_ip_binary(ip))
+        except AddressNotFoundError:
+            metrics.NOT_FOUND.inc()
+            records.append(binary.NOT_FOUND_RECORD)
+    return b"".join(records)
+
+
+_range_index = None
+_range_index_lock = threading.Lock()
+
+
+def range_index():
+    """
+    The vectorized `RangeIndex` over the compiled index, for resolving whole
+    arrays of addresses into columns. It is opened on first use and again
+    whenever the index file is rebuilt, which takes a while, so call it off
+    the event loop.
+    """
+
+    global _range_index
+    # NumPy is only needed by offline enrichment, keep it out of server startup
+    from .vectorized import RangeIndex
+
+    with _range_index_lock:
+        signature = files_signature((INDEX_PATH,))
+        if _range_index is None or _range_index[0] != signature:
+            _range_index = (signature, RangeIndex(INDEX_PATH))
+        return _range_index[1]
+
+
+def known_missing(ip, plan=None):
+    """
+    Whether an address is in a reserved network or a block known to be missing
+    from a database the lookup needs, answered without touching the databases
+    """
+
+    try:
+        ip = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    if ip in reserved_networks:
+        return True
+    database = missing_cache.get(ip)
+    if database is None:
+        return False
+    if plan is None:
+        return database in ("city", "asn")
+    return database in plan.databases
+
+
+def try_lookup_ip(ip_address):
+    """Look up an untrusted address, returning a status code, the result and an error message"""
+
+    try:
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        metrics.ERRORS.inc("invalid")
+        return 422, None, f"{ip_address} is not a valid IP address"
+
+    if known_missing(ip):
+        metrics.NOT_FOUND.inc()
+        return 404, None, not_found_message(ip_address)
+
+    try:
+        return 200, lookup_ip(ip), None
+    except AddressNotFoundError:
+        metrics.NOT_FOUND.inc()
+        return 404, None, not_found_message(ip_address)
+
+
+def lookup_batch(ip_addresses):
+    results = {}
+    for ip_address in dict.fromkeys(ip_addresses):
+        status, result, message = try_lookup_ip(ip_address)
+        results[ip_address] = BatchResult(
+            ip_address=ip_address, status=status, result=result, message=message
+        )
+
+    return [results[ip_address] for ip_address in ip_addresses]
+
+
+def enrich_line(line):
+    """Enrich one NDJSON line, either a bare IP address or a record with an `ip` field"""
+
+    if line.startswith(b"{"):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return json.dumps({"error": "Line is not valid JSON"})
+        if not isinstance(record, dict) or not isinstance(record.get("ip"), str):
+            return json.dumps({"error": "Record has no ip field"})
+    else:
+        record = {"ip": line.decode(errors="replace")}
+
+    _, result, message = try_lookup_ip(record["ip"])
+    if result is None:
+        record["error"] = message
+    else:
+        record["geolocation"] = result.dict(exclude_none=True)
+
+    return json.dumps(record, default=str)
+
+
+def _reply(message_id, status, **fields):
+    return json.dumps({"id": message_id, "status": status, **fields}, default=str)
+
+
+def lookup_message(text):
+    """
+    Answer one WebSocket lookup message, `{"id": ..., "ip": ...}`, with the
+    status of the lookup and its `result` or `message`, under the same id
+    """
+
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return _reply(None, 422, message="Message is not valid JSON")
+    if not isinstance(message, dict):
+        return _reply(None, 422, message="Message is not a JSON object")
+    message_id = message.get("id")
+    if not isinstance(message.get("ip"), str):
+        return _reply(message_id, 422, message="Message has no ip field")
+
+    status, result, error = try_lookup_ip(message["ip"])
+    if result is None:
+        return _reply(message_id, status, message=error)
+    return _reply(message_id, status, result=result.dict(exclude_none=True))
+
+
+async def stream_lines(chunks):
+    """
+    Split a stream of newline-delimited chunks into lists of the stripped,
+    non-empty lines each chunk completes. A line longer than
+    `STREAM_MAX_LINE_SIZE` is skipped and listed as None.
+    """
+
+    pending = b""
+    discarding = False
+    async for chunk in chunks:
+        if discarding:
+            # Skip the remainder of an oversized line
+            _, newline, chunk = chunk.partition(b"\n")
+            discarding = not newline
+
+        *lines, pending = (pending + chunk).split(b"\n")
+        lines = [line for line in map(bytes.strip, lines) if line]
+
+        if len(pending) > STREAM_MAX_LINE_SIZE:
+            lines.append(None)
+            pending = b""
+            discarding = True
+
+        if lines:
+            yield lines
+
+    if pending.strip():
+        yield [pending.strip()]
+
+
+def enrich_lines(lines):
+    """Enrich the lines of one chunk of `stream_lines` into their NDJSON output"""
+
+    output = [
+        json.dumps({"error": "Line is too long"}) if line is None else enrich_line(line)
+        for line in lines
+    ]
+    return "\n".join(output) + "\n"
+
+
+async def enrich_stream(chunks):
+    """
+    Enrich a stream of NDJSON chunks, yielding the output for each chunk as it
+    resolves, the lines of every chunk in the threadpool
+    """
+
+    async for lines in stream_lines(chunks):
+        yield await asyncio.to_thread(enrich_lines, lines)
@@ -0,0 +1,128 @@
+import sys
+import time
+
+from .mmdb import IPV4_MAX, TreeWalker, tree_network
+
+# A network is its start in the search tree, as 16 big-endian bytes, followed
+# by its prefix length in the tree
+ENTRY_SIZE = 17
+
+KINDS = ("asn", "country")
+
+_UNKNOWN = object()
+
+
+def asn_key(record):
+    return record.get("autonomous_system_number")
+
+
+def country_key(record):
+    iso_code = record.get("country", {}).get("iso_code")
+    return iso_code.upper() if iso_code else None
+
+
+def _ranges(walker, key_of):
+    """Merge the networks of every key into address ranges, in address order"""
+
+    keys = {}
+    ranges = {}
+    for start, prefix_len, pointer in walker.networks():
+        if pointer is None:
+            continue
+        key = keys.get(pointer, _UNKNOWN)
+        if key is _UNKNOWN:
+            key = keys[pointer] = key_of(walker.record(pointer))
+        if key is None:
+            continue
+
+        end = start + (1 << (walker.bits - prefix_len)) - 1
+        key_ranges = ranges.setdefault(key, [])
+        # IPv4 networks of an IPv6 tree are never merged with the IPv6 ones
+        if key_ranges and key_ranges[-1][1] + 1 == start and start != IPV4_MAX + 1:
+            key_ranges[-1][1] = end
+        else:
+            key_ranges.append([start, end])
+    return ranges
+
+
+def cidrs(start, end, bits):
+    """Yield the `(start, prefix_len)` of the fewest networks covering a range"""
+
+    while start <= end:
+        size = (start & -start).bit_length() - 1 if start else bits
+        size = min(size, (end - start + 1).bit_length() - 1)
+        yield start, bits - size
+        start += 1 << size
+
+
+def _pack(ranges, bits):
+    return {
+        key: b"".join(
+            start.to_bytes(16, "big") + bytes((prefix_len,))
+            for range_start, range_end in key_ranges
+            for start, prefix_len in cidrs(range_start, range_end, bits)
+        )
+        for key, key_ranges in ranges.items()
+    }
+
+
+class NetworkIndex:
+    """
+    Every network of an ASN or of a country, found by walking the whole
+    search trees of the City and ASN databases once.
+
+    Adjacent networks of the same key are merged into the fewest CIDRs, which
+    are kept packed in one bytes object per key, so a page of networks is a
+    slice of it.
+    """
+
+    def __init__(self, bits, packed, build_epoch, build_seconds):
+        self.bits = bits
+        self.packed = packed
+        self.build_epoch = build_epoch
+        self.build_seconds = build_seconds
+
+    @classmethod
+    def build(cls, city_path, asn_path):
+        started = time.perf_counter()
+        with TreeWalker(city_path) as city, TreeWalker(asn_path) as asn:
+            if city.bits != asn.bits:
+                raise ValueError(
+                    "The City and ASN databases must have the same IP version"
+                )
+            packed = {
+                "asn": _pack(_ranges(asn, asn_key), asn.bits),
+                "country": _pack(_ranges(city, country_key), city.bits),
+            }
+            build_epoch = max(city.metadata.build_epoch, asn.metadata.build_epoch)
+            return cls(city.bits, packed, build_epoch, time.perf_counter() - started)
+
+    def count(self, kind, key):
+        """The number of networks of a key, None for an unknown one"""
+
+        packed = self.packed[kind].get(key)
+        return None if packed is None else len(packed) // ENTRY_SIZE
+
+    def networks(self, kind, key, offset=0, limit=None):
+        """Yield the networks of a key in address order, from `offset` on"""
+
+        packed = self.packed[kind].get(key, b"")
+        end = len(packed) if limit is None else (offset + limit) * ENTRY_SIZE
+        for position in range(offset * ENTRY_SIZE, min(end, len(packed)), ENTRY_SIZE):
+            start = int.from_bytes(packed[position : position + 16], "big")
+            yield tree_network(self.bits, start, packed[position + 16])
+
+    def stats(self):
+        return {
+            "build_epoch": self.build_epoch,
+            "build_seconds": self.build_seconds,
+            "size_bytes": sum(
+                sys.getsizeof(keys) + sum(map(sys.getsizeof, keys.values()))
+                for keys in self.packed.values()
+            ),
+            "keys": {kind: len(keys) for kind, keys in self.packed.items()},
+            "networks": {
+                kind: sum(len(packed) for packed in keys.values()) // ENTRY_SIZE
+                for kind, keys in self.packed.items()
+            },
+        }
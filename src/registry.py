@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import maxminddb
+
+from . import metrics
+from .databases import Retirable, address_not_found, files_signature
+
+logger = logging.getLogger(__name__)
+
+# MaxMind editions that can be added next to the City and ASN databases, with
+# their default file name, the `GeoLocation` sections their records answer and
+# the relative cost of a lookup. Requests are routed to the cheapest database
+# that answers a section.
+EDITIONS = {
+    "country": ("GeoLite2-Country.mmdb", ("continent", "country"), 1),
+    "anonymous_ip": ("GeoIP2-Anonymous-IP.mmdb", ("anonymous_ip",), 1),
+    "isp": ("GeoIP2-ISP.mmdb", ("asn", "isp"), 2),
+}
+
+# Costs of the databases served by the `DatabaseManager`, a City record is
+# several times larger to decode than a Country record
+CITY_SECTIONS = ("continent", "country", "city", "location", "postal")
+CITY_COST = 3
+ASN_COST = 1
+
+
+class Database:
+    """
+    One database of the registry, shared by every request. Records the time of
+    every lookup.
+    """
+
+    def __init__(self, name, sections, cost):
+        self.name = name
+        self.sections = tuple(sections)
+        self.cost = cost
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+
+    def _record(self, ip_address):
+        raise NotImplementedError
+
+    @property
+    def build_epoch(self):
+        raise NotImplementedError
+
+    def record(self, ip_address):
+        """Return the `(record, prefix_len)` pair of an address"""
+
+        started = time.perf_counter()
+        try:
+            return self._record(ip_address)
+        finally:
+            seconds = time.perf_counter() - started
+            self.lookups += 1
+            self.lookup_seconds += seconds
+            metrics.DATABASE_DURATION.observe(self.name, seconds)
+
+    def status(self):
+        return {
+            "sections": list(self.sections),
+            "cost": self.cost,
+            "lookups": self.lookups,
+            "mean_lookup_seconds": (
+                self.lookup_seconds / self.lookups if self.lookups else None
+            ),
+        }
+
+
+class ManagedDatabase(Database):
+    """The City or ASN database of the active build of a `DatabaseManager`"""
+
+    def __init__(self, name, sections, cost, databases):
+        super().__init__(name, sections, cost)
+        self.databases = databases
+
+    def _record(self, ip_address):
+        with self.databases.acquire() as readers:
+            if self.name == "city":
+                return readers.city_record(ip_address)
+            return readers.asn_record(ip_address)
+
+    @property
+    def build_epoch(self):
+        return self.databases.current.build_epoch
+
+
+class EditionReader(Retirable):
+    """The maxminddb reader of one opened file of an extra edition"""
+
+    def __init__(self, path, mode):
+        super().__init__()
+        self.reader = maxminddb.open_database(path, mode)
+
+    def close(self):
+        self.reader.close()
+
+
+class FileDatabase(Database):
+    """
+    A MaxMind DB file opened on its first lookup, and again after `close`
+    once its file changed. Lookups hold the `EditionReader` they use, so a
+    closed file is only unmapped once the last of them has finished.
+    """
+
+    def __init__(self, name, sections, cost, path, mode=maxminddb.MODE_MMAP_EXT):
+        super().__init__(name, sections, cost)
+        self.path = path
+        self.mode = mode
+        self.reader = None
+        self._signature = None
+        self._open_lock = threading.Lock()
+
+    def open(self):
+        with self._open_lock:
+            if self.reader is None:
+                self._signature = files_signature((self.path,))
+                self.reader = EditionReader(self.path, self.mode)
+        return self.reader
+
+    @contextmanager
+    def acquire(self):
+        """Hold the open reader, opening it first if needed"""
+
+        reader = self.reader or self.open()
+        # A lookup in the threadpool can race `close`, the reader it read may
+        # have been closed since
+        while not reader.hold():
+            reader = self.reader or self.open()
+        try:
+            yield reader.reader
+        finally:
+            reader.release()
+
+    def changed(self):
+        # A file that was never opened has nothing to be swapped out
+        return (
+            self.reader is not None
+            and files_signature((self.path,)) != self._signature
+        )
+
+    @property
+    def build_epoch(self):
+        with self.acquire() as reader:
+            return reader.metadata().build_epoch
+
+    def _record(self, ip_address):
+        with self.acquire() as reader:
+            record, prefix_len = reader.get_with_prefix_len(ip_address)
+        if record is None:
+            raise address_not_found(ip_address, prefix_len, self.name)
+        return record, prefix_len
+
+    def close(self):
+        """
+        Close the file, the next lookup opens it again. Lookups in the
+        threadpool still reading it keep it open until they finish.
+        """
+
+        with self._open_lock:
+            reader, self.reader = self.reader, None
+        if reader is not None:
+            reader.retire()
+
+    def status(self):
+        status = super().status()
+        reader = self.reader
+        status["path"] = str(self.path)
+        status["open"] = reader is not None and reader.hold()
+        if status["open"]:
+            try:
+                status["build_epoch"] = reader.reader.metadata().build_epoch
+            finally:
+                reader.release()
+        return status
+
+
+def parse_databases(value, db_dir):
+    """
+    Parse a space-separated list of editions, each `name` or `name=path`, into
+    `(name, path)` pairs, raising ValueError for an unknown edition
+    """
+
+    databases = []
+    for item in value.split():
+        name, _, path = item.partition("=")
+        if name not in EDITIONS:
+            raise ValueError(
+                f"Unknown database {name!r}, expected one of {', '.join(EDITIONS)}"
+            )
+        databases.append((name, path or db_dir.joinpath(EDITIONS[name][0])))
+    return databases
+
+
+class DatabaseRegistry:
+    """
+    The City and ASN databases of a `DatabaseManager` and the configured
+    extra editions, by name. `on_reopen` callbacks run after `watch` closed
+    the extra editions whose file changed.
+    """
+
+    def __init__(
+        self, databases, extra=(), mode=maxminddb.MODE_MMAP_EXT, on_reopen=()
+    ):
+        self.on_reopen = list(on_reopen)
+        self.databases = {
+            "city": ManagedDatabase("city", CITY_SECTIONS, CITY_COST, databases),
+            "asn": ManagedDatabase("asn", ("asn",), ASN_COST, databases),
+        }
+        for name, path in extra:
+            _, sections, cost = EDITIONS[name]
+            self.databases[name] = FileDatabase(name, sections, cost, path, mode)
+
+    def __getitem__(self, name):
+        return self.databases[name]
+
+    def route(self, sections):
+        """
+        Map every section to the database it is looked up in, raising
+        ValueError for a section no database answers.
+
+        Sections with the fewest candidates are routed first, so a database
+        chosen for one of them answers the others it can too, and each
+        database is looked up at most once.
+        """
+
+        candidates = {
+            section: sorted(
+                (
+                    database
+                    for database in self.databases.values()
+                    if section in database.sections
+                ),
+                key=lambda database: database.cost,
+            )
+            for section in sections
+        }
+        route = {}
+        chosen = set()
+        for section in sorted(sections, key=lambda section: len(candidates[section])):
+            if not candidates[section]:
+                raise ValueError(f"No database configured for {section}")
+            database = next(
+                (
+                    database
+                    for database in candidates[section]
+                    if database.name in chosen
+                ),
+                candidates[section][0],
+            )
+            route[section] = database.name
+            chosen.add(database.name)
+        return {section: route[section] for section in sections}
+
+    def close(self):
+        """Close the extra editions, so they are opened again from their files"""
+
+        for database in self.databases.values():
+            if isinstance(database, FileDatabase):
+                database.close()
+
+    def reopen_changed(self):
+        """
+        Close the extra editions whose file changed, so the next lookup opens
+        the new one, returning their names
+        """
+
+        changed = [
+            name
+            for name, database in self.databases.items()
+            if isinstance(database, FileDatabase) and database.changed()
+        ]
+        for name in changed:
+            self.databases[name].close()
+        return changed
+
+    async def watch(self, interval):
+        """Check the files of the extra editions for changes every `interval` seconds"""
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed = await asyncio.to_thread(self.reopen_changed)
+                if changed:
+                    logger.info(
+                        "Reopening the changed databases %s", ", ".join(changed)
+                    )
+                    for callback in self.on_reopen:
+                        callback()
+            except Exception:
+                # Keep watching, the next change may open
+                logger.exception("Watching the extra databases failed")
+
+    def status(self):
+        return {name: database.status() for name, database in self.databases.items()}
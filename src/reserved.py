@@ -0,0 +1,82 @@
+import ipaddress
+from bisect import bisect_right
+
+from geoip2.errors import AddressNotFoundError
+
+# Special-purpose ranges that public geolocation databases leave empty. Only the
+# ones `verified_missing` confirms for the loaded build are rejected up front.
+RESERVED_NETWORKS = [
+    ipaddress.ip_network(network)
+    for network in (
+        "0.0.0.0/8",
+        "10.0.0.0/8",
+        "100.64.0.0/10",
+        "127.0.0.0/8",
+        "169.254.0.0/16",
+        "172.16.0.0/12",
+        "192.0.0.0/24",
+        "192.0.2.0/24",
+        "192.168.0.0/16",
+        "198.18.0.0/15",
+        "198.51.100.0/24",
+        "203.0.113.0/24",
+        "224.0.0.0/4",
+        "240.0.0.0/4",
+        "::/128",
+        "::1/128",
+        "100::/64",
+        "2001:db8::/32",
+        "fc00::/7",
+        "fe80::/10",
+        "ff00::/8",
+    )
+]
+
+
+class NetworkSet:
+    """
+    A fixed set of networks, merged into sorted address ranges per IP version.
+
+    Membership is one binary search, with IPv4-mapped IPv6 addresses checked
+    as the IPv4 address they map to.
+    """
+
+    def __init__(self, networks):
+        self._ranges = {4: ([], []), 6: ([], [])}
+        for network in sorted(networks, key=lambda n: (n.version, n.network_address)):
+            starts, ends = self._ranges[network.version]
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+    def __contains__(self, ip_address):
+        if ip_address.version == 6 and ip_address.ipv4_mapped is not None:
+            ip_address = ip_address.ipv4_mapped
+        starts, ends = self._ranges[ip_address.version]
+        address = int(ip_address)
+        position = bisect_right(starts, address) - 1
+        return position >= 0 and address <= ends[position]
+
+
+def _is_missing(lookup, network):
+    try:
+        lookup(network.network_address)
+    except AddressNotFoundError as exc:
+        # The error carries the largest network around the address without a record
+        return network.subnet_of(exc.network)
+    return False
+
+
+def verified_missing(readers, networks=RESERVED_NETWORKS):
+    """Return the networks that have no record at all in either database of `readers`"""
+
+    return [
+        network
+        for network in networks
+        if _is_missing(readers.city_record, network)
+        and _is_missing(readers.asn_record, network)
+    ]
@@ -0,0 +1,209 @@
+import heapq
+import ipaddress
+import json
+import math
+from pathlib import Path
+
+from parse_env import getenv
+
+from . import metrics, models
+from .cache import NetworkCache
+from .databases import FileIndex, RecordNotFoundError
+
+SITES_FILE = Path(
+    getenv("GEOLOCATION_SITES_FILE", str(models.BASE_DIR.joinpath("sites.json")))
+)
+
+# Mean radius of the Earth
+EARTH_RADIUS_KM = 6371.0088
+
+
+def unit_vector(latitude, longitude):
+    """
+    A point on the unit sphere, where the straight line distance between two
+    points grows with their great-circle distance
+    """
+
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def chord_to_km(chord):
+    return 2 * math.asin(min(chord / 2, 1.0)) * EARTH_RADIUS_KM
+
+
+def load_sites(path):
+    """
+    Read a JSON list of sites, each an object with an `id`, a `latitude` and a
+    `longitude`, raising ValueError for a malformed one
+    """
+
+    with open(path, "rb") as file:
+        sites = json.load(file)
+    if not isinstance(sites, list):
+        raise ValueError(f"{path} must hold a JSON list of sites")
+    ids = set()
+    for position, site in enumerate(sites):
+        if not isinstance(site, dict) or "id" not in site:
+            raise ValueError(f"Site {position} of {path} has no id")
+        latitude, longitude = site.get("latitude"), site.get("longitude")
+        if not (
+            isinstance(latitude, (int, float))
+            and isinstance(longitude, (int, float))
+            and -90 <= latitude <= 90
+            and -180 <= longitude <= 180
+        ):
+            raise ValueError(f"Site {site['id']} of {path} has no valid location")
+        if site["id"] in ids:
+            raise ValueError(f"Site {site['id']} of {path} is listed twice")
+        ids.add(site["id"])
+    return sites
+
+
+class SiteIndex:
+    """
+    A k-d tree over the sites as points on the unit sphere, so the nearest
+    sites of a location are found without measuring the distance to all of
+    them. Built once per site list.
+
+    Leaves hold up to `LEAF_SIZE` sites, which are cheaper to scan than to
+    split further.
+    """
+
+    LEAF_SIZE = 16
+
+    def __init__(self, sites):
+        self.sites = sites
+        points = [
+            (*unit_vector(site["latitude"], site["longitude"]), position)
+            for position, site in enumerate(sites)
+        ]
+        self.root = self._build(points, 0)
+
+    @classmethod
+    def load(cls, path):
+        return cls(load_sites(path))
+
+    def __len__(self):
+        return len(self.sites)
+
+    def _build(self, points, depth):
+        # A leaf is (None, points), a node is (axis, split, left, right)
+        if len(points) <= self.LEAF_SIZE:
+            return None, points
+        axis = depth % 3
+        points.sort(key=lambda point: point[axis])
+        middle = len(points) // 2
+        return (
+            axis,
+            points[middle][axis],
+            self._build(points[:middle], depth + 1),
+            self._build(points[middle:], depth + 1),
+        )
+
+    def nearest(self, latitude, longitude, k):
+        """The `k` nearest sites of a location, nearest first, with their distance in km"""
+
+        target = unit_vector(latitude, longitude)
+        x, y, z = target
+        # Max-heap of the best candidates so far, as (-squared chord, position)
+        best = []
+        # Every node with the squared distance from the target to its side
+        # of the splitting planes above it
+        stack = [(self.root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            # Only a side closer than the worst candidate can hold a nearer site
+            if len(best) == k and bound >= -best[0][0]:
+                continue
+            axis = node[0]
+            if axis is None:
+                for px, py, pz, position in node[1]:
+                    squared = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+                    if len(best) < k:
+                        heapq.heappush(best, (-squared, position))
+                    elif squared < -best[0][0]:
+                        heapq.heapreplace(best, (-squared, position))
+                continue
+
+            _, split, left, right = node
+            offset = target[axis] - split
+            near, far = (left, right) if offset < 0 else (right, left)
+            # The far side is pushed first, so it is visited once the near
+            # side has tightened the worst candidate
+            stack.append((far, max(bound, offset * offset)))
+            stack.append((near, bound))
+
+        return [
+            (self.sites[position], chord_to_km(math.sqrt(-squared)))
+            for squared, position in sorted(best, reverse=True)
+        ]
+
+
+# The nearest sites of a City network block
+nearest_cache = models.register_cache("nearest", NetworkCache(models.CACHE_SIZE))
+# Opened on the first nearest site lookup, see `nearest_sites`
+sites = FileIndex(SITES_FILE, SiteIndex.load, on_load=[nearest_cache.clear])
+
+
+def nearest_sites(ip, k):
+    """
+    The location of an address and the `k` nearest sites of the site list to
+    it, with their distance in km. An address without a location has no
+    nearest sites.
+    """
+
+    index = sites.current()
+    cached = nearest_cache.get(ip)
+    if cached is None:
+        # See `models.lookup_ip`
+        generation = nearest_cache.generation
+        database = models.field_plan("location").databases[0]
+        record, prefix_len = models.registry[database].record(ip)
+        location = models.SECTIONS["location"](record)
+        nearest = []
+        if "latitude" in location and "longitude" in location:
+            # Up to the largest `k`, so every request for the block is answered
+            nearest = [
+                {**site, "distance_km": round(distance, 1)}
+                for site, distance in index.nearest(
+                    location["latitude"],
+                    location["longitude"],
+                    models.NEAREST_MAX_SITES,
+                )
+            ]
+        cached = location, nearest
+        nearest_cache.put(
+            ipaddress.ip_network((ip, prefix_len), strict=False), cached, generation
+        )
+    location, nearest = cached
+    return {"ip_address": str(ip), "location": location, "sites": nearest[:k]}
+
+
+def try_nearest_sites(ip_address, k):
+    """
+    Find the nearest sites of an untrusted address, returning a status code,
+    the result and an error message. An invalid address is left for the
+    caller to count, a 422 response already is by `MetricsMiddleware`.
+    """
+
+    try:
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return 422, None, f"{ip_address} is not a valid IP address"
+
+    if models.known_missing(ip, models.field_plan("location")):
+        metrics.NOT_FOUND.inc()
+        return 404, None, models.not_found_message(ip_address)
+    # See `models.lookup_ip`
+    missing_generation = models.missing_cache.generation
+    try:
+        return 200, nearest_sites(ip, k), None
+    except RecordNotFoundError as exc:
+        models.missing_cache.put(exc.network, exc.database, missing_generation)
+        metrics.NOT_FOUND.inc()
+        return 404, None, models.not_found_message(ip_address)
@@ -0,0 +1,151 @@
+import numpy as np
+
+from .index import ENTRY, NO_RECORD, CompiledIndex
+
+IPV4_MASK = np.uint64(0xFFFFFFFF)
+ENTRY_DTYPE = np.dtype(
+    [("city", "<u4"), ("asn", "<u4"), ("city_prefix", "u1"), ("asn_prefix", "u1")]
+)
+assert ENTRY_DTYPE.itemsize == ENTRY.size
+
+# Column name, dtype, missing value and the path of the field in the record
+CITY_COLUMNS = (
+    ("country_iso_code", "U2", "", ("country", "iso_code")),
+    ("latitude", np.float64, np.nan, ("location", "latitude")),
+    ("longitude", np.float64, np.nan, ("location", "longitude")),
+    ("accuracy_radius", np.uint16, 0, ("location", "accuracy_radius")),
+)
+ASN_COLUMNS = (
+    ("autonomous_system_number", np.uint32, 0, ("autonomous_system_number",)),
+)
+
+
+def ipv6_keys(high, low):
+    """Pack the high and low 64 bits of IPv6 addresses into sortable 16-byte keys"""
+
+    packed = np.empty((len(high), 2), dtype=">u8")
+    packed[:, 0] = high
+    packed[:, 1] = low
+    return packed.view("S16").ravel()
+
+
+def _field(record, path):
+    for key in path:
+        record = record.get(key)
+        if record is None:
+            return None
+    return record
+
+
+def _columns(records, columns):
+    # The extra last row holds the missing values, for ranges without a record
+    result = {}
+    for name, dtype, missing, path in columns:
+        values = (_field(record, path) for record in records)
+        result[name] = np.array(
+            [missing if value is None else value for value in values] + [missing],
+            dtype=dtype,
+        )
+    return result
+
+
+class RangeIndex:
+    """
+    Columnar lookups of whole arrays of addresses in a compiled index.
+
+    The range starts and entries are used straight from the memory-mapped file
+    written by `index.build_index`. Addresses are resolved with `searchsorted`,
+    then the columns are gathered from per-record arrays that are decoded once
+    when the index is opened.
+
+    Missing values are "" for ISO codes, 0 for numbers and NaN for coordinates.
+    """
+
+    def __init__(self, index_path):
+        self.index = CompiledIndex(index_path)
+        count = self.index.count
+        self._starts = np.frombuffer(
+            self.index.buffer, dtype="S16", count=count, offset=self.index.starts_offset
+        )
+        self._entries = np.frombuffer(
+            self.index.buffer,
+            dtype=ENTRY_DTYPE,
+            count=count,
+            offset=self.index.entries_offset,
+        )
+
+        # IPv4 addresses of an IPv6 tree are the ranges starting in ::/96
+        ipv4_count = int(np.searchsorted(self._starts, (2**32).to_bytes(16, "big")))
+        words = self._starts[:ipv4_count].view(">u8").reshape(-1, 2)
+        self._ipv4_starts = words[:, 1].astype(np.uint64)
+
+        self._city_columns = _columns(self.index.pool("city"), CITY_COLUMNS)
+        self._asn_columns = _columns(self.index.pool("asn"), ASN_COLUMNS)
+
+    def close(self):
+        # The views into the mapped file must be released before it is unmapped
+        self._starts = self._entries = None
+        self.index.close()
+
+    def _gather(self, positions):
+        entries = self._entries[positions]
+        result = {}
+        for indexes, columns in (
+            (entries["city"], self._city_columns),
+            (entries["asn"], self._asn_columns),
+        ):
+            missing = len(next(iter(columns.values()))) - 1
+            indexes = np.where(indexes == NO_RECORD, missing, indexes)
+            for name, values in columns.items():
+                result[name] = values[indexes]
+        return result
+
+    def lookup_ipv4(self, addresses):
+        """Resolve an array of IPv4 addresses given as integers"""
+
+        addresses = np.asarray(addresses, dtype=np.uint64)
+        positions = np.searchsorted(self._ipv4_starts, addresses, side="right") - 1
+        return self._gather(positions)
+
+    def lookup_ipv6(self, high, low):
+        """Resolve an array of IPv6 addresses given as their high and low 64 bits"""
+
+        if self.index.bits == 32:
+            raise ValueError("IPv6 addresses cannot be looked up in an IPv4-only index")
+
+        high = np.asarray(high, dtype=np.uint64)
+        low = np.asarray(low, dtype=np.uint64)
+        keys = ipv6_keys(high, low)
+        positions = np.searchsorted(self._starts, keys, side="right") - 1
+
+        for network, prefix_len in self.index.aliases:
+            matches, embedded = self._alias(network, prefix_len, high, low)
+            if matches.any():
+                positions[matches] = (
+                    np.searchsorted(self._ipv4_starts, embedded[matches], side="right")
+                    - 1
+                )
+        return self._gather(positions)
+
+    @staticmethod
+    def _alias(network, prefix_len, high, low):
+        """Match addresses in an aliased network and extract their embedded IPv4 address"""
+
+        network_high = np.uint64(int(network.network_address) >> 64)
+        network_low = np.uint64(int(network.network_address) & (2**64 - 1))
+        if prefix_len <= 64:
+            shift = np.uint64(64 - prefix_len)
+            matches = (high >> shift) == (network_high >> shift)
+        else:
+            shift = np.uint64(128 - prefix_len)
+            matches = (high == network_high) & ((low >> shift) == (network_low >> shift))
+
+        # The IPv4 address is the 32 bits following the prefix
+        end = prefix_len + 32
+        if end <= 64:
+            embedded = high >> np.uint64(64 - end)
+        elif prefix_len >= 64:
+            embedded = low >> np.uint64(128 - end)
+        else:
+            embedded = (high << np.uint64(end - 64)) | (low >> np.uint64(128 - end))
+        return matches, embedded & IPV4_MASK
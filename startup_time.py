@@ -0,0 +1,93 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Runs in a fresh interpreter, the way a worker starts on a cold instance
+CHILD = """
+import asyncio
+import json
+import sys
+import time
+
+started = time.time()
+from src.main import app, readiness
+from src import health, models
+imported = time.time()
+
+
+async def first_lookup(address):
+    await app.router.startup()
+    while readiness.response is health.STARTING:
+        await asyncio.sleep(0.001)
+    warmed = time.time()
+    models.lookup_ip(address)
+    looked_up = time.time()
+    await app.router.shutdown()
+    return warmed, looked_up
+
+
+warmed, looked_up = asyncio.run(first_lookup(sys.argv[1]))
+print(json.dumps([started, imported, warmed, looked_up]))
+"""
+
+STAGES = ("interpreter", "import", "warm_up", "first_lookup", "total")
+
+
+def measure(address):
+    """Start a fresh interpreter and return the milliseconds spent in every stage"""
+
+    spawned = time.time()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, address],
+        cwd=BASE_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    started, imported, warmed, looked_up = json.loads(output.splitlines()[-1])
+    return {
+        "interpreter": (started - spawned) * 1000,
+        "import": (imported - started) * 1000,
+        "warm_up": (warmed - imported) * 1000,
+        "first_lookup": (looked_up - warmed) * 1000,
+        "total": (looked_up - spawned) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the import time of the app and the time to its first lookup"
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--address", default="8.8.8.8")
+    parser.add_argument(
+        "--import-budget-ms",
+        type=float,
+        help="Exit with an error when the median import time exceeds this budget",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the runs as JSON")
+    args = parser.parse_args()
+
+    runs = [measure(args.address) for _ in range(args.runs)]
+    if args.json:
+        print(json.dumps(runs))
+    else:
+        print(f"{'stage':<14}{'median ms':>12}{'max ms':>12}")
+        for stage in STAGES:
+            values = [run[stage] for run in runs]
+            print(
+                f"{stage:<14}{statistics.median(values):>12.1f}{max(values):>12.1f}"
+            )
+
+    median_import = statistics.median(run["import"] for run in runs)
+    if args.import_budget_ms is not None and median_import > args.import_budget_ms:
+        sys.exit(
+            f"Median import time {median_import:.1f}ms exceeds the budget "
+            f"of {args.import_budget_ms:.1f}ms"
+        )
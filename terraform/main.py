@@ -252,21 +252,22 @@ class DeployCloudRunStack(TerraformStack):
                     containers=[
                         CloudRunServiceTemplateSpecContainers(
                             image=getenv("CLOUDRUN_IMAGE_LATEST"),
-                            # startup_probe=CloudRunServiceTemplateSpecContainersStartupProbe(
-                            #     initial_delay_seconds=0,
-                            #     timeout_seconds=4,
-                            #     period_seconds=5,
-                            #     http_get=CloudRunServiceTemplateSpecContainersStartupProbeHttpGet(
-                            #         path="/healthz/",
-                            #         port=8080,
-                            #     ),
-                            # ),
+                            startup_probe=CloudRunServiceTemplateSpecContainersStartupProbe(
+                                initial_delay_seconds=0,
+                                timeout_seconds=1,
+                                period_seconds=1,
+                                failure_threshold=60,
+                                http_get=CloudRunServiceTemplateSpecContainersStartupProbeHttpGet(
+                                    path="/readyz/",
+                                    port=8080,
+                                ),
+                            ),
                             liveness_probe=CloudRunServiceTemplateSpecContainersLivenessProbe(
                                 initial_delay_seconds=5,
                                 period_seconds=1800,
                                 timeout_seconds=5,
                                 http_get=CloudRunServiceTemplateSpecContainersLivenessProbeHttpGet(
-                                    path="/healthz/",
+                                    path="/livez/",
                                     port=8080,
                                 ),
                             ),
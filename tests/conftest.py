@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from parse_env import getenv
+from synthetic_db import write_databases
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def pytest_configure(config):
+    # Runs before the test modules import src.models, which opens the databases
+    config.synthetic_db_dir = Path(tempfile.mkdtemp(prefix="geolocation-db-"))
+    write_databases(config.synthetic_db_dir)
+
+    db_dir = Path(getenv("GEOLOCATION_DB_DIR", str(BASE_DIR.joinpath("db"))))
+    if not all(
+        db_dir.joinpath(name).exists()
+        for name in ("GeoLite2-City.mmdb", "GeoLite2-ASN.mmdb")
+    ):
+        os.environ["GEOLOCATION_DB_DIR"] = str(config.synthetic_db_dir)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(config.synthetic_db_dir, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def synthetic_db(pytestconfig):
+    """Directory of the deterministic databases written by `synthetic_db.write_databases`"""
+
+    return pytestconfig.synthetic_db_dir
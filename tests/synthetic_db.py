@@ -0,0 +1,355 @@
+"""
+Small deterministic GeoLite2-like City and ASN databases.
+
+The files are written with a minimal MaxMind DB writer, so the tests and
+benchmarks run without downloading the real databases. The data is generated
+from a fixed seed and build epoch, which keeps benchmark baselines comparable
+between runs.
+"""
+
+import ipaddress
+import random
+import struct
+
+METADATA_START = b"\xab\xcd\xefMaxMind.com"
+DATA_SECTION_SEPARATOR = b"\x00" * 16
+BUILD_EPOCH = 1686700800
+
+# Type numbers of the MaxMind DB data section
+POINTER, UTF8_STRING, DOUBLE, BYTES, UINT16, UINT32, MAP = 1, 2, 3, 4, 5, 6, 7
+INT32, UINT64, UINT128, ARRAY, BOOLEAN = 8, 9, 10, 11, 14
+
+
+def _control(type_, size):
+    if type_ <= MAP:
+        first, extended = type_ << 5, b""
+    else:
+        first, extended = 0, bytes([type_ - 7])
+    if size < 29:
+        return bytes([first | size]) + extended
+    if size < 285:
+        return bytes([first | 29]) + extended + bytes([size - 29])
+    if size < 65821:
+        return bytes([first | 30]) + extended + (size - 285).to_bytes(2, "big")
+    return bytes([first | 31]) + extended + (size - 65821).to_bytes(3, "big")
+
+
+def _uint(type_, value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return _control(type_, len(data)) + data
+
+
+class Typed:
+    """An unsigned integer encoded with a given type, as the metadata requires"""
+
+    def __init__(self, type_, value):
+        self.type = type_
+        self.value = value
+
+
+def encode(value):
+    """Encode a value in the MaxMind DB data section format"""
+
+    if isinstance(value, Typed):
+        return _uint(value.type, value.value)
+    if isinstance(value, bool):
+        return _control(BOOLEAN, int(value))
+    if isinstance(value, str):
+        data = value.encode()
+        return _control(UTF8_STRING, len(data)) + data
+    if isinstance(value, float):
+        return _control(DOUBLE, 8) + struct.pack(">d", value)
+    if isinstance(value, int):
+        if value < 0:
+            return _control(INT32, 4) + struct.pack(">i", value)
+        for type_, limit in ((UINT16, 2**16), (UINT32, 2**32), (UINT64, 2**64)):
+            if value < limit:
+                return _uint(type_, value)
+        return _uint(UINT128, value)
+    if isinstance(value, dict):
+        return _control(MAP, len(value)) + b"".join(
+            encode(key) + encode(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return _control(ARRAY, len(value)) + b"".join(encode(item) for item in value)
+    raise TypeError(f"Cannot encode {type(value).__name__} values")
+
+
+class MMDBWriter:
+    """
+    Writes an IPv6 MaxMind DB file with IPv4 networks stored in ::/96.
+
+    Inserted networks must not overlap. `alias` points an IPv6 network at the
+    IPv4 subtree, like the ::ffff:0:0/96 and 2002::/16 networks of GeoLite2.
+    """
+
+    def __init__(self, database_type, record_size=28, build_epoch=BUILD_EPOCH):
+        self.database_type = database_type
+        self.record_size = record_size
+        self.build_epoch = build_epoch
+        # Each record is None, ("node", index) or ("data", offset)
+        self._nodes = [[None, None]]
+        self._data = bytearray()
+        self._offsets = {}
+
+    @staticmethod
+    def _key(network):
+        network = ipaddress.ip_network(network)
+        if network.version == 4:
+            return int(network.network_address), network.prefixlen + 96
+        return int(network.network_address), network.prefixlen
+
+    def _node(self, bits, depth):
+        """Return the node at `depth` on the path of `bits`, creating it if needed"""
+
+        node = 0
+        for position in range(depth):
+            bit = (bits >> (127 - position)) & 1
+            record = self._nodes[node][bit]
+            if record is None:
+                self._nodes.append([None, None])
+                record = self._nodes[node][bit] = ("node", len(self._nodes) - 1)
+            elif record[0] == "data":
+                raise ValueError("Inserted networks must not overlap")
+            node = record[1]
+        return node
+
+    def _store(self, record):
+        data = encode(record)
+        offset = self._offsets.get(data)
+        if offset is None:
+            offset = self._offsets[data] = len(self._data)
+            self._data += data
+        return offset
+
+    def insert(self, network, record):
+        bits, prefix_len = self._key(network)
+        parent = self._node(bits, prefix_len - 1)
+        bit = (bits >> (128 - prefix_len)) & 1
+        if self._nodes[parent][bit] is not None:
+            raise ValueError("Inserted networks must not overlap")
+        self._nodes[parent][bit] = ("data", self._store(record))
+
+    def alias(self, network):
+        ipv4_start = self._node(0, 96)
+        bits, prefix_len = self._key(network)
+        parent = self._node(bits, prefix_len - 1)
+        self._nodes[parent][(bits >> (128 - prefix_len)) & 1] = ("node", ipv4_start)
+
+    def _record_value(self, record):
+        node_count = len(self._nodes)
+        if record is None:
+            return node_count
+        kind, value = record
+        if kind == "node":
+            return value
+        return node_count + len(DATA_SECTION_SEPARATOR) + value
+
+    def _tree(self):
+        tree = bytearray()
+        for left, right in self._nodes:
+            left, right = self._record_value(left), self._record_value(right)
+            if self.record_size == 24:
+                tree += left.to_bytes(3, "big") + right.to_bytes(3, "big")
+            elif self.record_size == 28:
+                middle = ((left >> 24) << 4) | (right >> 24)
+                tree += (left & 0xFFFFFF).to_bytes(3, "big")
+                tree += bytes([middle]) + (right & 0xFFFFFF).to_bytes(3, "big")
+            else:
+                tree += left.to_bytes(4, "big") + right.to_bytes(4, "big")
+        return tree
+
+    def write(self, path):
+        metadata = {
+            "binary_format_major_version": Typed(UINT16, 2),
+            "binary_format_minor_version": Typed(UINT16, 0),
+            "build_epoch": Typed(UINT64, self.build_epoch),
+            "database_type": self.database_type,
+            "description": {"en": f"Synthetic {self.database_type} database"},
+            "ip_version": Typed(UINT16, 6),
+            "languages": ["en"],
+            "node_count": Typed(UINT32, len(self._nodes)),
+            "record_size": Typed(UINT16, self.record_size),
+        }
+        with open(path, "wb") as file:
+            file.write(self._tree())
+            file.write(DATA_SECTION_SEPARATOR)
+            file.write(self._data)
+            file.write(METADATA_START)
+            file.write(encode(metadata))
+
+
+CONTINENTS = {
+    "NA": (6255149, "North America"),
+    "EU": (6255148, "Europe"),
+    "AS": (6255147, "Asia"),
+    "SA": (6255150, "South America"),
+    "OC": (6255151, "Oceania"),
+}
+COUNTRIES = {
+    "US": (6252001, "United States", "NA", False),
+    "DE": (2921044, "Germany", "EU", True),
+    "GB": (2635167, "United Kingdom", "EU", False),
+    "FR": (3017382, "France", "EU", True),
+    "IN": (1269750, "India", "AS", False),
+    "JP": (1861060, "Japan", "AS", False),
+    "BR": (3469034, "Brazil", "SA", False),
+    "AU": (2077456, "Australia", "OC", False),
+}
+# Country, city, latitude, longitude, time zone and postal code
+CITIES = [
+    ("US", "Mountain View", 37.4043, -122.0748, "America/Los_Angeles", "94043"),
+    ("US", "San Francisco", 37.7642, -122.3993, "America/Los_Angeles", "94103"),
+    ("US", "Ashburn", 39.0469, -77.4903, "America/New_York", "20149"),
+    ("DE", "Berlin", 52.5196, 13.4069, "Europe/Berlin", "10178"),
+    ("DE", "Frankfurt am Main", 50.1188, 8.6843, "Europe/Berlin", "60313"),
+    ("GB", "London", 51.5164, -0.093, "Europe/London", "EC2V"),
+    ("FR", "Paris", 48.8582, 2.3387, "Europe/Paris", "75001"),
+    ("IN", "Mumbai", 19.0748, 72.8856, "Asia/Kolkata", "400070"),
+    ("JP", "Tokyo", 35.6893, 139.6899, "Asia/Tokyo", "151-0053"),
+    ("BR", "Sao Paulo", -23.5335, -46.6359, "America/Sao_Paulo", "01323"),
+    ("AU", "Sydney", -33.8715, 151.2006, "Australia/Sydney", "2000"),
+]
+ASNS = [
+    (15169, "GOOGLE"),
+    (13414, "TWITTER"),
+    (20712, "Andrews & Arnold Ltd"),
+    (16509, "AMAZON-02"),
+    (8075, "MICROSOFT-CORP-MSN-AS-BLOCK"),
+    (3320, "Deutsche Telekom AG"),
+    (2856, "British Telecommunications PLC"),
+    (3215, "Orange S.A."),
+    (9498, "BHARTI Airtel Ltd."),
+    (2516, "KDDI CORPORATION"),
+    (28573, "Claro NXT Telecomunicacoes Ltda"),
+    (1221, "Telstra Corporation Ltd"),
+]
+
+# Networks the endpoint tests look up, as (network, city index, asn index)
+FIXED_NETWORKS = [
+    ("8.8.8.0/24", 0, 0),
+    ("104.244.42.0/24", 1, 1),
+    ("81.2.69.0/24", 3, 2),
+    ("2001:4860::/32", 0, 0),
+]
+ANONYMOUS_NETWORKS = [
+    ("104.244.42.0/24", {"is_anonymous": True, "is_hosting_provider": True}),
+    ("81.2.69.0/25", {"is_anonymous": True, "is_tor_exit_node": True}),
+]
+GENERATED_BLOCKS = 3000
+EXCLUDED_FIRST_OCTETS = {0, 8, 10, 81, 104, 127} | set(range(224, 256))
+
+
+def _names(name):
+    return {"de": name, "en": name, "fr": name, "ja": name}
+
+
+def city_record(index, rng=None):
+    iso_code, name, latitude, longitude, time_zone, postal_code = CITIES[index]
+    country_geoname_id, country_name, continent_code, in_eu = COUNTRIES[iso_code]
+    continent_geoname_id, continent_name = CONTINENTS[continent_code]
+    country = {
+        "geoname_id": country_geoname_id,
+        "iso_code": iso_code,
+        "names": _names(country_name),
+    }
+    if in_eu:
+        country["is_in_european_union"] = True
+    accuracy_radius = 1000 if rng is None else rng.choice((5, 20, 50, 100, 200, 1000))
+    return {
+        "city": {"geoname_id": 5375480 + index, "names": _names(name)},
+        "continent": {
+            "code": continent_code,
+            "geoname_id": continent_geoname_id,
+            "names": _names(continent_name),
+        },
+        "country": country,
+        "location": {
+            "accuracy_radius": accuracy_radius,
+            "latitude": latitude,
+            "longitude": longitude,
+            "time_zone": time_zone,
+        },
+        "postal": {"code": postal_code},
+        "registered_country": dict(country),
+    }
+
+
+def country_record(city):
+    """The part of a City record a GeoLite2-Country database has"""
+
+    return {
+        key: city[key] for key in ("continent", "country", "registered_country")
+    }
+
+
+def asn_record(index):
+    number, organization = ASNS[index]
+    return {
+        "autonomous_system_number": number,
+        "autonomous_system_organization": organization,
+    }
+
+
+def _generated_blocks(seed):
+    """Yield distinct public /16 blocks with a City prefix length and ASN indexes"""
+
+    rng = random.Random(seed)
+    candidates = [
+        (first, second)
+        for first in range(256)
+        if first not in EXCLUDED_FIRST_OCTETS
+        for second in range(256)
+        if (first, second) not in ((172, 16), (192, 168))
+    ]
+    for first, second in sorted(rng.sample(candidates, GENERATED_BLOCKS)):
+        yield first, second, rng.randint(16, 24), rng, rng.randrange(len(ASNS))
+
+
+def write_databases(directory, seed=0, build_epoch=BUILD_EPOCH):
+    """
+    Write GeoLite2-City.mmdb and GeoLite2-ASN.mmdb to `directory`, with a
+    GeoLite2-Country.mmdb of the same networks and a GeoIP2-Anonymous-IP.mmdb.
+
+    Generated blocks are split into different networks in each database, and
+    every tenth block is missing from the ASN database.
+    """
+
+    city = MMDBWriter("GeoLite2-City", record_size=28, build_epoch=build_epoch)
+    country = MMDBWriter("GeoLite2-Country", record_size=24, build_epoch=build_epoch)
+    asn = MMDBWriter("GeoLite2-ASN", record_size=24, build_epoch=build_epoch)
+    anonymous_ip = MMDBWriter(
+        "GeoIP2-Anonymous-IP", record_size=24, build_epoch=build_epoch
+    )
+    for network, city_index, asn_index in FIXED_NETWORKS:
+        city.insert(network, city_record(city_index))
+        country.insert(network, country_record(city_record(city_index)))
+        asn.insert(network, asn_record(asn_index))
+    for network, record in ANONYMOUS_NETWORKS:
+        anonymous_ip.insert(network, record)
+
+    for count, (first, second, prefix_len, rng, asn_index) in enumerate(
+        _generated_blocks(seed)
+    ):
+        # The City database covers the start of the block with a smaller network
+        network = ipaddress.IPv4Network((f"{first}.{second}.0.0", prefix_len))
+        record = city_record(rng.randrange(len(CITIES)), rng)
+        city.insert(network, record)
+        country.insert(network, country_record(record))
+        if count % 10:
+            asn.insert(
+                ipaddress.IPv4Network((f"{first}.{second}.0.0", 16)),
+                asn_record(asn_index),
+            )
+
+    for writer in (city, country, asn, anonymous_ip):
+        writer.alias("::ffff:0:0/96")
+        writer.alias("2002::/16")
+
+    city_path = directory.joinpath("GeoLite2-City.mmdb")
+    asn_path = directory.joinpath("GeoLite2-ASN.mmdb")
+    city.write(city_path)
+    asn.write(asn_path)
+    country.write(directory.joinpath("GeoLite2-Country.mmdb"))
+    anonymous_ip.write(directory.joinpath("GeoIP2-Anonymous-IP.mmdb"))
+    return city_path, asn_path
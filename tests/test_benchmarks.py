@@ -0,0 +1,569 @@
+import asyncio
+import heapq
+import ipaddress
+import itertools
+import json
+import math
+import random
+import time
+
+import httpx
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from geoip2.errors import AddressNotFoundError
+
+from parse_env import getenv
+from src import binary, distances, main, metrics, models, sites
+from src.cache import NetworkCache
+from src.databases import READER_MODES, FileIndex, MMDBReaderSet
+from src.geo import Geofence, distance_km
+from src.index import IndexReaderSet, build_index
+from src.networks import NetworkIndex
+from src.registry import DatabaseRegistry, parse_databases
+from src.sites import SiteIndex, unit_vector
+from src.vectorized import RangeIndex
+from src.main import app
+
+BASE_URL = getenv("FASTAPI_CORS_ORIGINS").split(" ")[0]
+
+client = TestClient(app, base_url=BASE_URL)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def synthetic_databases(synthetic_db):
+    """
+    Serve every benchmark from the synthetic databases, whatever is in the
+    database directory, so saved baselines stay comparable between builds
+    """
+
+    city_path = synthetic_db.joinpath("GeoLite2-City.mmdb")
+    asn_path = synthetic_db.joinpath("GeoLite2-ASN.mmdb")
+    readers = MMDBReaderSet(city_path, asn_path, mode=models.READER_MODE)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(models, "CITY_DB_PATH", city_path)
+        monkeypatch.setattr(models, "ASN_DB_PATH", asn_path)
+        monkeypatch.setattr(models.databases, "current", readers)
+        models.result_cache.clear()
+        models.json_cache.clear()
+        yield
+    models.result_cache.clear()
+    models.json_cache.clear()
+    readers.close()
+
+
+# 10k addresses with the repetition typical of access logs
+IP_ADDRESSES = [
+    f"{prefix}.{i % 256}"
+    for i in range(5000)
+    for prefix in ("8.8.8", "104.244.42")
+]
+
+
+@pytest.mark.benchmark(group="lookup-10k")
+def test_single_lookup_throughput(benchmark):
+    def lookup_each():
+        for ip_address in IP_ADDRESSES:
+            client.post("/", json={"ip_address": ip_address})
+
+    benchmark.pedantic(lookup_each, rounds=1, iterations=1)
+
+
+@pytest.mark.benchmark(group="lookup-10k")
+def test_batch_lookup_throughput(benchmark):
+    def lookup_batch():
+        response = client.post("/batch", json={"ip_addresses": IP_ADDRESSES})
+        assert response.status_code == 200
+
+    benchmark.pedantic(lookup_batch, rounds=5, iterations=1)
+
+
+@pytest.mark.benchmark(group="lookup-ip")
+def test_lookup_ip_cached(benchmark):
+    benchmark(models.lookup_ip, "8.8.8.8")
+
+
+@pytest.mark.benchmark(group="lookup-ip")
+def test_lookup_ip_uncached(benchmark, monkeypatch):
+    monkeypatch.setattr(models, "result_cache", NetworkCache(0))
+    benchmark(models.lookup_ip, "8.8.8.8")
+
+
+@pytest.mark.benchmark(group="lookup-response")
+def test_model_response(benchmark):
+    benchmark(client.post, "/", json={"ip_address": "8.8.8.8"})
+
+
+@pytest.mark.benchmark(group="lookup-response")
+def test_fast_response(benchmark, monkeypatch):
+    monkeypatch.setattr(models, "FAST_RESPONSE", True)
+    benchmark(client.post, "/", json={"ip_address": "8.8.8.8"})
+
+
+@pytest.mark.benchmark(group="lookup-encode")
+def test_model_encode(benchmark):
+    benchmark(lambda: models.lookup_ip("8.8.8.8").json(exclude_none=True))
+
+
+@pytest.mark.benchmark(group="lookup-encode")
+def test_fast_encode(benchmark):
+    benchmark(models.lookup_ip_json, "8.8.8.8")
+
+
+def benchmark_not_found(benchmark):
+    benchmark(models.try_lookup_ip, "192.168.1.2")
+
+
+@pytest.mark.benchmark(group="not-found")
+def test_not_found_lookup(benchmark, monkeypatch):
+    monkeypatch.setattr(models, "reserved_networks", models.NetworkSet(()))
+    monkeypatch.setattr(models, "missing_cache", NetworkCache(0))
+    benchmark_not_found(benchmark)
+
+
+@pytest.mark.benchmark(group="not-found")
+def test_not_found_rejected(benchmark):
+    benchmark_not_found(benchmark)
+
+
+@pytest.mark.benchmark(group="field-selection")
+def test_all_fields(benchmark, monkeypatch):
+    monkeypatch.setattr(models, "json_cache", NetworkCache(0))
+    benchmark(models.lookup_ip_json, "8.8.8.8")
+
+
+@pytest.mark.benchmark(group="field-selection")
+@pytest.mark.parametrize(
+    "fields", ["country.iso_code", "country,asn.autonomous_system_number"]
+)
+def test_selected_fields(benchmark, fields):
+    benchmark(models.lookup_ip_fields, "8.8.8.8", models.field_plan(fields))
+
+
+@pytest.mark.benchmark(group="field-selection")
+def test_selected_fields_from_country_database(benchmark, monkeypatch, synthetic_db):
+    registry = DatabaseRegistry(
+        models.databases, parse_databases("country", synthetic_db)
+    )
+    monkeypatch.setattr(models, "registry", registry)
+    models.field_plan.cache_clear()
+    plan = models.field_plan("country.iso_code")
+    models.field_plan.cache_clear()
+    assert plan.databases == ("country",)
+    benchmark(models.lookup_ip_fields, "8.8.8.8", plan)
+    registry.close()
+
+
+ASGI_REQUESTS = 500
+
+
+def benchmark_asgi(benchmark, send, status_code=200):
+    """Benchmark concurrent requests sent to the app in-process, without a server"""
+
+    async def send_all():
+        async with httpx.AsyncClient(app=app, base_url=BASE_URL) as asgi_client:
+            responses = await asyncio.gather(
+                *(send(asgi_client) for _ in range(ASGI_REQUESTS))
+            )
+        assert all(response.status_code == status_code for response in responses)
+
+    loop = asyncio.new_event_loop()
+    benchmark.extra_info["requests"] = ASGI_REQUESTS
+    benchmark.pedantic(lambda: loop.run_until_complete(send_all()), rounds=5)
+    loop.close()
+
+
+@pytest.mark.benchmark(group="asgi-throughput")
+def test_asgi_lookup_throughput(benchmark):
+    benchmark_asgi(
+        benchmark,
+        lambda asgi_client: asgi_client.post("/", json={"ip_address": "8.8.8.8"}),
+    )
+
+
+@pytest.mark.benchmark(group="asgi-throughput")
+@pytest.mark.parametrize("revalidate", [False, True], ids=["lookup", "not-modified"])
+def test_asgi_get_lookup_throughput(benchmark, revalidate):
+    headers = {}
+    if revalidate:
+        headers["If-None-Match"] = client.get("/ip/8.8.8.8").headers["etag"]
+    benchmark_asgi(
+        benchmark,
+        lambda asgi_client: asgi_client.get("/ip/8.8.8.8", headers=headers),
+        status_code=304 if revalidate else 200,
+    )
+
+
+@pytest.mark.benchmark(group="asgi-throughput")
+@pytest.mark.parametrize("path", ["/livez/", "/readyz/"])
+def test_asgi_probe_throughput(benchmark, path, monkeypatch):
+    # The in-process client runs no startup hooks, check readiness once instead
+    monkeypatch.setattr(main.readiness, "response", main.readiness.check())
+    benchmark_asgi(benchmark, lambda asgi_client: asgi_client.get(path))
+
+
+@pytest.mark.benchmark(group="asgi-throughput")
+def test_websocket_lookup_throughput(benchmark):
+    message = json.dumps({"id": 1, "ip": "8.8.8.8"})
+
+    def send_all():
+        for _ in range(ASGI_REQUESTS):
+            websocket.send_text(message)
+        for _ in range(ASGI_REQUESTS):
+            websocket.receive_text()
+
+    benchmark.extra_info["requests"] = ASGI_REQUESTS
+    with client.websocket_connect("/ws") as websocket:
+        benchmark.pedantic(send_all, rounds=5)
+
+
+@pytest.mark.benchmark(group="metrics-overhead")
+@pytest.mark.parametrize("enabled", [False, True], ids=["disabled", "enabled"])
+def test_metrics_overhead(benchmark, enabled, tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", enabled)
+    monkeypatch.setattr(metrics, "registry", metrics.Registry(tmp_path))
+    benchmark_asgi(
+        benchmark,
+        lambda asgi_client: asgi_client.post("/", json={"ip_address": "8.8.8.8"}),
+    )
+
+
+# Random public and private addresses, so lookups touch the whole database
+RANDOM_IP_ADDRESSES = [
+    ipaddress.IPv4Address(random.Random(seed).getrandbits(32)) for seed in range(20000)
+]
+
+
+PROTOCOL_BATCH = RANDOM_IP_ADDRESSES[:1000]
+
+
+@pytest.mark.benchmark(group="batch-protocol")
+@pytest.mark.parametrize("protocol", ["json", "binary"])
+def test_batch_protocol(benchmark, protocol):
+    """Round trips of a batch, including the encoding and decoding on the client side"""
+
+    if protocol == "json":
+
+        def round_trip():
+            ip_addresses = [str(ip_address) for ip_address in PROTOCOL_BATCH]
+            response = client.post("/batch", json={"ip_addresses": ip_addresses})
+            response.json()
+            return response
+
+    else:
+
+        def round_trip():
+            content = b"".join(
+                bytes([ip_address.version]) + ip_address.packed
+                for ip_address in PROTOCOL_BATCH
+            )
+            response = client.post(
+                "/batch", content=content, headers={"Content-Type": binary.CONTENT_TYPE}
+            )
+            binary.decode_records(response.content)
+            return response
+
+    response = benchmark(round_trip)
+    assert response.status_code == 200
+    benchmark.extra_info["request_bytes"] = len(response.request.content)
+    benchmark.extra_info["response_bytes"] = len(response.content)
+
+
+@pytest.fixture(scope="module")
+def aggregate_addresses():
+    """10,000 addresses that are in the databases, as dashboards mostly send"""
+
+    rng = random.Random(0)
+    ip_addresses = []
+    with models.databases.acquire() as readers:
+        while len(ip_addresses) < 10000:
+            ip_address = ipaddress.IPv4Address(rng.getrandbits(32))
+            try:
+                readers.records(ip_address)
+            except AddressNotFoundError:
+                continue
+            ip_addresses.append(str(ip_address))
+    return ip_addresses
+
+
+@pytest.mark.benchmark(group="aggregate")
+@pytest.mark.parametrize("approach", ["per-ip", "aggregate"])
+def test_aggregate(benchmark, approach, aggregate_addresses):
+    """Counts by country and ASN, reduced on the client or on the server"""
+
+    if approach == "per-ip":
+
+        def count():
+            response = client.post(
+                "/batch", json={"ip_addresses": aggregate_addresses}
+            )
+            counts = {"country": {}, "asn": {}}
+            for item in response.json():
+                if item["status"] == 200:
+                    country = item["result"]["country"].get("iso_code")
+                    asn = item["result"]["asn"].get("autonomous_system_number")
+                    counts["country"][country] = counts["country"].get(country, 0) + 1
+                    counts["asn"][asn] = counts["asn"].get(asn, 0) + 1
+            return response
+
+    else:
+
+        def count():
+            response = client.post(
+                "/aggregate",
+                json={"ip_addresses": aggregate_addresses, "by": ["country", "asn"]},
+            )
+            response.json()
+            return response
+
+    response = benchmark(count)
+    assert response.status_code == 200
+    benchmark.extra_info["response_bytes"] = len(response.content)
+
+
+NEAREST_SITES = [
+    {
+        "id": f"site-{position}",
+        "latitude": math.degrees(math.asin(random.Random(position).uniform(-1, 1))),
+        "longitude": random.Random(-position - 1).uniform(-180, 180),
+    }
+    for position in range(300)
+]
+
+
+@pytest.mark.benchmark(group="nearest-sites")
+@pytest.mark.parametrize("approach", ["index", "brute-force"])
+def test_nearest_sites(benchmark, approach):
+    """The 3 nearest of 300 sites to random locations"""
+
+    rng = random.Random(0)
+    locations = itertools.cycle(
+        [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(1000)]
+    )
+    if approach == "index":
+        index = SiteIndex(NEAREST_SITES)
+
+        def nearest():
+            return index.nearest(*next(locations), 3)
+
+    else:
+        points = [
+            (unit_vector(site["latitude"], site["longitude"]), site)
+            for site in NEAREST_SITES
+        ]
+
+        def nearest():
+            target = unit_vector(*next(locations))
+            return heapq.nsmallest(
+                3, points, key=lambda item: math.dist(target, item[0])
+            )
+
+    benchmark(nearest)
+
+
+@pytest.mark.benchmark(group="nearest-sites")
+def test_nearest_sites_memo(benchmark, monkeypatch, tmp_path):
+    path = tmp_path.joinpath("sites.json")
+    path.write_text(json.dumps(NEAREST_SITES))
+    monkeypatch.setattr(sites, "sites", FileIndex(path, SiteIndex.load))
+    # Every lookup after the first is answered from the per-network memo
+    status, _, _ = benchmark(sites.try_nearest_sites, "8.8.8.8", 3)
+    assert status == 200
+
+
+@pytest.fixture(scope="module")
+def index_path(tmp_path_factory, synthetic_databases):
+    index_path = tmp_path_factory.mktemp("index").joinpath("GeoLite2-City-ASN.idx")
+    build_index(models.CITY_DB_PATH, models.ASN_DB_PATH, index_path)
+    return index_path
+
+
+def rss_kib(field="VmRSS"):
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+
+
+def benchmark_engine(benchmark, open_readers):
+    """
+    Benchmark lookups of random addresses, after a first pass over them that
+    records the growth of the RSS, of its private part and the p99 latency
+    """
+
+    rss = rss_kib()
+    rss_anon = rss_kib("RssAnon")
+    readers = open_readers()
+
+    def lookup(ip_address):
+        try:
+            readers.records(ip_address)
+        except AddressNotFoundError:
+            pass
+
+    latencies = []
+    for ip_address in RANDOM_IP_ADDRESSES:
+        started = time.perf_counter_ns()
+        lookup(ip_address)
+        latencies.append(time.perf_counter_ns() - started)
+    benchmark.extra_info["rss_kib"] = rss_kib() - rss
+    benchmark.extra_info["rss_anon_kib"] = rss_kib("RssAnon") - rss_anon
+    latencies.sort()
+    benchmark.extra_info["p99_us"] = latencies[len(latencies) * 99 // 100] / 1000
+
+    ip_addresses = itertools.cycle(RANDOM_IP_ADDRESSES)
+    benchmark(lambda: lookup(next(ip_addresses)))
+    readers.close()
+
+
+@pytest.mark.benchmark(group="lookup-engine")
+def test_mmdb_readers_engine(benchmark):
+    benchmark_engine(
+        benchmark,
+        lambda: MMDBReaderSet(models.CITY_DB_PATH, models.ASN_DB_PATH, mode=1),
+    )
+
+
+@pytest.mark.benchmark(group="lookup-engine")
+def test_index_engine(benchmark, index_path):
+    benchmark_engine(benchmark, lambda: IndexReaderSet(index_path))
+
+
+@pytest.mark.benchmark(group="reader-mode")
+@pytest.mark.parametrize("mode", READER_MODES)
+def test_reader_mode(benchmark, mode):
+    benchmark_engine(
+        benchmark,
+        lambda: MMDBReaderSet(
+            models.CITY_DB_PATH, models.ASN_DB_PATH, mode=READER_MODES[mode]
+        ),
+    )
+
+
+BULK_IP_ADDRESSES = np.random.default_rng(0).integers(0, 2**32, 100_000, np.uint32)
+
+
+@pytest.mark.benchmark(group="network-index")
+def test_network_index_build(benchmark):
+    index = benchmark.pedantic(
+        NetworkIndex.build, (models.CITY_DB_PATH, models.ASN_DB_PATH), rounds=3
+    )
+    benchmark.extra_info.update(index.stats())
+
+
+@pytest.mark.benchmark(group="bulk-100k")
+def test_bulk_loop_lookup(benchmark):
+    readers = MMDBReaderSet(models.CITY_DB_PATH, models.ASN_DB_PATH, mode=1)
+
+    def lookup_each():
+        for address in BULK_IP_ADDRESSES.tolist():
+            ip_address = ipaddress.IPv4Address(address)
+            readers.city_reader.get(ip_address)
+            readers.asn_reader.get(ip_address)
+
+    benchmark.pedantic(lookup_each, rounds=3, iterations=1)
+    readers.close()
+
+
+@pytest.mark.benchmark(group="bulk-100k")
+def test_bulk_vectorized_lookup(benchmark, index_path):
+    range_index = RangeIndex(index_path)
+    benchmark(range_index.lookup_ipv4, BULK_IP_ADDRESSES)
+    range_index.close()
+
+
+# A 64-sided polygon of about 1500 km around Kansas
+GEOFENCE_RING = [
+    [
+        -98 + 20 * math.cos(2 * math.pi * step / 64),
+        39 + 13 * math.sin(2 * math.pi * step / 64),
+    ]
+    for step in range(64)
+]
+GEOFENCE = Geofence("us", [[GEOFENCE_RING]])
+
+
+def bulk_locations(index_path):
+    """The locations of the located bulk addresses, repeated up to 100,000 rows"""
+
+    range_index = RangeIndex(index_path)
+    columns = range_index.lookup_ipv4(BULK_IP_ADDRESSES)
+    range_index.close()
+    located = np.flatnonzero(np.isfinite(columns["latitude"]))
+    rows = np.resize(located, len(BULK_IP_ADDRESSES))
+    radii = columns["accuracy_radius"][rows].astype(np.float64)
+    return columns["latitude"][rows], columns["longitude"][rows], radii
+
+
+def contains_scalar(latitude, longitude):
+    inside = False
+    for x1, y1, x2, y2 in GEOFENCE.edges.tolist():
+        if (y1 > latitude) != (y2 > latitude):
+            if longitude < x1 + (latitude - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+    return inside
+
+
+@pytest.mark.benchmark(group="distance-100k")
+@pytest.mark.parametrize("approach", ["loop", "vectorized"])
+def test_distance_and_geofence(benchmark, index_path, approach):
+    """Distances to one point and a 64-sided geofence for 100,000 located rows"""
+
+    latitudes, longitudes, radii = bulk_locations(index_path)
+    if approach == "vectorized":
+
+        def compute():
+            distance = distance_km(latitudes, longitudes, 50.11, 8.68)
+            return distance, GEOFENCE.classify(latitudes, longitudes, radii)
+
+    else:
+        rows = list(zip(latitudes.tolist(), longitudes.tolist()))
+
+        def compute():
+            results = []
+            for latitude, longitude in rows:
+                phi1, phi2 = math.radians(latitude), math.radians(50.11)
+                a = (
+                    math.sin((phi2 - phi1) / 2) ** 2
+                    + math.cos(phi1)
+                    * math.cos(phi2)
+                    * math.sin(math.radians(8.68 - longitude) / 2) ** 2
+                )
+                distance = 2 * 6371.0088 * math.asin(math.sqrt(a))
+                results.append((distance, contains_scalar(latitude, longitude)))
+            return results
+
+    benchmark.pedantic(compute, rounds=3, iterations=1)
+    benchmark.extra_info["rows"] = len(BULK_IP_ADDRESSES)
+
+
+@pytest.mark.benchmark(group="distance-100k")
+@pytest.mark.parametrize("engine", ["readers", "index"])
+def test_distance_batch(benchmark, monkeypatch, tmp_path, index_path, engine):
+    """`POST /distance` of 100,000 addresses with a point and a geofence in process"""
+
+    monkeypatch.setattr(models, "LOOKUP_ENGINE", engine)
+    monkeypatch.setattr(models, "INDEX_PATH", index_path)
+    monkeypatch.setattr(models, "_range_index", None)
+    monkeypatch.setattr(distances, "location_cache", NetworkCache(models.CACHE_SIZE))
+    path = tmp_path.joinpath("geofences.json")
+    feature = {
+        "id": "us",
+        "geometry": {"type": "Polygon", "coordinates": [GEOFENCE_RING]},
+    }
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [feature]}))
+    monkeypatch.setattr(
+        distances, "geofences", FileIndex(path, distances.load_geofences)
+    )
+    request = models.DistanceRequest(
+        ip_addresses=[
+            str(ipaddress.IPv4Address(address))
+            for address in BULK_IP_ADDRESSES.tolist()
+        ],
+        latitudes=[50.11],
+        longitudes=[8.68],
+        max_distance_km=1000,
+        geofences=["us"],
+    )
+    benchmark.pedantic(distances.distances, (request,), rounds=3, iterations=1)
+    benchmark.extra_info["rows"] = len(BULK_IP_ADDRESSES)
@@ -0,0 +1,42 @@
+from ipaddress import ip_address, ip_network
+
+from src.cache import NetworkCache
+
+
+def test_cache_hit_within_network():
+    cache = NetworkCache(maxsize=8)
+    cache.put(ip_network("8.8.8.0/24"), "google")
+    cache.put(ip_network("2001:4860::/32"), "google-v6")
+
+    assert cache.get(ip_address("8.8.8.200")) == "google"
+    assert cache.get(ip_address("2001:4860::8888")) == "google-v6"
+    assert cache.get(ip_address("8.8.9.1")) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cache_lru_eviction():
+    cache = NetworkCache(maxsize=2)
+    cache.put(ip_network("10.0.0.0/8"), "a")
+    cache.put(ip_network("172.16.0.0/12"), "b")
+    cache.get(ip_address("10.1.2.3"))
+    cache.put(ip_network("192.168.0.0/16"), "c")
+
+    assert cache.get(ip_address("172.16.0.1")) is None
+    assert cache.get(ip_address("10.1.2.3")) == "a"
+    assert cache.get(ip_address("192.168.1.1")) == "c"
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_cache_evicts_overlapping_blocks():
+    cache = NetworkCache(maxsize=8)
+    for network in ("10.0.0.0/8", "8.8.8.0/24", "8.8.4.0/24", "2001:4860::/32"):
+        cache.put(ip_network(network), network)
+
+    changed = [ip_network("8.8.8.128/25"), ip_network("10.0.0.0/7")]
+    assert cache.evict(changed) == 2
+    assert cache.get(ip_address("8.8.8.1")) is None
+    assert cache.get(ip_address("10.1.2.3")) is None
+    assert cache.get(ip_address("8.8.4.4")) == "8.8.4.0/24"
+    assert cache.get(ip_address("2001:4860::1")) == "2001:4860::/32"
+    assert len(cache) == 2
@@ -0,0 +1,163 @@
+import asyncio
+import os
+import shutil
+from functools import partial
+
+import pytest
+
+from src import models
+from src.databases import READER_MODES, DatabaseManager, MMDBReaderSet, reader_mode
+
+
+@pytest.fixture
+def manager(tmp_path):
+    city_path = shutil.copy(models.CITY_DB_PATH, tmp_path)
+    asn_path = shutil.copy(models.ASN_DB_PATH, tmp_path)
+    reloaded = []
+    manager = DatabaseManager(
+        partial(MMDBReaderSet, city_path, asn_path),
+        paths=(city_path, asn_path),
+        on_reload=[lambda: reloaded.append(True)],
+    )
+    manager.reloaded = reloaded
+    return manager
+
+
+def test_readers_are_opened_on_first_use(manager):
+    assert not manager.is_open and not manager.changed()
+    with manager.acquire() as readers:
+        readers.lookup("8.8.8.8")
+    assert manager.is_open and manager.loaded_at is not None
+    assert manager.open() is readers
+
+
+def test_reload_swaps_readers_after_in_flight_lookups(manager):
+    with manager.acquire() as readers:
+        assert asyncio.run(manager.reload())
+        assert manager.current is not readers
+        assert readers.retired and not readers.closed
+        readers.lookup("8.8.8.8")
+
+    assert readers.closed
+    assert manager.reloads == 1
+    assert manager.reloaded == [True]
+    assert manager.last_reload_duration is not None
+
+
+def test_first_reload_only_opens_the_files(manager):
+    assert asyncio.run(manager.reload())
+    assert manager.is_open
+    assert manager.reloads == 0
+    assert manager.reloaded == []
+
+
+def test_failing_reload_callbacks_are_logged(manager, caplog):
+    def fail():
+        raise RuntimeError("callback failed")
+
+    blocking = []
+    manager.on_reload.insert(0, fail)
+    manager.on_reload_blocking = [fail, lambda: blocking.append(True)]
+    manager.open()
+    assert asyncio.run(manager.reload())
+    assert manager.reloaded == [True] and blocking == [True]
+    failed = [record for record in caplog.records if record.exc_info]
+    assert len(failed) == 2
+    manager.current.retire()
+
+
+def test_watch_survives_a_failing_reload(manager, monkeypatch):
+    checks = []
+
+    def changed():
+        checks.append(True)
+        if len(checks) == 1:
+            raise OSError("stat failed")
+        return False
+
+    async def watch():
+        task = asyncio.create_task(manager.watch(0))
+        while len(checks) < 2:
+            await asyncio.sleep(0)
+        task.cancel()
+
+    monkeypatch.setattr(manager, "changed", changed)
+    asyncio.run(watch())
+    assert len(checks) >= 2
+
+
+def test_acquire_skips_readers_closed_by_a_swap(manager):
+    readers = manager.current
+    # A lookup in the threadpool read the set just before the swap closed it
+    manager.current = readers
+    asyncio.run(manager.reload())
+    assert readers.closed and not readers.hold()
+    with manager.acquire() as current:
+        assert current is not readers
+        current.lookup("8.8.8.8")
+    assert current.in_flight == 0
+
+
+def test_reload_keeps_readers_when_files_are_invalid(manager, tmp_path):
+    readers = manager.current
+    # Replace the file like geoipupdate does, writing over a mapped file would crash
+    invalid_path = tmp_path.joinpath("invalid.mmdb")
+    invalid_path.write_bytes(b"not a database")
+    os.replace(invalid_path, manager.paths[0])
+
+    assert manager.changed()
+    assert not asyncio.run(manager.reload())
+    assert manager.current is readers
+    assert manager.last_reload_error
+    assert manager.reloaded == []
+
+
+@pytest.mark.parametrize(
+    "lookup, cache", [("lookup_ip", "result_cache"), ("lookup_ip_json", "json_cache")]
+)
+def test_reload_during_a_lookup_drops_its_result(manager, monkeypatch, lookup, cache):
+    manager.on_reload.append(models.invalidate_caches)
+    monkeypatch.setattr(models, "databases", manager)
+    for name in (
+        "result_cache",
+        "json_cache",
+        "binary_cache",
+        "missing_cache",
+    ):
+        monkeypatch.setattr(models, name, models.NetworkCache(8))
+    readers = manager.open()
+    records = readers.records
+
+    # A lookup in the threadpool read the previous build while the event
+    # loop swapped in the next one and invalidated the caches
+    def records_and_reload(ip_address):
+        found = records(ip_address)
+        assert asyncio.run(manager.reload())
+        return found
+
+    monkeypatch.setattr(readers, "records", records_and_reload)
+    getattr(models, lookup)("8.8.8.8")
+    assert len(getattr(models, cache)) == 0
+
+    getattr(models, lookup)("8.8.8.8")
+    assert len(getattr(models, cache)) == 1
+    manager.current.retire()
+
+
+@pytest.mark.parametrize("mode", READER_MODES)
+def test_reader_modes_return_the_same_records(mode):
+    readers = MMDBReaderSet(
+        models.CITY_DB_PATH, models.ASN_DB_PATH, mode=reader_mode(mode)
+    )
+    with models.databases.acquire() as current:
+        assert readers.records("8.8.8.8") == current.records("8.8.8.8")
+    readers.close()
+
+
+def test_unknown_reader_mode():
+    with pytest.raises(ValueError):
+        reader_mode("mmap-ext")
+
+
+def test_prewarm_reads_every_file(manager):
+    assert manager.prewarm() == sum(os.path.getsize(path) for path in manager.paths)
@@ -0,0 +1,172 @@
+import asyncio
+import ipaddress
+import os
+import random
+import shutil
+from functools import partial
+
+import pytest
+
+from src import main, models
+from src.cache import NetworkCache
+from src.databases import DatabaseManager, MMDBReaderSet
+from src.diff import aliased_networks, changed_fields, diff_builds, diff_database
+from src.reserved import NetworkSet
+from synthetic_db import MMDBWriter, asn_record, write_databases
+
+DATABASES = ("GeoLite2-City.mmdb", "GeoLite2-ASN.mmdb")
+
+
+@pytest.fixture(scope="module")
+def new_build(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("new-build")
+    write_databases(directory, seed=1, build_epoch=1700000000)
+    return directory
+
+
+def _paths(directory):
+    return [directory.joinpath(name) for name in DATABASES]
+
+
+def _replace(paths, directory):
+    # Like geoipupdate, writing over a mapped file would crash
+    for path, new_path in zip(paths, _paths(directory)):
+        os.replace(shutil.copy(new_path, f"{path}.new"), path)
+
+
+def test_changed_fields():
+    old = {"city": {"name": "Berlin", "geoname_id": 1}, "postal": {"code": "10115"}}
+    new = {"city": {"name": "Bern", "geoname_id": 1}, "location": {"latitude": 1.0}}
+    assert changed_fields(old, new) == ["city.name", "location", "postal"]
+    assert changed_fields(old, old) == []
+
+
+def test_aliased_networks():
+    aliases = [
+        ipaddress.ip_network("2002::/16"),
+        ipaddress.ip_network("::ffff:0:0/96"),
+    ]
+    assert aliased_networks(ipaddress.ip_network("1.4.0.0/20"), aliases) == [
+        ipaddress.ip_network("2002:104::/36"),
+        ipaddress.ip_network("::ffff:1.4.0.0/116"),
+    ]
+    assert aliased_networks(ipaddress.ip_network("2001:db8::/32"), aliases) == []
+
+
+def test_identical_builds_have_no_changes(synthetic_db):
+    paths = _paths(synthetic_db)
+    assert list(diff_builds(*paths, *paths)) == []
+
+
+def test_changes_cover_every_changed_address(synthetic_db, new_build):
+    changes = list(diff_builds(*_paths(synthetic_db), *_paths(new_build)))
+    networks = {"city": [], "asn": []}
+    for change in changes:
+        networks[change["database"]].append(change["network"])
+        assert change["change"] in ("added", "removed", "changed")
+        assert bool(change.get("changed_fields")) == (change["change"] == "changed")
+    networks = {name: NetworkSet(items) for name, items in networks.items()}
+
+    old = MMDBReaderSet(*_paths(synthetic_db))
+    new = MMDBReaderSet(*_paths(new_build))
+    rng = random.Random(0)
+    for _ in range(5000):
+        ip_address = ipaddress.IPv4Address(rng.getrandbits(32))
+        for database, reader_name in (("city", "city_reader"), ("asn", "asn_reader")):
+            old_record = getattr(old, reader_name).get(ip_address)
+            new_record = getattr(new, reader_name).get(ip_address)
+            changed = ip_address in networks[database]
+            assert changed == (old_record != new_record)
+    old.close()
+    new.close()
+
+
+def test_split_network_with_the_same_record_is_changed(tmp_path):
+    old = MMDBWriter("GeoLite2-ASN", record_size=24)
+    old.insert(ipaddress.ip_network("8.8.8.0/24"), asn_record(0))
+    old_path = tmp_path.joinpath("old.mmdb")
+    old.write(old_path)
+    new = MMDBWriter("GeoLite2-ASN", record_size=24)
+    for network in ("8.8.8.0/25", "8.8.8.128/25"):
+        new.insert(ipaddress.ip_network(network), asn_record(0))
+    new_path = tmp_path.joinpath("new.mmdb")
+    new.write(new_path)
+
+    changes = list(diff_database(old_path, new_path, "asn"))
+    assert changes == [
+        {
+            "database": "asn",
+            "network": ipaddress.ip_network("8.8.8.0/24"),
+            "change": "changed",
+            "changed_fields": ["network"],
+        }
+    ]
+
+    # The block of the old network no longer overlaps the new ones once evicted
+    cache = NetworkCache(maxsize=8)
+    cache.put(ipaddress.ip_network("8.8.8.0/24"), "8.8.8.0/24")
+    assert cache.evict([change["network"] for change in changes]) == 1
+
+
+def test_reload_evicts_only_changed_networks(
+    monkeypatch, tmp_path, synthetic_db, new_build
+):
+    paths = [shutil.copy(path, tmp_path) for path in _paths(synthetic_db)]
+    manager = DatabaseManager(
+        partial(MMDBReaderSet, *paths),
+        paths=paths,
+        on_reload=[models.invalidate_caches],
+        compare=models.changed_networks,
+    )
+    cache = NetworkCache(maxsize=8)
+    monkeypatch.setattr(models, "databases", manager)
+    monkeypatch.setattr(models, "RELOAD_DIFF", True)
+    monkeypatch.setattr(models, "result_cache", cache)
+    for name in ("json_cache", "binary_cache", "missing_cache"):
+        monkeypatch.setattr(models, name, NetworkCache(maxsize=8))
+
+    # 1.4.0.0/20 is only in the first build, 8.8.8.0/24 is the same in both
+    for network in ("1.4.0.0/20", "2002:104::/36", "8.8.8.0/24"):
+        cache.put(ipaddress.ip_network(network), network)
+    manager.open()
+    _replace(paths, new_build)
+
+    assert asyncio.run(manager.reload())
+    assert manager.last_changes
+    assert manager.previous_files is not None
+    assert cache.get(ipaddress.ip_address("1.4.0.1")) is None
+    assert cache.get(ipaddress.ip_address("2002:104::1")) is None
+    assert cache.get(ipaddress.ip_address("8.8.8.8")) == "8.8.8.0/24"
+
+    monkeypatch.setattr(models, "RELOAD_DIFF_MAX_NETWORKS", 10)
+    _replace(paths, synthetic_db)
+    assert asyncio.run(manager.reload())
+    assert manager.last_changes is None
+    assert len(cache) == 0
+    manager.current.retire()
+
+
+async def _body(response):
+    return "".join([chunk async for chunk in response.body_iterator])
+
+
+def test_changes_stream_outlives_reloads(
+    monkeypatch, tmp_path, synthetic_db, new_build
+):
+    paths = [shutil.copy(path, tmp_path) for path in _paths(synthetic_db)]
+    manager = DatabaseManager(partial(MMDBReaderSet, *paths), paths=paths)
+    monkeypatch.setattr(models, "databases", manager)
+    manager.open()
+    _replace(paths, new_build)
+    assert asyncio.run(manager.reload())
+
+    response = asyncio.run(main.database_changes())
+    # Closes the files of the first build, and takes over those of the second
+    _replace(paths, synthetic_db)
+    assert asyncio.run(manager.reload())
+    assert asyncio.run(manager.reload())
+
+    lines = asyncio.run(_body(response)).splitlines()
+    changes = list(diff_builds(*_paths(synthetic_db), *_paths(new_build)))
+    assert lines and len(lines) == len(changes)
+    manager.current.retire()
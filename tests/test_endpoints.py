@@ -1,8 +1,19 @@
+import asyncio
+import ipaddress
+import json
+import time
+import types
+
+import httpx
 import pytest
+from fastapi.responses import PlainTextResponse
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocket, WebSocketDisconnect
 from icecream import ic
 
 from parse_env import getenv
+from src import aggregate, binary, distances, health, main, models, sites
+from src.databases import FileIndex
 from src.main import app
 
 client = TestClient(
@@ -17,6 +28,152 @@ def test_healthz():
     assert response.json()["status"] == "ok"
 
 
+def test_livez():
+    response = client.get("/livez/")
+    assert response.status_code == 200
+    assert response.json() == {"status": "alive"}
+
+
+def test_readiness_after_warm_up():
+    with TestClient(app, base_url=client.base_url) as ready_client:
+        deadline = time.monotonic() + 5
+        while (response := ready_client.get("/readyz/")).status_code == 503:
+            assert response.json()["status"] == "starting"
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        health_response = ready_client.get("/healthz/")
+
+    assert response.status_code == 200
+    content = response.json()
+    assert content["status"] == "ready"
+    with models.databases.acquire() as readers:
+        assert content["build_epoch"] == readers.build_epoch
+    assert content["age"] > 0
+    assert health_response.json() == {"status": "ok"}
+
+
+def test_readiness_reports_starting_until_warmed_up(monkeypatch):
+    async def run(warm_up, interval):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(main.readiness, "run", run)
+    with TestClient(app, base_url=client.base_url) as starting_client:
+        response = starting_client.get("/readyz/")
+        health_response = starting_client.get("/healthz/")
+    assert response.status_code == 503
+    assert response.json() == {"status": "starting"}
+    assert health_response.status_code == 503
+    assert health_response.json() == {"status": "starting"}
+
+
+def test_healthz_reports_failed_readiness_checks(monkeypatch):
+    def check():
+        raise OSError("GeoLite2-City.mmdb is unreadable")
+
+    monkeypatch.setattr(main.readiness, "check", check)
+    with TestClient(app, base_url=client.base_url) as failing_client:
+        deadline = time.monotonic() + 5
+        while failing_client.get("/readyz/").json()["status"] == "starting":
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        response = failing_client.get("/healthz/")
+    assert response.status_code == 500
+    assert response.json() == {
+        "status": "error",
+        "message": "GeoLite2-City.mmdb is unreadable",
+    }
+
+
+def test_readiness_reports_stale_databases():
+    readiness = health.Readiness(models.databases, "8.8.8.8", max_age=1)
+    response = readiness.check()
+    assert response.status_code == 503
+    assert json.loads(response.body)["status"] == "stale"
+
+
+def test_event_loop_lag():
+    lag = health.EventLoopLag(0.01)
+
+    async def block_loop():
+        monitor = asyncio.create_task(lag.run())
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)
+        # Overdue before the monitor wakes up
+        assert lag.current() >= 0.05
+        await asyncio.sleep(0.005)
+        assert lag.lag >= 0.05
+        monitor.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await monitor
+
+    asyncio.run(block_loop())
+    assert lag.current() == 0
+
+
+def admission(max_in_flight=0, max_lag=0, lag=0.0):
+    release = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        if scope["path"] == "/slow":
+            await release.wait()
+        await PlainTextResponse("ok")(scope, receive, send)
+
+    middleware = main.AdmissionMiddleware(
+        slow_app,
+        types.SimpleNamespace(current=lambda: lag),
+        max_in_flight=max_in_flight,
+        max_lag=max_lag,
+        retry_after=2,
+    )
+    return middleware, release
+
+
+def test_admission_sheds_past_max_in_flight():
+    middleware, release = admission(max_in_flight=1)
+
+    async def send_requests():
+        base_url = client.base_url
+        async with httpx.AsyncClient(app=middleware, base_url=base_url) as asgi:
+            slow = asyncio.create_task(asgi.get("/slow"))
+            await asyncio.sleep(0.01)
+            assert middleware.in_flight == 1
+            shed = await asgi.get("/")
+            probe = await asgi.get("/healthz/")
+            release.set()
+            return await slow, shed, probe
+
+    slow, shed, probe = asyncio.run(send_requests())
+    assert slow.status_code == 200 and probe.status_code == 200
+    assert shed.status_code == 503
+    assert shed.headers["Retry-After"] == "2"
+    assert middleware.in_flight == 0
+
+
+def test_shed_responses_carry_cors_headers(monkeypatch):
+    (admission_middleware,) = [
+        middleware
+        for middleware in app.user_middleware
+        if middleware.cls is main.AdmissionMiddleware
+    ]
+    lag = types.SimpleNamespace(current=lambda: 1.0)
+    monkeypatch.setitem(admission_middleware.options, "lag", lag)
+    monkeypatch.setitem(admission_middleware.options, "max_lag", 0.5)
+    overloaded = TestClient(app.build_middleware_stack(), base_url=client.base_url)
+
+    origin = str(client.base_url).rstrip("/")
+    response = overloaded.get("/ip/8.8.8.8", headers={"Origin": origin})
+    assert response.status_code == 503
+    assert response.headers["access-control-allow-origin"] == origin
+
+
+@pytest.mark.parametrize("lag, status_code", [(0.01, 200), (0.5, 503)])
+def test_admission_sheds_on_event_loop_lag(lag, status_code):
+    middleware, _ = admission(max_lag=0.1, lag=lag)
+    lagging_client = TestClient(middleware, base_url=client.base_url)
+    assert lagging_client.get("/").status_code == status_code
+    assert lagging_client.get("/admin/databases").status_code == 200
+
+
 @pytest.mark.parametrize("ip_address", ["104.244.42.65", "8.8.8.8"])
 def test_lookup_user_ip(ip_address):
     headers = {"X-Forwarded-For": ip_address}
@@ -68,3 +225,604 @@ def test_cors_invalid_origin():
     )
     assert response.headers.get("access-control-allow-origin") is None
     # assert response.headers["allow"] == "POST"
+
+
+def test_batch_lookup():
+    ip_addresses = ["8.8.8.8", "192.168.1.2", "8.8.8.257", "8.8.8.8", "104.244.42.65"]
+    response = client.post("/batch", json={"ip_addresses": ip_addresses})
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["ip_address"] for result in results] == ip_addresses
+    assert [result["status"] for result in results] == [200, 404, 422, 200, 200]
+    assert results[0]["result"]["country"]["iso_code"] is not None
+    assert results[0] == results[3]
+    assert "message" in results[1] and "result" not in results[1]
+
+
+def test_batch_lookup_runs_off_the_event_loop(monkeypatch):
+    lookup_ip = models.lookup_ip
+
+    def lookup_off_the_loop(ip):
+        # Only the event loop thread has a running loop
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        return lookup_ip(ip)
+
+    monkeypatch.setattr(models, "lookup_ip", lookup_off_the_loop)
+    monkeypatch.setattr(models, "result_cache", models.NetworkCache(0))
+    response = client.post("/batch", json={"ip_addresses": ["8.8.8.8"]})
+    assert response.json()[0]["status"] == 200
+
+
+def test_batch_lookup_size_limit():
+    response = client.post("/batch", json={"ip_addresses": []})
+    assert response.status_code == 422
+
+
+def test_stream_lookup():
+    body = b'8.8.8.8\n{"ip": "104.244.42.65", "path": "/"}\n\n192.168.1.2\nnot-an-ip\n{"ip'
+    response = client.post("/stream", content=body)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert len(records) == 5
+    assert records[0]["geolocation"] == client.post(
+        "/", json={"ip_address": "8.8.8.8"}
+    ).json()
+    assert records[1]["path"] == "/"
+    assert records[1]["geolocation"]["country"]["iso_code"] is not None
+    assert "error" in records[2] and "error" in records[3] and "error" in records[4]
+
+
+def test_stream_lines(monkeypatch):
+    monkeypatch.setattr(models, "STREAM_MAX_LINE_SIZE", 16)
+
+    async def chunks():
+        for chunk in (b"8.8.8.8\n 1.1.", b"1.1 \n\n", b"x" * 20, b"x\n9.9.9.9"):
+            yield chunk
+
+    async def batches():
+        return [lines async for lines in models.stream_lines(chunks())]
+
+    assert asyncio.run(batches()) == [
+        [b"8.8.8.8"],
+        [b"1.1.1.1"],
+        [None],
+        [b"9.9.9.9"],
+    ]
+
+
+def test_lookup_cached_network():
+    first = client.post("/", json={"ip_address": "8.8.8.8"}).json()
+    second = client.post("/", json={"ip_address": "8.8.8.4"}).json()
+    assert second["asn"]["ip_address"] == "8.8.8.4"
+    second["asn"]["ip_address"] = first["asn"]["ip_address"]
+    assert first == second
+
+
+def test_admin_endpoints_require_token():
+    assert client.get("/admin/databases").status_code == 403
+    assert client.post("/admin/reload").status_code == 403
+    assert client.get("/admin/changes").status_code == 403
+
+
+def test_admin_reload(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    headers = {"X-Admin-Token": "secret"}
+    status = client.get("/admin/databases", headers=headers).json()
+    build_epoch = status["build_epoch"]
+    assert set(status["registry"]) == {"city", "asn"}
+    assert status["caches"]["json"] == models.json_cache.stats()
+    assert status["caches"]["missing"]["maxsize"] == models.NEGATIVE_CACHE_SIZE
+
+    response = client.post("/admin/reload", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["build_epoch"] == build_epoch
+    assert response.json()["last_reload_duration"] is not None
+    assert client.post("/", json={"ip_address": "8.8.8.8"}).status_code == 200
+
+
+def test_admin_changes(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    headers = {"X-Admin-Token": "secret"}
+    monkeypatch.setattr(models.databases, "previous_files", None)
+    assert client.get("/admin/changes", headers=headers).status_code == 404
+
+    with open(models.CITY_DB_PATH, "rb") as city, open(models.ASN_DB_PATH, "rb") as asn:
+        monkeypatch.setattr(
+            models.databases, "previous_files", {"city": city, "asn": asn}
+        )
+        response = client.get("/admin/changes", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    # The same build on both sides
+    assert response.text == ""
+
+
+@pytest.mark.parametrize(
+    "ip_address", ["104.244.42.65", "8.8.8.8", "8.8.8.9", "2001:4860::8888"]
+)
+def test_fast_response_matches_lookup(ip_address, monkeypatch):
+    response = client.post("/", json={"ip_address": ip_address})
+    monkeypatch.setattr(models, "FAST_RESPONSE", True)
+    fast_response = client.post("/", json={"ip_address": ip_address})
+    assert fast_response.status_code == 200
+    assert fast_response.headers["content-type"] == "application/json"
+    assert fast_response.content == response.content
+
+
+def test_fast_response_not_found(monkeypatch):
+    monkeypatch.setattr(models, "FAST_RESPONSE", True)
+    response = client.post("/", json={"ip_address": "192.168.1.2"})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize(
+    "fields",
+    ["country", "country.iso_code", "asn.autonomous_system_number,country", "asn"],
+)
+def test_lookup_selected_fields(fields):
+    full = client.post("/", json={"ip_address": "8.8.8.8"}).json()
+    response = client.post(
+        "/", params={"fields": fields}, json={"ip_address": "8.8.8.8"}
+    )
+    assert response.status_code == 200
+    expected = {}
+    for name in full:
+        for field in fields.split(","):
+            section, _, key = field.partition(".")
+            if section == name and not key:
+                expected[name] = full[name]
+            elif section == name:
+                expected.setdefault(name, {})[key] = full[name][key]
+    assert response.json() == expected
+    assert list(response.json()) == [name for name in full if name in expected]
+
+
+@pytest.mark.parametrize("fields", ["country.population", "isp"])
+def test_lookup_unknown_field(fields):
+    response = client.post(
+        "/", params={"fields": fields}, json={"ip_address": "8.8.8.8"}
+    )
+    assert response.status_code == 422
+
+
+def test_lookup_selected_fields_skips_asn(monkeypatch):
+    def asn_record(ip_address):
+        raise AssertionError("The ASN database must not be looked up")
+
+    with models.databases.acquire() as readers:
+        monkeypatch.setattr(readers, "asn_record", asn_record)
+        response = client.post(
+            "/", params={"fields": "country.iso_code"}, json={"ip_address": "8.8.8.8"}
+        )
+    assert response.json() == {"country": {"iso_code": "US"}}
+    assert client.post(
+        "/", params={"fields": "country"}, json={"ip_address": "192.168.1.2"}
+    ).status_code == 404
+
+
+@pytest.mark.parametrize("ip_address", ["192.168.1.2", "::ffff:10.0.0.1", "fe80::1"])
+def test_reserved_address_skips_lookup(ip_address, monkeypatch):
+    def lookup(ip_address):
+        raise AssertionError("Reserved addresses must not be looked up")
+
+    with models.databases.acquire() as readers:
+        monkeypatch.setattr(readers, "lookup", lookup)
+        response = client.post("/", json={"ip_address": ip_address})
+    assert response.status_code == 404
+    assert response.json() == {
+        "message": models.not_found_message(ipaddress.ip_address(ip_address))
+    }
+
+
+def test_missing_network_is_cached(monkeypatch):
+    monkeypatch.setattr(models, "reserved_networks", models.NetworkSet(()))
+    models.missing_cache.clear()
+    first = client.post("/", json={"ip_address": "192.168.1.2"})
+    assert models.known_missing("192.168.1.3")
+    second = client.post("/", json={"ip_address": "192.168.1.3"})
+    assert first.status_code == second.status_code == 404
+    assert second.json()["message"] == models.not_found_message("192.168.1.3")
+
+
+@pytest.mark.parametrize("fields", [None, "country.iso_code,asn"])
+@pytest.mark.parametrize("ip_address", ["8.8.8.8", "2001:4860::8888"])
+def test_get_lookup_matches_post(ip_address, fields):
+    params = {} if fields is None else {"fields": fields}
+    expected = client.post("/", params=params, json={"ip_address": ip_address})
+    response = client.get(f"/ip/{ip_address}", params=params)
+    assert response.status_code == 200
+    assert response.content == expected.content
+    assert response.headers["cache-control"] == main.CACHE_CONTROL
+    assert response.headers["etag"].startswith('"')
+
+
+def test_get_lookup_not_modified_skips_lookup(monkeypatch):
+    etag = client.get("/ip/8.8.8.8").headers["etag"]
+    assert client.get("/ip/8.8.8.9").headers["etag"] != etag
+
+    def lookup_ip_document(ip, plan=None):
+        raise AssertionError("A current ETag must not be looked up")
+
+    monkeypatch.setattr(models, "lookup_ip_document", lookup_ip_document)
+    response = client.get("/ip/8.8.8.8", headers={"If-None-Match": f"W/{etag}"})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+
+def test_get_lookup_etag_changes_with_build(monkeypatch):
+    etag = client.get("/ip/8.8.8.8").headers["etag"]
+    with models.databases.acquire() as readers:
+        monkeypatch.setattr(readers, "build_epoch", readers.build_epoch + 1)
+        response = client.get("/ip/8.8.8.8", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+@pytest.mark.parametrize(
+    "address, status_code", [("not-an-ip", 422), ("192.168.1.2", 404)]
+)
+def test_get_lookup_errors(address, status_code):
+    response = client.get(f"/ip/{address}")
+    assert response.status_code == status_code
+    assert "etag" not in response.headers
+
+
+def pack_addresses(*ip_addresses):
+    return b"".join(
+        bytes([ip.version]) + ip.packed for ip in map(ipaddress.ip_address, ip_addresses)
+    )
+
+
+def test_binary_batch_matches_json():
+    ip_addresses = ["8.8.8.8", "192.168.1.2", "2001:4860::8888", "104.244.42.65"]
+    response = client.post(
+        "/batch",
+        content=pack_addresses(*ip_addresses),
+        headers={"Content-Type": binary.CONTENT_TYPE},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == binary.CONTENT_TYPE
+
+    records = binary.decode_records(response.content)
+    assert len(records) == len(ip_addresses)
+    for ip_address, record in zip(ip_addresses, records):
+        expected = client.post("/", json={"ip_address": ip_address})
+        if expected.status_code == 404:
+            assert record is None
+            continue
+        expected = expected.json()
+        del expected["asn"]["ip_address"]
+        network = expected["asn"]["network"]
+        expected["asn"]["network"] = int(network.rpartition("/")[2])
+        assert record == expected
+
+
+def test_binary_single_lookup():
+    response = client.post(
+        "/",
+        content=pack_addresses("8.8.8.8"),
+        headers={"Content-Type": binary.CONTENT_TYPE, "Accept": binary.CONTENT_TYPE},
+    )
+    assert binary.decode_records(response.content)[0]["country"]["iso_code"] == "US"
+
+
+@pytest.mark.parametrize(
+    "path, content, headers, status_code",
+    [
+        ("/", pack_addresses("8.8.8.8", "8.8.4.4"), {}, 422),
+        ("/batch", b"\x05" + bytes(4), {}, 422),
+        ("/batch", b"\x06" + bytes(4), {}, 422),
+        ("/batch", b"", {}, 422),
+        ("/batch", pack_addresses("8.8.8.8"), {"Accept": "application/json"}, 406),
+    ],
+)
+def test_binary_errors(path, content, headers, status_code):
+    headers["Content-Type"] = binary.CONTENT_TYPE
+    response = client.post(path, content=content, headers=headers)
+    assert response.status_code == status_code
+
+
+def test_websocket_lookup():
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_json({"id": 1, "ip": "8.8.8.8"})
+        websocket.send_json({"id": "b", "ip": "192.168.1.2"})
+        websocket.send_json({"ip": "not-an-ip"})
+        websocket.send_text("{")
+        replies = [websocket.receive_json() for _ in range(4)]
+
+    expected = client.post("/", json={"ip_address": "8.8.8.8"}).json()
+    assert replies[0] == {"id": 1, "status": 200, "result": expected}
+    assert replies[1]["id"] == "b" and replies[1]["status"] == 404
+    assert replies[2]["id"] is None and replies[2]["status"] == 422
+    assert replies[3]["status"] == 422
+
+
+def test_websocket_lookup_holds_back_unread_replies(monkeypatch):
+    monkeypatch.setattr(main, "WEBSOCKET_MAX_IN_FLIGHT", 2)
+    with client.websocket_connect("/ws") as websocket:
+        for message_id in range(10):
+            websocket.send_json({"id": message_id, "ip": "8.8.8.8"})
+        replies = [websocket.receive_json() for _ in range(10)]
+    assert [reply["id"] for reply in replies] == list(range(10))
+
+
+def test_websocket_lookup_stops_when_sending_fails(monkeypatch):
+    async def send_text(self, data):
+        raise OSError("Connection reset by peer")
+
+    monkeypatch.setattr(main, "WEBSOCKET_MAX_IN_FLIGHT", 2)
+    monkeypatch.setattr(WebSocket, "send_text", send_text)
+    with client.websocket_connect("/ws") as websocket:
+        for message_id in range(5):
+            websocket.send_json({"id": message_id, "ip": "8.8.8.8"})
+        with pytest.raises(WebSocketDisconnect) as exc_info:
+            websocket.receive_text()
+    assert exc_info.value.code == 1011
+
+
+def test_network_endpoints(monkeypatch):
+    from src.networks import NetworkIndex
+
+    index = NetworkIndex.build(models.CITY_DB_PATH, models.ASN_DB_PATH)
+    monkeypatch.setattr(models, "network_index", index)
+
+    networks = [str(network) for network in index.networks("country", "US")]
+    response = client.get("/networks/country/us", params={"offset": 2, "limit": 3})
+    assert response.status_code == 200
+    assert response.json() == {
+        "country": "US",
+        "build_epoch": index.build_epoch,
+        "total": len(networks),
+        "offset": 2,
+        "limit": 3,
+        "networks": networks[2:5],
+    }
+
+    response = client.get("/networks/country/US", params={"stream": True})
+    assert response.headers["content-type"].startswith("text/plain")
+    assert response.text.splitlines() == networks
+
+    response = client.get("/networks/asn/15169")
+    assert "8.8.8.0/24" in response.json()["networks"]
+    assert client.get("/networks/asn/1").status_code == 404
+
+
+def test_network_endpoints_without_index(monkeypatch):
+    monkeypatch.setattr(models, "network_index", None)
+    assert client.get("/networks/asn/15169").status_code == 404
+    monkeypatch.setattr(models, "NETWORK_INDEX", True)
+    assert client.get("/networks/asn/15169").status_code == 503
+
+
+AGGREGATE_ADDRESSES = ["8.8.8.8", "8.8.8.9", "104.244.42.65", "81.2.69.160"] * 3 + [
+    "192.168.1.3",
+    "not an ip",
+]
+
+
+def batch_counts(ip_addresses, dimension):
+    """Count addresses by a dimension on the client side, from the results of /batch"""
+
+    counts = {}
+    response = client.post("/batch", json={"ip_addresses": ip_addresses})
+    for item in response.json():
+        if item["status"] == 200:
+            section, field = {
+                "country": ("country", "iso_code"),
+                "asn": ("asn", "autonomous_system_number"),
+            }[dimension]
+            key = str(item["result"][section][field])
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def test_aggregate_matches_batch():
+    response = client.post(
+        "/aggregate",
+        json={"ip_addresses": AGGREGATE_ADDRESSES, "by": ["country", "asn"]},
+    )
+    assert response.status_code == 200
+    content = response.json()
+    assert (content["total"], content["found"]) == (14, 12)
+    assert (content["invalid"], content["not_found"]) == (1, 1)
+    for dimension in ("country", "asn"):
+        assert content[dimension]["counts"] == batch_counts(
+            AGGREGATE_ADDRESSES, dimension
+        )
+        assert content[dimension]["unknown"] == 0
+
+
+def test_aggregate_runs_off_the_event_loop(monkeypatch):
+    def add(self, ip_address):
+        # Only the event loop thread has a running loop
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        self.total += 1
+
+    monkeypatch.setattr(aggregate.Aggregation, "add", add)
+    response = client.post("/aggregate", json={"ip_addresses": ["8.8.8.8"]})
+    assert response.json()["total"] == 1
+    response = client.post("/aggregate/stream", content=b"8.8.8.8\n1.1.1.1")
+    assert response.json()["total"] == 2
+
+
+def test_aggregate_top():
+    ip_addresses = ["8.8.8.8"] * 3 + ["104.244.42.65"] * 2 + ["81.2.69.160"]
+    response = client.post(
+        "/aggregate", json={"ip_addresses": ip_addresses, "by": ["asn"], "top": 1}
+    )
+    assert response.json()["asn"] == {
+        "keys": 3,
+        "top": [{"key": "15169", "count": 3}],
+        "others": 3,
+        "unknown": 0,
+    }
+
+
+def test_aggregate_stream_matches_list():
+    expected = client.post(
+        "/aggregate", json={"ip_addresses": AGGREGATE_ADDRESSES, "by": ["continent"]}
+    ).json()
+
+    def chunks():
+        content = "\n".join(AGGREGATE_ADDRESSES).encode()
+        for start in range(0, len(content), 7):
+            yield content[start : start + 7]
+
+    response = client.post("/aggregate/stream?by=continent", content=chunks())
+    assert response.status_code == 200
+    assert response.json() == expected
+
+
+@pytest.mark.parametrize("by", [["city"], []])
+def test_aggregate_unknown_dimension(by):
+    response = client.post("/aggregate", json={"ip_addresses": ["8.8.8.8"], "by": by})
+    assert response.status_code == 422
+
+
+SITES = [
+    {"id": "fra", "name": "Frankfurt", "latitude": 50.11, "longitude": 8.68},
+    {"id": "lhr", "name": "London", "latitude": 51.47, "longitude": -0.45},
+    {"id": "sjc", "name": "San Jose", "latitude": 37.36, "longitude": -121.93},
+    {"id": "iad", "name": "Ashburn", "latitude": 39.04, "longitude": -77.49},
+]
+
+
+@pytest.fixture
+def sites_file(monkeypatch, tmp_path):
+    path = tmp_path.joinpath("sites.json")
+    path.write_text(json.dumps(SITES))
+    nearest_cache = models.NetworkCache(8)
+    monkeypatch.setattr(sites, "nearest_cache", nearest_cache)
+    monkeypatch.setattr(
+        sites,
+        "sites",
+        FileIndex(path, sites.SiteIndex.load, on_load=[nearest_cache.clear]),
+    )
+    return path
+
+
+def test_nearest_sites(sites_file):
+    response = client.get("/nearest/81.2.69.160", params={"k": 2})
+    assert response.status_code == 200
+    content = response.json()
+    assert content["location"]["latitude"] is not None
+    # Berlin
+    assert [site["id"] for site in content["sites"]] == ["fra", "lhr"]
+    distance_kms = [site["distance_km"] for site in content["sites"]]
+    assert distance_kms == sorted(distance_kms)
+
+    # The whole block is answered from the memo
+    assert sites.nearest_cache.get(ipaddress.ip_address("81.2.69.1")) is not None
+    assert client.get("/nearest/81.2.69.1").json()["sites"] == content["sites"][:1]
+
+
+def test_nearest_sites_batch(sites_file):
+    response = client.post(
+        "/nearest",
+        json={"ip_addresses": ["8.8.8.8", "192.168.1.3", "not an ip"], "k": 4},
+    )
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()] == [200, 404, 422]
+    assert len(response.json()[0]["result"]["sites"]) == 4
+
+
+def test_nearest_sites_errors(sites_file):
+    response = client.get("/nearest/not-an-ip")
+    assert response.status_code == 422
+    assert response.json() == {"message": "not-an-ip is not a valid IP address"}
+    response = client.get("/nearest/192.168.1.3")
+    assert response.status_code == 404
+    assert response.json() == {"message": models.not_found_message("192.168.1.3")}
+    assert client.get("/nearest/8.8.8.8", params={"k": 0}).status_code == 422
+    sites_file.unlink()
+    sites.sites.index = None
+    assert client.get("/nearest/8.8.8.8").status_code == 404
+
+
+GEOFENCES = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "id": "bay-area",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [
+                    [[-123.5, 36.5], [-121.0, 36.5], [-121.0, 38.5], [-123.5, 38.5]]
+                ],
+            },
+        }
+    ],
+}
+
+
+@pytest.fixture
+def geofences(monkeypatch, tmp_path):
+    path = tmp_path.joinpath("geofences.json")
+    path.write_text(json.dumps(GEOFENCES))
+    monkeypatch.setattr(
+        distances, "geofences", FileIndex(path, distances.load_geofences)
+    )
+    monkeypatch.setattr(distances, "location_cache", models.NetworkCache(8))
+    return path
+
+
+def test_distances(geofences):
+    ip_addresses = ["81.2.69.160", "8.8.8.8", "192.168.1.3", "not an ip"]
+    response = client.post(
+        "/distance",
+        json={
+            "ip_addresses": ip_addresses,
+            # Berlin
+            "latitudes": [52.52],
+            "longitudes": [13.40],
+            "max_distance_km": 2000,
+            "geofences": ["bay-area"],
+        },
+    )
+    assert response.status_code == 200
+    content = response.json()
+    assert content["ip_addresses"] == ip_addresses
+    assert content["status"] == [200, 200, 404, 422]
+    assert content["distance_km"][0] < 1 and content["distance_km"][1] > 9000
+    assert content["distance_km"][2:] == [None, None]
+    for distance, radius, nearest, farthest in zip(
+        content["distance_km"][:2],
+        content["accuracy_radius_km"][:2],
+        content["min_distance_km"][:2],
+        content["max_distance_km"][:2],
+    ):
+        assert nearest == pytest.approx(max(distance - radius, 0), abs=0.1)
+        assert farthest == pytest.approx(distance + radius, abs=0.1)
+    assert content["within"] == [True, False, None, None]
+    # Mountain View, but its accuracy radius reaches out of the geofence
+    assert content["geofences"] == {"bay-area": [False, None, None, None]}
+
+
+def test_distances_run_off_the_event_loop(monkeypatch):
+    def compute(request):
+        # Only the event loop thread has a running loop
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        return {"ip_addresses": request.ip_addresses}
+
+    monkeypatch.setattr(distances, "distances", compute)
+    response = client.post("/distance", json={"ip_addresses": ["8.8.8.8"]})
+    assert response.status_code == 200
+
+
+def test_distances_errors(geofences):
+    request = {"ip_addresses": ["8.8.8.8"], "latitudes": [52.52]}
+    assert client.post("/distance", json=request).status_code == 422
+    request = {"ip_addresses": ["8.8.8.8"], "max_distance_km": 10}
+    assert client.post("/distance", json=request).status_code == 422
+    request = {"ip_addresses": ["8.8.8.8"], "geofences": ["unknown"]}
+    assert client.post("/distance", json=request).status_code == 422
+    geofences.unlink()
+    distances.geofences.index = None
+    request = {"ip_addresses": ["8.8.8.8"], "geofences": ["bay-area"]}
+    assert client.post("/distance", json=request).status_code == 404
@@ -0,0 +1,41 @@
+import csv
+import json
+
+import enrich
+from src import models
+
+
+def test_enrich_ndjson_matches_stream(tmp_path):
+    source = tmp_path.joinpath("input.ndjson")
+    output = tmp_path.joinpath("output.ndjson")
+    lines = ["8.8.8.8", '{"ip": "104.244.42.65", "path": "/"}', "192.168.1.2"] * 3
+    source.write_text("\n".join(lines + ["not-an-ip"]) + "\n")
+
+    enrich.main([str(source), str(output), "--workers", "2", "--chunk-size", "2"])
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [record["ip"] for record in records] == [
+        json.loads(line)["ip"] if line.startswith("{") else line
+        for line in lines + ["not-an-ip"]
+    ]
+    assert json.dumps(records[0]["geolocation"], separators=(",", ":")).encode() == (
+        models.lookup_ip_json("8.8.8.8")
+    )
+    assert records[1]["path"] == "/"
+    assert "error" in records[2] and "error" in records[-1]
+
+
+def test_enrich_csv(tmp_path):
+    source = tmp_path.joinpath("input.csv")
+    output = tmp_path.joinpath("output.csv")
+    source.write_text('name,ip\n"a, b",8.8.8.8\nc,not-an-ip\n')
+
+    enrich.main([str(source), str(output), "--workers", "1"])
+
+    with open(output, newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert rows[0]["name"] == "a, b"
+    assert rows[0]["country_iso_code"] == "US"
+    assert rows[0]["error"] == ""
+    assert rows[1]["country_iso_code"] == ""
+    assert rows[1]["error"] == "not-an-ip is not a valid IP address"
@@ -0,0 +1,117 @@
+import json
+import math
+import random
+
+import numpy as np
+import pytest
+
+from src.geo import Geofence, distance_km, load_geofences, verdicts
+from src.sites import EARTH_RADIUS_KM
+
+# Roughly Germany, with a hole around Berlin
+SQUARE = [[5.9, 47.3], [15.0, 47.3], [15.0, 55.0], [5.9, 55.0], [5.9, 47.3]]
+HOLE = [[13.0, 52.3], [13.8, 52.3], [13.8, 52.7], [13.0, 52.7], [13.0, 52.3]]
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1)
+        * math.cos(phi2)
+        * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def test_distance_matches_scalar_haversine():
+    rng = random.Random(0)
+    points = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(1000)]
+    latitudes, longitudes = np.array(points).T
+    distances = distance_km(latitudes, longitudes, 50.11, 8.68)
+    for (latitude, longitude), distance in zip(points, distances):
+        assert distance == pytest.approx(
+            haversine_km(latitude, longitude, 50.11, 8.68), abs=1e-6
+        )
+
+    # One point per row, and NaN for a missing location
+    distances = distance_km(
+        np.array([np.nan, 0.0]), np.array([0.0, 0.0]), latitudes[:2], longitudes[:2]
+    )
+    assert np.isnan(distances[0]) and not np.isnan(distances[1])
+
+
+@pytest.mark.parametrize(
+    "latitude, longitude, radius, expected",
+    [
+        # Frankfurt, well inside
+        (50.11, 8.68, 20, True),
+        # Berlin, in the hole
+        (52.52, 13.40, 5, False),
+        # Berlin, with a radius reaching out of the hole
+        (52.52, 13.40, 50, None),
+        # Paris, far outside
+        (48.86, 2.35, 100, False),
+        # About 7 km from the western edge
+        (48.58, 6.0, 5, True),
+        (48.58, 6.0, 20, None),
+        # No location
+        (np.nan, np.nan, 0, None),
+    ],
+)
+def test_geofence_classify(latitude, longitude, radius, expected):
+    geofence = Geofence("de", [[SQUARE, HOLE]])
+    inside, certain = geofence.classify(
+        np.array([latitude]), np.array([longitude]), np.array([float(radius)])
+    )
+    assert verdicts(inside, certain) == [expected]
+
+
+def test_boundary_distance_within_one_percent():
+    geofence = Geofence("de", [[SQUARE]])
+    # 1 degree of latitude north of the southern edge is about 111.2 km
+    latitudes = np.array([48.3, 48.3])
+    longitudes = np.array([10.0, 10.0])
+    _, certain = geofence.classify(latitudes, longitudes, np.array([110.0, 112.5]))
+    assert certain.tolist() == [True, False]
+
+
+def test_load_geofences(tmp_path):
+    path = tmp_path.joinpath("geofences.json")
+    path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "id": "de",
+                        "geometry": {"type": "Polygon", "coordinates": [SQUARE]},
+                    },
+                    {
+                        "type": "Feature",
+                        "properties": {"id": "berlin"},
+                        "geometry": {"type": "MultiPolygon", "coordinates": [[HOLE]]},
+                    },
+                ],
+            }
+        )
+    )
+    assert list(load_geofences(path)) == ["de", "berlin"]
+
+
+@pytest.mark.parametrize(
+    "features",
+    [
+        [{"geometry": {"type": "Polygon", "coordinates": [SQUARE]}}],
+        [{"id": "de", "geometry": {"type": "Point", "coordinates": [8.68, 50.11]}}],
+        [{"id": "de", "geometry": {"type": "Polygon", "coordinates": [SQUARE[:3]]}}],
+        [{"id": 1, "geometry": {"type": "Polygon", "coordinates": [[[200, 0]] * 4]}}],
+        [{"id": "de", "geometry": {"type": "Polygon", "coordinates": [SQUARE]}}] * 2,
+    ],
+)
+def test_load_invalid_geofences(tmp_path, features):
+    path = tmp_path.joinpath("geofences.json")
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+    with pytest.raises(ValueError):
+        load_geofences(path)
@@ -0,0 +1,63 @@
+import ipaddress
+
+import pytest
+from geoip2.errors import AddressNotFoundError
+
+from src import models
+from src.databases import MMDBReaderSet
+from src.index import IndexReaderSet, build_index, prune_city
+
+IP_ADDRESSES = [
+    "8.8.8.8",
+    "8.8.7.255",
+    "104.244.42.65",
+    "192.168.1.2",
+    "2001:4860:4860::8888",
+    "::ffff:8.8.8.8",
+    "0.0.0.0",
+    "255.255.255.255",
+]
+
+
+@pytest.fixture(scope="module")
+def index_readers(tmp_path_factory):
+    index_path = tmp_path_factory.mktemp("index").joinpath("GeoLite2-City-ASN.idx")
+    build_index(models.CITY_DB_PATH, models.ASN_DB_PATH, index_path)
+    readers = IndexReaderSet(index_path)
+    yield readers
+    readers.close()
+
+
+@pytest.fixture(scope="module")
+def mmdb_readers():
+    readers = MMDBReaderSet(models.CITY_DB_PATH, models.ASN_DB_PATH)
+    yield readers
+    readers.close()
+
+
+def lookup(readers, ip_address):
+    try:
+        return readers.records(ipaddress.ip_address(ip_address))
+    except AddressNotFoundError as exc:
+        return exc.network
+
+
+@pytest.mark.parametrize("ip_address", IP_ADDRESSES)
+def test_index_matches_readers(index_readers, mmdb_readers, ip_address):
+    expected = lookup(mmdb_readers, ip_address)
+    result = lookup(index_readers, ip_address)
+    if isinstance(expected, tuple):
+        (city, city_prefix_len), asn = expected
+        expected = (prune_city(city), city_prefix_len), asn
+    assert result == expected
+
+
+def test_index_lookup_response(index_readers, monkeypatch):
+    expected = models.lookup_ip_json("8.8.8.8")
+    monkeypatch.setattr(models.databases, "current", index_readers)
+    models.json_cache.clear()
+    models.result_cache.clear()
+    assert models.lookup_ip_json("8.8.8.8") == expected
+    assert models.lookup_ip("8.8.8.8").country.iso_code is not None
+    models.json_cache.clear()
+    models.result_cache.clear()
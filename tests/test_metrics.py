@@ -0,0 +1,152 @@
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import types
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from parse_env import getenv
+from src import main, metrics, models, sites
+from src.databases import FileIndex
+from src.main import app
+
+client = TestClient(
+    app,
+    base_url=getenv("FASTAPI_CORS_ORIGINS").split(" ")[0],
+)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    registry = metrics.Registry(tmp_path)
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    monkeypatch.setattr(metrics, "registry", registry)
+    models.result_cache.clear()
+    return registry
+
+
+def samples():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(metrics.CONTENT_TYPE)
+    return {
+        name: float(value)
+        for name, value in (
+            line.rsplit(" ", 1)
+            for line in response.text.splitlines()
+            if not line.startswith("#")
+        )
+    }
+
+
+def test_metrics_disabled():
+    assert client.get("/metrics").status_code == 404
+
+
+def test_metrics_record_stages_and_counters(registry):
+    for ip_address in ("8.8.8.8", "8.8.8.9", "192.168.1.2", "8.8.8.257"):
+        client.post("/", json={"ip_address": ip_address})
+
+    values = samples()
+    stage = "geolocation_stage_duration_seconds"
+    assert values[f'{stage}_count{{stage="request"}}'] == 4
+    assert values[f'{stage}_count{{stage="validate"}}'] == 3
+    # The private address is rejected before the cache and the databases
+    assert values[f'{stage}_count{{stage="lookup"}}'] == 1
+    assert values[f'{stage}_count{{stage="build"}}'] == 1
+    assert values[f'{stage}_count{{stage="serialize"}}'] == 2
+    assert values[f'{stage}_bucket{{stage="lookup",le="+Inf"}}'] == 1
+    assert values[f'{stage}_sum{{stage="lookup"}}'] > 0
+    assert values['geolocation_cache_hits_total{cache="result"}'] == 1
+    assert values['geolocation_cache_misses_total{cache="result"}'] == 1
+    assert values["geolocation_not_found_total"] == 1
+    assert values['geolocation_errors_total{type="invalid"}'] == 1
+
+
+def _count_not_found(count):
+    for _ in range(count):
+        metrics.NOT_FOUND.inc()
+
+
+def test_metrics_aggregate_processes(registry):
+    metrics.NOT_FOUND.inc()
+    # The child inherits the registry and must write to a file of its own
+    process = multiprocessing.get_context("fork").Process(
+        target=_count_not_found, args=(2,)
+    )
+    process.start()
+    process.join()
+
+    assert len(list(registry.directory.glob("metrics_*.bin"))) == 2
+    assert samples()["geolocation_not_found_total"] == 3
+
+
+def test_metrics_count_shed_requests(registry):
+    lag = types.SimpleNamespace(current=lambda: 1.0)
+    overloaded = main.AdmissionMiddleware(app, lag, max_lag=0.5)
+    overloaded_client = TestClient(overloaded, base_url=client.base_url)
+    assert overloaded_client.get("/livez/").status_code == 200
+    assert overloaded_client.get("/8.8.8.8").status_code == 503
+
+    assert samples()['geolocation_shed_total{reason="lag"}'] == 1
+
+
+def test_event_loop_lag_has_buckets_of_its_own(registry):
+    metrics.EVENT_LOOP_LAG.observe(None, 1.5)
+    metrics.STAGE_DURATION.observe("lookup", 0.00002)
+
+    values = samples()
+    lag = "geolocation_event_loop_lag_seconds"
+    assert values[f'{lag}_bucket{{le="1.0"}}'] == 0
+    assert values[f'{lag}_bucket{{le="2.5"}}'] == 1
+    assert values[f'{lag}_sum'] == 1.5
+    stage = "geolocation_stage_duration_seconds"
+    assert values[f'{stage}_bucket{{stage="lookup",le="2.5e-05"}}'] == 1
+
+
+def test_metrics_count_invalid_nearest_addresses_once(registry, tmp_path, monkeypatch):
+    path = tmp_path.joinpath("sites.json")
+    site = {"id": "fra", "name": "Frankfurt", "latitude": 50.11, "longitude": 8.68}
+    path.write_text(json.dumps([site]))
+    monkeypatch.setattr(sites, "nearest_cache", models.NetworkCache(8))
+    monkeypatch.setattr(sites, "sites", FileIndex(path, sites.SiteIndex.load))
+    assert client.get("/nearest/not-an-ip").status_code == 422
+    response = client.post("/nearest", json={"ip_addresses": ["not an ip", "8.8.8.8"]})
+    assert response.status_code == 200
+
+    assert samples()['geolocation_errors_total{type="invalid"}'] == 2
+
+
+RUN_SCRIPT = """
+import os
+import sys
+
+from src import metrics
+
+metrics.NOT_FOUND.inc()
+if os.fork() == 0:
+    # A worker exiting leaves the directory of the run alone
+    sys.exit(0)
+os.wait()
+print(metrics.METRICS_DIR, len(list(metrics.METRICS_DIR.glob("metrics_*.bin"))))
+"""
+
+
+def test_metrics_directory_is_scoped_to_the_run(tmp_path):
+    env = {**os.environ, "GEOLOCATION_METRICS": "true", "TMPDIR": str(tmp_path)}
+    env.pop("GEOLOCATION_METRICS_DIR", None)
+    output = subprocess.run(
+        [sys.executable, "-c", RUN_SCRIPT],
+        env=env,
+        cwd=Path(__file__).resolve().parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    directory, count = output.split()
+    assert Path(directory).parent == tmp_path and count == "1"
+    assert not Path(directory).exists()
@@ -0,0 +1,69 @@
+import ipaddress
+import random
+
+import pytest
+from geoip2.errors import AddressNotFoundError
+
+from src import models
+from src.databases import MMDBReaderSet
+from src.networks import NetworkIndex, cidrs
+
+
+@pytest.fixture(scope="module")
+def network_index():
+    return NetworkIndex.build(models.CITY_DB_PATH, models.ASN_DB_PATH)
+
+
+@pytest.fixture(scope="module")
+def readers():
+    readers = MMDBReaderSet(models.CITY_DB_PATH, models.ASN_DB_PATH)
+    yield readers
+    readers.close()
+
+
+def test_cidrs_cover_range_exactly():
+    start, end = 5, 1000
+    networks = [ipaddress.IPv4Network(network) for network in cidrs(start, end, 32)]
+    assert networks == list(
+        ipaddress.summarize_address_range(
+            ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)
+        )
+    )
+
+
+def test_network_index_finds_every_address(network_index, readers):
+    rng = random.Random(0)
+    for _ in range(2000):
+        ip_address = ipaddress.IPv4Address(rng.getrandbits(32))
+        try:
+            asn, _ = readers.asn_record(ip_address)
+        except AddressNotFoundError:
+            continue
+        number = asn["autonomous_system_number"]
+        assert any(
+            ip_address in network for network in network_index.networks("asn", number)
+        )
+
+
+@pytest.mark.parametrize("kind, key", [("asn", 15169), ("country", "DE")])
+def test_network_index_networks_match_records(network_index, readers, kind, key):
+    networks = list(network_index.networks(kind, key))
+    assert len(networks) == network_index.count(kind, key) > 0
+    assert networks == sorted(networks, key=lambda n: (n.version, n.network_address))
+    for network in networks:
+        for ip_address in (network.network_address, network.broadcast_address):
+            if kind == "asn":
+                record, _ = readers.asn_record(ip_address)
+                assert record["autonomous_system_number"] == key
+            else:
+                record, _ = readers.city_record(ip_address)
+                assert record["country"]["iso_code"] == key
+
+
+def test_network_index_pages(network_index):
+    networks = list(network_index.networks("country", "US"))
+    assert list(network_index.networks("country", "US", 5, 10)) == networks[5:15]
+    assert network_index.count("asn", 1) is None
+    stats = network_index.stats()
+    assert stats["networks"]["country"] >= len(networks)
+    assert stats["size_bytes"] > 0
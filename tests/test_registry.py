@@ -0,0 +1,138 @@
+import asyncio
+import ipaddress
+import json
+import os
+import shutil
+
+import pytest
+from geoip2.errors import AddressNotFoundError
+
+from src import models
+from src.registry import DatabaseRegistry, parse_databases
+from synthetic_db import MMDBWriter, city_record, country_record
+
+
+@pytest.fixture
+def registry(monkeypatch, synthetic_db):
+    registry = DatabaseRegistry(
+        models.databases, parse_databases("country anonymous_ip", synthetic_db)
+    )
+    monkeypatch.setattr(models, "registry", registry)
+    models.field_plan.cache_clear()
+    yield registry
+    registry.close()
+    models.field_plan.cache_clear()
+
+
+def test_parse_databases(tmp_path):
+    assert parse_databases("country isp=/data/isp.mmdb", tmp_path) == [
+        ("country", tmp_path.joinpath("GeoLite2-Country.mmdb")),
+        ("isp", "/data/isp.mmdb"),
+    ]
+    with pytest.raises(ValueError):
+        parse_databases("enterprise", tmp_path)
+
+
+@pytest.mark.parametrize(
+    "sections, route",
+    [
+        (("country",), {"country": "country"}),
+        (("continent", "country"), {"continent": "country", "country": "country"}),
+        (("country", "location"), {"country": "city", "location": "city"}),
+        (("asn", "anonymous_ip"), {"asn": "asn", "anonymous_ip": "anonymous_ip"}),
+    ],
+)
+def test_route_to_cheapest_database(registry, sections, route):
+    assert registry.route(sections) == route
+
+
+def test_route_unconfigured_section(registry):
+    with pytest.raises(ValueError):
+        registry.route(("isp",))
+    with pytest.raises(ValueError):
+        DatabaseRegistry(models.databases).route(("anonymous_ip",))
+
+
+@pytest.mark.parametrize("ip_address", ["8.8.8.8", "104.244.42.65", "2001:4860::1"])
+def test_country_database_matches_city(registry, ip_address):
+    plan = models.field_plan("continent,country")
+    assert plan.databases == ("country",)
+    content = json.loads(models.lookup_ip_fields(ip_address, plan))
+
+    models.field_plan.cache_clear()
+    city_plan = models.field_plan("continent,country,location.time_zone")
+    city_content = json.loads(models.lookup_ip_fields(ip_address, city_plan))
+    assert city_plan.databases == ("city",)
+    assert content == {
+        "continent": city_content["continent"],
+        "country": city_content["country"],
+    }
+    assert registry["country"].lookups == 1 and registry["city"].lookups == 1
+
+
+def test_extra_databases_open_lazily(registry):
+    database = registry["anonymous_ip"]
+    assert database.reader is None and not database.status()["open"]
+
+    plan = models.field_plan("anonymous_ip.is_anonymous,anonymous_ip.is_tor_exit_node")
+    content = json.loads(models.lookup_ip_fields("81.2.69.1", plan))
+    assert content == {
+        "anonymous_ip": {"is_anonymous": True, "is_tor_exit_node": True}
+    }
+    status = database.status()
+    assert status["open"] and status["lookups"] == 1
+    assert status["mean_lookup_seconds"] > 0
+
+    with pytest.raises(AddressNotFoundError):
+        models.lookup_ip_fields("8.8.8.8", plan)
+    assert models.known_missing(ipaddress.ip_address("8.8.8.8"), plan)
+    assert not models.known_missing(ipaddress.ip_address("8.8.8.8"))
+    models.missing_cache.clear()
+
+
+def test_extra_databases_reopen_when_files_change(monkeypatch, synthetic_db, tmp_path):
+    path = shutil.copy(synthetic_db.joinpath("GeoLite2-Country.mmdb"), tmp_path)
+    registry = DatabaseRegistry(models.databases, [("country", path)])
+    monkeypatch.setattr(models, "registry", registry)
+    models.field_plan.cache_clear()
+    plan = models.field_plan("country")
+    assert plan.databases == ("country",)
+
+    models.lookup_ip_fields("8.8.8.8", plan)
+    build_epoch = models.build_epoch(plan)
+    assert registry.reopen_changed() == []
+
+    writer = MMDBWriter("GeoLite2-Country", record_size=24, build_epoch=1)
+    writer.insert(ipaddress.ip_network("8.8.8.0/24"), country_record(city_record(1)))
+    # Replaced like geoipupdate does
+    writer.write(tmp_path.joinpath("new.mmdb"))
+    os.replace(tmp_path.joinpath("new.mmdb"), path)
+    reader = registry["country"].reader
+    reopened = []
+
+    async def watch():
+        registry.on_reopen.append(lambda: reopened.append(True))
+        task = asyncio.create_task(registry.watch(0))
+        while not reopened:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(watch(), 5))
+    assert registry["country"].reader is None
+    assert reader.closed
+    assert registry.reopen_changed() == []
+    assert models.build_epoch(plan) == "1" != build_epoch
+    with pytest.raises(AddressNotFoundError):
+        models.lookup_ip_fields("104.244.42.65", plan)
+    models.missing_cache.clear()
+    models.field_plan.cache_clear()
+
+
+def test_closed_extra_database_drains_lookups(registry):
+    database = registry["country"]
+    with database.acquire():
+        reader = database.reader
+        registry.close()
+        assert reader.retired and not reader.closed
+        assert database.record("8.8.8.8")[0]["country"]
+    assert reader.closed and database.reader is not reader
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import math
+import random
+
+import pytest
+
+from src.databases import FileIndex
+from src.sites import EARTH_RADIUS_KM, SiteIndex, load_sites
+
+
+def random_sites(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "id": f"site-{position}",
+            "latitude": math.degrees(math.asin(rng.uniform(-1, 1))),
+            "longitude": rng.uniform(-180, 180),
+        }
+        for position in range(count)
+    ]
+
+
+def haversine_km(latitude, longitude, site):
+    phi1, phi2 = math.radians(latitude), math.radians(site["latitude"])
+    delta_phi = phi2 - phi1
+    delta_lambda = math.radians(site["longitude"] - longitude)
+    a = (
+        math.sin(delta_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def test_nearest_matches_brute_force():
+    sites = random_sites(300)
+    index = SiteIndex(sites)
+    rng = random.Random(1)
+    for _ in range(500):
+        latitude, longitude = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        nearest = index.nearest(latitude, longitude, 5)
+        expected = sorted(
+            sites, key=lambda site: haversine_km(latitude, longitude, site)
+        )
+        assert [site["id"] for site, _ in nearest] == [
+            site["id"] for site in expected[:5]
+        ]
+        for site, distance in nearest:
+            assert distance == pytest.approx(
+                haversine_km(latitude, longitude, site), abs=1e-6
+            )
+
+
+def test_nearest_with_fewer_sites_than_k():
+    sites = random_sites(3)
+    assert len(SiteIndex(sites).nearest(0, 0, 10)) == 3
+    assert SiteIndex([]).nearest(0, 0, 1) == []
+
+
+@pytest.mark.parametrize(
+    "sites",
+    [
+        {"id": "fra"},
+        [{"latitude": 50.1, "longitude": 8.7}],
+        [{"id": "fra", "latitude": 95, "longitude": 8.7}],
+        [{"id": "fra", "latitude": 50.1, "longitude": "8.7"}],
+        [{"id": "fra", "latitude": 50.1, "longitude": 8.7}] * 2,
+    ],
+)
+def test_load_invalid_sites(tmp_path, sites):
+    path = tmp_path.joinpath("sites.json")
+    path.write_text(json.dumps(sites))
+    with pytest.raises(ValueError):
+        load_sites(path)
+
+
+def test_site_list_reloads_changed_file(tmp_path):
+    path = tmp_path.joinpath("sites.json")
+    path.write_text(json.dumps(random_sites(10)))
+    loads = []
+    site_list = FileIndex(path, SiteIndex.load, on_load=[lambda: loads.append(True)])
+    assert not site_list.changed()
+    index = site_list.current()
+    assert site_list.current() is index and loads == [True]
+
+    path.write_text("not json")
+    assert site_list.changed()
+    assert not asyncio.run(site_list.reload())
+    assert site_list.current() is index and site_list.last_error
+    assert not site_list.changed()
+
+    path.write_text(json.dumps(random_sites(20)))
+    assert asyncio.run(site_list.reload())
+    assert len(site_list.current().sites) == 20 and loads == [True, True]
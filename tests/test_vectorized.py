@@ -0,0 +1,68 @@
+import ipaddress
+
+import numpy as np
+import pytest
+
+from src import distances, models
+from src.index import build_index
+from src.vectorized import RangeIndex
+
+IPV4_ADDRESSES = ["8.8.8.8", "104.244.42.65", "192.168.1.2", "0.0.0.0", "255.255.255.255"]
+IPV6_ADDRESSES = ["2001:4860:4860::8888", "::ffff:8.8.8.8", "2002:808:808::", "::1"]
+
+
+@pytest.fixture(scope="module")
+def index_path(tmp_path_factory):
+    index_path = tmp_path_factory.mktemp("index").joinpath("GeoLite2-City-ASN.idx")
+    build_index(models.CITY_DB_PATH, models.ASN_DB_PATH, index_path)
+    return index_path
+
+
+def expected_columns(index, ip_address):
+    city, _, asn, _ = index.get(ip_address)
+    city = city or {}
+    location = city.get("location", {})
+    return {
+        "country_iso_code": city.get("country", {}).get("iso_code", ""),
+        "latitude": location.get("latitude", np.nan),
+        "longitude": location.get("longitude", np.nan),
+        "accuracy_radius": location.get("accuracy_radius", 0),
+        "autonomous_system_number": (asn or {}).get("autonomous_system_number", 0),
+    }
+
+
+def assert_columns(columns, index, ip_addresses):
+    for position, ip_address in enumerate(ip_addresses):
+        for name, value in expected_columns(index, ip_address).items():
+            np.testing.assert_equal(columns[name][position], value)
+
+
+def test_lookup_ipv4(index_path):
+    range_index = RangeIndex(index_path)
+    addresses = np.array(
+        [int(ipaddress.IPv4Address(ip)) for ip in IPV4_ADDRESSES], dtype=np.uint32
+    )
+    columns = range_index.lookup_ipv4(addresses)
+    assert_columns(columns, range_index.index, IPV4_ADDRESSES)
+    assert columns["country_iso_code"][0] != ""
+
+
+def test_lookup_ipv6(index_path):
+    range_index = RangeIndex(index_path)
+    addresses = [int(ipaddress.IPv6Address(ip)) for ip in IPV6_ADDRESSES]
+    columns = range_index.lookup_ipv6(
+        np.array([address >> 64 for address in addresses], dtype=np.uint64),
+        np.array([address & (2**64 - 1) for address in addresses], dtype=np.uint64),
+    )
+    assert_columns(columns, range_index.index, IPV6_ADDRESSES)
+
+
+def test_locate_with_index_matches_readers(monkeypatch, index_path):
+    ip_addresses = IPV4_ADDRESSES + IPV6_ADDRESSES + ["not an ip"]
+    expected = distances.locate(ip_addresses)
+
+    monkeypatch.setattr(models, "LOOKUP_ENGINE", "index")
+    monkeypatch.setattr(models, "INDEX_PATH", index_path)
+    monkeypatch.setattr(models, "_range_index", None)
+    for column, expected_column in zip(distances.locate(ip_addresses), expected):
+        np.testing.assert_equal(column, expected_column)